@@ -0,0 +1,339 @@
+# coding: utf-8
+
+"""
+Lane batched account engine for sweeps of the allocation bands.
+
+A band sweep runs one account with K sets of allocation targets and limits,
+e.g. the narrow and broad bands of scenarios.specify_allocation(). The price
+data, the deposits and the initial set up are the same for every set, only the
+rebalancing differs. The K lanes are simulated together: every account column
+is an array of lanes x days, and each pass propagates all the lanes from their
+last rebalancing date to the end at once, as refunc.propagate_window() does for
+one account. The first row of each lane that breaches its limits is then
+rebalanced with refunc.rebalance_row() and the next pass starts from there.
+
+The arithmetic mirrors refunc.propagate_window and refunc.drip term by term, the
+sums from the rebalancing date of each lane are cumulative sums over the days
+after it, so every lane has the values of rebalance_account() with its
+parameters.
+
+    lanes = [scenarios.specify_allocation({}, "50/50", rr) for rr in bands]
+    dfs = batch_engine.rebalance_lanes(a, lanes)
+"""
+
+import numpy as np
+import rebalance_account as ra
+import refunc as rf
+import row_state as rs
+
+
+# Securities, list of typically two etfs and two mutual funds. Representing equity
+# and fixed income. Do not vary these for now.
+securities = rf.securities
+
+# Parameters that can differ between the lanes of a batch.
+lane_fields = [
+    prefix + "_" + asset
+    for prefix in ["atar", "amin", "amax", "rmin", "rmax"]
+    for asset in ["cash", "fixed_income", "equity"]
+]
+
+# Columns of the lane state, lanes x days each.
+state_columns = rs.row_columns + [
+    sec + "-" + c for c in rs.security_columns for sec in securities
+]
+
+
+def read(state, nav, etf, k, i):
+    """
+    RowState of a row of one lane.
+
+    :param state: dictionary, column: np.array lanes x days
+    :param nav: list of np.array, nav per share by security offset
+    :param etf: list of lists, etf flags of every day by security offset
+    :param k: int, lane
+    :param i: int, day
+    :return: RowState
+    """
+    r = rs.RowState.__new__(rs.RowState)
+    for name in rs.row_columns:
+        setattr(r, name, state[name][k, i].item())
+    r.rebalanced = bool(r.rebalanced)
+    r.nav = [nav[j][i].item() for j in range(len(securities))]
+    r.etf = [etf[j][i] for j in range(len(securities))]
+    for name in rs.security_columns:
+        values = [state[sec + "-" + name][k, i].item() for sec in securities]
+        setattr(r, name, values)
+    return r
+
+
+def write(state, k, i, r):
+    """
+    Write a RowState back to a row of one lane.
+
+    :param state: dictionary, column: np.array lanes x days
+    :param k: int, lane
+    :param i: int, day
+    :param r: RowState
+    :return: None
+    """
+    for col, value in r.items():
+        state[col][k, i] = value
+
+
+def propagate_lanes(state, lanes, starts, a, params, prices, factors=None, events=None):
+    """
+    Fill down the lanes from their rebalancing dates to the end.
+
+    :param state: dictionary, column: np.array lanes x days, modified in place
+    :param lanes: np.array, lanes to propagate
+    :param starts: np.array, rebalancing date position of each of these lanes
+    :param a: dictionary, account parameters shared by the lanes
+    :param params: dictionary, lane field: np.array lanes x 1
+    :param prices: dictionary, column: np.array of days, see window_columns, the
+    deposits of "dep_with" can also differ between the lanes, lanes x days
+    :param factors: dictionary, security: drip factors of the account, see
+    refunc.drip_factors(), needed with the drip
+    :param events: dictionary, security: distribution dates of the account, see
+    refunc.dividend_events(), needed for the acb of taxable accounts
+    :return: None
+    """
+    n = prices["dep_with"].shape[-1]
+    days = np.arange(n)
+    rows = np.arange(lanes.size)
+    after = days[np.newaxis, :] > starts[:, np.newaxis]
+    w = {c: state[c][lanes] for c in rf.propagate_columns}
+
+    def first(col):
+        # Value on the rebalancing date, for every day of the lane.
+        return np.broadcast_to(w[col][rows, starts][:, np.newaxis], (rows.size, n))
+
+    def cumsum(values):
+        # Sums from the day after the rebalancing date of each lane.
+        return np.cumsum(np.where(after, values, 0.0), axis=1)
+
+    nav = {sec: prices[sec + "-nav_per_share"][np.newaxis, :] for sec in securities}
+    div = {sec: prices[sec + "-dividends"][np.newaxis, :] for sec in securities}
+
+    # The units and acb are those of the rebalancing date.
+    unit = {sec: first(sec + "-unit") for sec in securities}
+    acb = {sec: first(sec + "-acb") for sec in securities}
+    cash = first("cash")
+
+    # Dividends for XBB and XIC.
+    dividends = div["XBB"] * unit["XBB"] + div["XIC"] * unit["XIC"]
+    w["dividends"] = np.where(after, dividends, w["dividends"])
+
+    # Income dividends to realized tax for XBB and XIC.
+    if a["taxable_transactions"]:
+        tax_dividend = (div["XBB"] * unit["XBB"]) * a["tax_rate"] + (
+            div["XIC"] * unit["XIC"]
+        ) * a["tax_div"]
+    else:
+        tax_dividend = 0.0
+    w["tax_dividend"] = np.where(after, tax_dividend, w["tax_dividend"])
+
+    if a["drip"]:
+        for sec in securities:
+            # Lanes with no units keep the units traded written before.
+            held = (unit[sec][:, 0] != 0)[:, np.newaxis]
+            units, f = factors[sec]
+            unit_traded = unit[sec] * units[np.newaxis, :]
+            w[sec + "-unit_traded"] = np.where(
+                after & held, unit_traded, w[sec + "-unit_traded"]
+            )
+            if a["taxable_transactions"]:
+                acb[sec] = lane_acb(
+                    nav[sec][0],
+                    w[sec + "-unit_traded"],
+                    unit[sec],
+                    acb[sec],
+                    starts,
+                    held,
+                    events[sec],
+                )
+            growth = 1 + (f[np.newaxis, :] - f[starts][:, np.newaxis])
+            unit[sec] = np.where(after & held, unit[sec] * growth, unit[sec])
+
+    elif a["mutual_funds"]:
+        for sec, target in (
+            ("TD_Bond", params["atar_fixed_income"]),
+            ("TD_CDN_Equity", params["atar_equity"]),
+        ):
+            unit_traded = ((w["dividends"] - w["tax_dividend"]) * target) / nav[sec]
+            w[sec + "-unit_traded"] = np.where(
+                after, unit_traded, w[sec + "-unit_traded"]
+            )
+            unit[sec] = unit[sec] + cumsum(w[sec + "-unit_traded"])
+
+        if a["taxable_transactions"]:
+            held = np.ones((rows.size, 1), dtype=bool)
+            etf_rows = np.union1d(events["XBB"], events["XIC"])
+            for sec in ["TD_Bond", "TD_CDN_Equity"]:
+                acb[sec] = lane_acb(
+                    nav[sec][0],
+                    w[sec + "-unit_traded"],
+                    unit[sec],
+                    acb[sec],
+                    starts,
+                    held,
+                    etf_rows,
+                )
+
+        cash = cash + cumsum(
+            (unit["TD_Bond"] * div["TD_Bond"])
+            + (unit["TD_CDN_Equity"] * div["TD_CDN_Equity"])
+        )
+
+        # Calculate taxes on mutual fund transactions.
+        if a["taxable_transactions"]:
+            for sec, trate in (
+                ("TD_Bond", a["tax_rate"]),
+                ("TD_CDN_Equity", a["tax_div"]),
+            ):
+                tax = (div[sec] * unit[sec]) * trate
+                w["tax_dividend"] = np.where(
+                    after, w["tax_dividend"] + tax, w["tax_dividend"]
+                )
+                cash = cash - tax
+
+    else:
+        # Add dividends net of tax to the cash.
+        cash = cash + (cumsum(w["dividends"]) - cumsum(w["tax_dividend"]))
+
+    # Add in deposits and withdrawals.
+    cash = cash + cumsum(prices["dep_with"])
+    w["cash"] = np.where(after, cash, w["cash"])
+
+    for sec in securities:
+        w[sec + "-unit"] = unit[sec]
+        w[sec + "-acb"] = acb[sec]
+        w[sec + "-value"] = w[sec + "-unit"] * nav[sec]
+
+    w["market_value"] = (
+        w["XBB-value"] + w["XIC-value"] + w["TD_Bond-value"] + w["TD_CDN_Equity-value"]
+    )
+    w["total_value"] = w["market_value"] + w["cash"]
+    w["cash_allocation"] = w["cash"] / w["total_value"]
+    w["cash_total"] = w["cash_allocation"] * w["total_value"]
+    w["fixed_income_allocation"] = (w["XBB-value"] + w["TD_Bond-value"]) / w[
+        "total_value"
+    ]
+    w["fixed_income_total"] = w["fixed_income_allocation"] * w["total_value"]
+    w["equity_allocation"] = (w["XIC-value"] + w["TD_CDN_Equity-value"]) / w[
+        "total_value"
+    ]
+    w["equity_total"] = w["equity_allocation"] * w["total_value"]
+    w["costs"] = np.where(after, first("costs"), w["costs"])
+
+    # Only the days from the rebalancing date of each lane are written.
+    written = days[np.newaxis, :] >= starts[:, np.newaxis]
+    for col, values in w.items():
+        state[col][lanes] = np.where(written, values, state[col][lanes])
+
+
+def lane_acb(nav, unit_traded, unit, acb, starts, held, trades):
+    """
+    acb of every lane from its rebalancing date, see refunc.event_acb.
+
+    :param nav: np.array of days, nav per share
+    :param unit_traded: np.array lanes x days
+    :param unit: np.array lanes x days, units before the trades of each day
+    :param acb: np.array lanes x days, the value on the rebalancing date is used
+    :param starts: np.array, rebalancing date position of each lane
+    :param held: np.array lanes x 1 of booleans, lanes where the acb is recalculated
+    :param trades: np.array, positions of the days units can be traded on
+    :return: np.array lanes x days
+    """
+    acb = np.array(acb)
+    for k, s in enumerate(starts):
+        if held[k, 0]:
+            rows = trades[trades > s] - s
+            acb[k, s:] = rf.event_acb(
+                nav[s:], unit_traded[k, s:], unit[k, s:], acb[k, s:], rows
+            )
+    return acb
+
+
+def rebalance_lanes(a, lanes):
+    """
+    Rebalance one account with several sets of allocation parameters at once.
+
+    :param a: dictionary, account parameters, see rebalance_account.py
+    :param lanes: list of dictionaries, values of lane_fields for each lane, the
+    fields left out are those of a
+    :return: list of dataframes, one fully rebalanced and finalized account per lane
+    """
+    for lane in lanes:
+        other = set(lane) - set(lane_fields)
+        if other:
+            raise ValueError(
+                "Only the allocation parameters can differ between lanes:",
+                sorted(other),
+            )
+
+    df = rf.new_df(a)
+
+    # Initial set up, deposit cash et.
+    df = rf.initialize(a, df)
+
+    # The start date is moved to the first trade date by new_df.
+    accounts = [dict(a, **lane) for lane in lanes]
+
+    n = df.shape[0]
+    period_end = np.zeros(n, dtype=bool)
+    period_end[rf.period_positions(a, df, a["start_date"])] = True
+
+    prices = {c: df[c].values.astype(float) for c in rf.window_columns}
+    nav = [prices[sec + "-nav_per_share"] for sec in securities]
+    etf = [(df[sec + "-fund_type"] == "ETF").tolist() for sec in securities]
+    factors = rf.drip_factors(a, df) if a["drip"] else None
+    events = rf.dividend_events(df) if a["taxable_transactions"] else None
+
+    state = {
+        c: np.tile(df[c].values.astype(float), (len(lanes), 1)) for c in state_columns
+    }
+    params = {
+        f: np.array([acc[f] for acc in accounts], dtype=float)[:, np.newaxis]
+        for f in lane_fields
+    }
+
+    # Every lane starts by investing the initial deposit on the first day.
+    active = np.arange(len(lanes))
+    starts = np.zeros(len(lanes), dtype=int)
+    days = np.arange(n)
+
+    while active.size:
+        for k, i in zip(active, starts):
+            r = read(state, nav, etf, k, i)
+            write(state, k, i, rf.rebalance_row(r, accounts[k]))
+
+        lane_params = {f: v[active] for f, v in params.items()}
+        propagate_lanes(state, active, starts, a, lane_params, prices, factors, events)
+
+        # The first period date of each lane from its rebalancing date that breaches.
+        dft = {c: state[c][active] for c in ra.breach_columns}
+        lane_params["minimum_trade_dollar"] = a["minimum_trade_dollar"]
+        mask = ra.breach_mask(dft, lane_params)
+        mask &= period_end[np.newaxis, :]
+        mask &= days[np.newaxis, :] >= starts[:, np.newaxis]
+
+        breached = mask.any(axis=1)
+        active = active[breached]
+        starts = mask[breached].argmax(axis=1)
+
+    dfs = []
+    for k, acc in enumerate(accounts):
+        out = df.copy()
+        for c in state_columns:
+            if c == "rebalanced":
+                out[c] = state[c][k].astype(bool)
+            else:
+                out[c] = state[c][k]
+        out = rf.finalize(acc, out)
+        out["pct_change"] = out.value_after_tax.pct_change()
+        out["log_ret"] = np.log(out.value_after_tax) - np.log(
+            out.value_after_tax.shift(1)
+        )
+        dfs.append(out)
+    return dfs
@@ -0,0 +1,369 @@
+# coding: utf-8
+
+"""
+Columnar, memory mapped storage for the price and account template DataFrames.
+
+Each column is saved as its own .npy file next to the index and a meta.json file
+describing the columns. Loading maps the files into memory instead of
+deserializing a pickle, so opening a store is near instant and the pages are
+shared by every process reading the same store. Rows added at the end of a
+DataFrame are appended to the end of the column files, see append().
+
+Convert the pickles from the command line:
+
+    python column_store.py accounts_template.pickle data/historical_prices.pickle
+"""
+
+import argparse
+import io
+import json
+import os
+import pickle
+import numpy as np
+import pandas as pd
+
+
+# Version of the on disk layout, bumped if meta.json changes.
+layout_version = 1
+
+
+def store_path(source):
+    """
+    Default store directory for a pickle file, e.g. accounts_template_columns.
+
+    :param source: string, path to the pickle file
+    :return: string
+    """
+    root, _ = os.path.splitext(source)
+    return root + "_columns"
+
+
+def source_signature(source):
+    """
+    Size and modification time of the source file, used to detect stale stores.
+
+    :param source: string, path to the pickle file
+    :return: list, [size, mtime_ns]
+    """
+    st = os.stat(source)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def save(df, path, source=None):
+    """
+    Write a DataFrame to a column store.
+
+    Numeric, boolean and datetime columns are saved as is, categorical and
+    object columns are saved as category codes.
+
+    :param df: dataframe
+    :param path: string, store directory
+    :param source: string, pickle file the DataFrame was loaded from
+    :return: None
+    """
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    columns = []
+    for i, col in enumerate(df.columns):
+        s = df[col]
+        filename = "c" + str(i) + ".npy"
+        meta = {"name": col, "file": filename}
+
+        if s.dtype.name == "category" or s.dtype == object:
+            cat = s.astype("category")
+            values = np.asarray(cat.cat.codes)
+            meta["kind"] = "category" if s.dtype.name == "category" else "object"
+            meta["categories"] = cat.cat.categories.tolist()
+            meta["ordered"] = bool(cat.cat.ordered)
+        elif np.issubdtype(s.dtype, np.datetime64):
+            values = np.asarray(s.values.astype("datetime64[ns]").view("i8"))
+            meta["kind"] = "datetime"
+        else:
+            values = np.asarray(s.values)
+            meta["kind"] = "values"
+
+        np.save(os.path.join(path, filename), values, allow_pickle=False)
+        columns.append(meta)
+
+    if isinstance(df.index, pd.DatetimeIndex):
+        index = np.asarray(df.index.asi8)
+        index_kind = "datetime"
+    else:
+        index = np.asarray(df.index.values)
+        index_kind = "values"
+    np.save(os.path.join(path, "index.npy"), index, allow_pickle=False)
+
+    meta = {
+        "layout_version": layout_version,
+        "rows": len(df),
+        "index": {"name": df.index.name, "kind": index_kind},
+        "columns": columns,
+        "source": os.path.abspath(source) if source else None,
+        "source_signature": source_signature(source) if source else None,
+    }
+
+    # Write meta.json last, a store without it is incomplete.
+    write_meta(path, meta)
+
+
+def write_meta(path, meta):
+    """
+    Replace the meta.json file of a store in one step.
+
+    :param path: string, store directory
+    :param meta: dictionary
+    :return: None
+    """
+    tmp = os.path.join(path, "meta.json.tmp")
+    with open(tmp, "w") as f:
+        json.dump(meta, f, indent=1)
+    os.replace(tmp, os.path.join(path, "meta.json"))
+
+
+def convert(source, path=None):
+    """
+    Convert a pickled DataFrame to a column store.
+
+    :param source: string, path to the pickle file
+    :param path: string, store directory, defaults to store_path(source)
+    :return: string, store directory
+    """
+    path = path or store_path(source)
+    with open(source, "rb") as infile:
+        df = pickle.load(infile)
+    save(df, path, source=source)
+    return path
+
+
+def encode(s, meta):
+    """
+    Values of a column as save() writes them, for the columns of a store.
+
+    :param s: series
+    :param meta: dictionary, column of meta.json
+    :return: np.array, or None if a value is not one of the store's categories
+    """
+    if meta["kind"] in ("category", "object"):
+        cat = pd.Categorical(s, categories=meta["categories"], ordered=meta["ordered"])
+        codes = np.asarray(cat.codes)
+        if ((codes == -1) & np.asarray(s.notnull())).any():
+            return None
+        return codes
+    elif meta["kind"] == "datetime":
+        return np.asarray(s.values.astype("datetime64[ns]").view("i8"))
+    return np.asarray(s.values)
+
+
+def append_npy(filename, values):
+    """
+    Append values to the end of a one dimensional .npy file.
+
+    The header of a .npy file is padded for its length to grow, only the length
+    in the header is written again.
+
+    :param filename: string, .npy file of format version 1.0
+    :param values: np.array, same dtype as the file
+    :return: None
+    """
+    with open(filename, "r+b") as f:
+        np.lib.format.read_magic(f)
+        shape, fortran, dtype = np.lib.format.read_array_header_1_0(f)
+        offset = f.tell()
+
+        header = io.BytesIO()
+        d = {
+            "descr": np.lib.format.dtype_to_descr(dtype),
+            "fortran_order": fortran,
+            "shape": (shape[0] + len(values),),
+        }
+        np.lib.format.write_array_header_1_0(header, d)
+        if header.tell() != offset:
+            raise ValueError("The header of " + filename + " can not grow.")
+
+        f.seek(offset + shape[0] * dtype.itemsize)
+        f.write(np.ascontiguousarray(values, dtype=dtype).tobytes())
+        f.seek(0)
+        f.write(header.getvalue())
+
+
+def append(df, path, source=None):
+    """
+    Append rows to a column store, only the new rows are written.
+
+    The rows must have the columns of the store, with the same dtypes and no new
+    categories, otherwise nothing is written and the store has to be saved again.
+
+    :param df: dataframe, rows after the last row of the store
+    :param path: string, store directory
+    :param source: string, pickle file the whole DataFrame was saved to
+    :return: boolean, True if the rows were appended
+    """
+    with open(os.path.join(path, "meta.json")) as f:
+        meta = json.load(f)
+    if meta["layout_version"] != layout_version or [
+        c["name"] for c in meta["columns"]
+    ] != list(df.columns):
+        return False
+
+    if meta["index"]["kind"] == "datetime":
+        if not isinstance(df.index, pd.DatetimeIndex):
+            return False
+        index = np.asarray(df.index.asi8)
+    else:
+        index = np.asarray(df.index.values)
+
+    # Check every column before writing any.
+    arrays = [("index.npy", index)]
+    for c in meta["columns"]:
+        values = encode(df[c["name"]], c)
+        if values is None:
+            return False
+        arrays.append((c["file"], values))
+    for filename, values in arrays:
+        with open(os.path.join(path, filename), "rb") as f:
+            version = np.lib.format.read_magic(f)
+            if version != (1, 0):
+                return False
+            shape, _, dtype = np.lib.format.read_array_header_1_0(f)
+        if len(shape) != 1 or shape[0] != meta["rows"] or values.dtype != dtype:
+            return False
+
+    for filename, values in arrays:
+        append_npy(os.path.join(path, filename), values)
+
+    meta["rows"] += len(df)
+    if source:
+        meta["source"] = os.path.abspath(source)
+        meta["source_signature"] = source_signature(source)
+
+    # Write meta.json last, the store is stale until then.
+    write_meta(path, meta)
+    return True
+
+
+class ColumnStore(object):
+    """
+    Memory mapped column store opened by load().
+
+    :param path: string, store directory
+    :param meta: dictionary, contents of meta.json
+    :param mmap: boolean, memory map the columns instead of reading them
+    """
+
+    def __init__(self, path, meta, mmap=True):
+        self.path = path
+        self.meta = meta
+        self._mmap_mode = "r" if mmap else None
+        self._columns = {c["name"]: c for c in meta["columns"]}
+        self._arrays = {}
+
+        index = self._load("index.npy")
+        if meta["index"]["kind"] == "datetime":
+            self.index = pd.DatetimeIndex(
+                np.asarray(index).view("datetime64[ns]"), name=meta["index"]["name"]
+            )
+        else:
+            self.index = pd.Index(np.asarray(index), name=meta["index"]["name"])
+
+    @property
+    def columns(self):
+        return [c["name"] for c in self.meta["columns"]]
+
+    def _load(self, filename):
+        return np.load(os.path.join(self.path, filename), mmap_mode=self._mmap_mode)
+
+    def array(self, col):
+        """
+        Raw array of a column, category and object columns are returned as codes.
+
+        :param col: string, column name
+        :return: np.array, read only memory map
+        """
+        try:
+            return self._arrays[col]
+        except KeyError:
+            values = self._load(self._columns[col]["file"])
+            self._arrays[col] = values
+            return values
+
+    def column(self, col, start=None, stop=None):
+        """
+        Values of a column for the rows start to stop, copied out of the store.
+
+        :param col: string, column name
+        :param start: int, first row position
+        :param stop: int, row position after the last row
+        :return: np.array or pd.Categorical
+        """
+        meta = self._columns[col]
+        values = np.array(self.array(col)[start:stop])
+        if meta["kind"] in ("category", "object"):
+            values = pd.Categorical.from_codes(
+                values, meta["categories"], ordered=meta["ordered"]
+            )
+            if meta["kind"] == "object":
+                return np.asarray(values, dtype=object)
+            return values
+        elif meta["kind"] == "datetime":
+            return values.view("datetime64[ns]")
+        return values
+
+    def frame(self, start=None, stop=None):
+        """
+        DataFrame for the rows start to stop, only those rows are read.
+
+        :param start: int, first row position
+        :param stop: int, row position after the last row
+        :return: dataframe
+        """
+        data = {col: self.column(col, start, stop) for col in self.columns}
+        return pd.DataFrame(data, index=self.index[start:stop], columns=self.columns)
+
+
+def load(path, mmap=True):
+    """
+    Open a column store.
+
+    :param path: string, store directory
+    :param mmap: boolean, memory map the columns instead of reading them
+    :return: ColumnStore
+    """
+    with open(os.path.join(path, "meta.json")) as f:
+        meta = json.load(f)
+    if meta["layout_version"] != layout_version:
+        raise ValueError("Unsupported column store layout in " + path)
+    return ColumnStore(path, meta, mmap=mmap)
+
+
+def is_current(path, source):
+    """
+    True if the store exists and was converted from the current source file.
+
+    :param path: string, store directory
+    :param source: string, path to the pickle file
+    :return: boolean
+    """
+    try:
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+    except (IOError, OSError, ValueError):
+        return False
+    if meta.get("layout_version") != layout_version:
+        return False
+    if not os.path.exists(source):
+        # The store is all there is.
+        return True
+    return meta.get("source_signature") == source_signature(source)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Convert pickled DataFrames to memory mapped column stores."
+    )
+    parser.add_argument("sources", nargs="+", help="pickle files to convert")
+    args = parser.parse_args()
+
+    for source in args.sources:
+        print(source, "->", convert(source))
@@ -0,0 +1,360 @@
+# coding: utf-8
+
+"""
+Single pass, event driven account engine.
+
+rebalance_account.py rebalances a row and then propagates the account forward
+from it until the next rebalancing date, one pass of array operations per
+rebalance. This engine walks the trading days once and carries the holdings,
+acb and cash forward as state. When the band masks fire on a rebalancing period
+date the rebalance_row logic is applied inline and the walk continues from the
+rebalanced row.
+
+The arithmetic mirrors refunc.propagate and refunc.drip term by term so the
+output DataFrame is the same as the one returned by the loop, up to the rounding
+of the vectorized refunc.calc_acb.
+"""
+
+import numpy as np
+import refunc as rf
+import row_state as rs
+from row_state import XBB, XIC, TD_BOND, TD_CDN_EQUITY
+
+
+# Securities, list of typically two etfs and two mutual funds. Representing equity
+# and fixed income. Do not vary these for now.
+securities = rf.securities
+
+# Row level columns carried forward as state and written to the output DataFrame.
+row_columns = rs.row_columns
+
+# Security level columns carried forward as state.
+security_columns = rs.security_columns
+
+# Minimum number of final rows passed to the online metrics at a time.
+feed_rows = 64
+
+
+def breach(r, a):
+    """
+    Test one row against the rebalancing masks used in rebalance_account.py.
+
+    :param r: RowState, one row of the account
+    :param a: dictionary, account parameters
+    :return: boolean, True if the row is outside the allocation limits.
+    """
+    tv = r.total_value
+    mtd = a["minimum_trade_dollar"]
+    csh = r.cash_allocation
+    fi = r.fixed_income_allocation
+    eq = r.equity_allocation
+
+    # Test for maximum levels.
+    if csh > a["amax_cash"] and (csh - a["rmax_cash"]) * tv > mtd:
+        return True
+    if fi > a["amax_fixed_income"] and (fi - a["rmax_fixed_income"]) * tv > mtd:
+        return True
+    if eq > a["amax_equity"] and (eq - a["rmax_equity"]) * tv > mtd:
+        return True
+
+    # Test for minimum levels.
+    if csh < a["amin_cash"] and (csh - a["rmin_cash"]) * tv < -mtd:
+        return True
+    if fi < a["amin_fixed_income"] and (fi - a["rmin_fixed_income"]) * tv < -mtd:
+        return True
+    if eq < a["amin_equity"] and (eq - a["rmin_equity"]) * tv < -mtd:
+        return True
+
+    return False
+
+
+def settle_row(r):
+    """
+    Recalculate values, totals and allocations of a row, as propagate does for
+    the first row of the propagated window.
+
+    :param r: RowState, one row of the account
+    :return: RowState
+    """
+    market_value = 0
+    for k in range(len(securities)):
+        r.value[k] = r.unit[k] * r.nav[k]
+        market_value += r.value[k]
+
+    total_value = market_value + r.cash
+    r.market_value = market_value
+    r.total_value = total_value
+
+    r.cash_allocation = r.cash / total_value
+    r.cash_total = r.cash_allocation * total_value
+    r.fixed_income_allocation = (r.value[XBB] + r.value[TD_BOND]) / total_value
+    r.fixed_income_total = r.fixed_income_allocation * total_value
+    r.equity_allocation = (r.value[XIC] + r.value[TD_CDN_EQUITY]) / total_value
+    r.equity_total = r.equity_allocation * total_value
+
+    return r
+
+
+def rebalance_account(a, online=None):
+    """
+    Single pass equivalent of rebalance_account.rebalance_account.
+
+    :param a: dictionary, account parameters, see rebalance_account.py
+    :param online: OnlineMetrics, optional, fed the value after tax of the days
+    once they are final, the account is then not written back nor finalized
+    :return: dataframe, fully rebalanced and finalized account, or None with online
+    """
+    df = rf.new_df(a)
+
+    # Initial set up, deposit cash et.
+    df = rf.initialize(a, df)
+
+    period_end = [False] * df.shape[0]
+    for i in rf.period_positions(a, df, a["start_date"]):
+        period_end[i] = True
+
+    n = df.shape[0]
+    ks = range(len(securities))
+
+    # Price data as plain lists, scalar access on lists is much faster than on arrays.
+    nav = [df[sec + "-nav_per_share"].tolist() for sec in securities]
+    div = [df[sec + "-dividends"].tolist() for sec in securities]
+    dep_with = df["dep_with"].tolist()
+
+    # Output columns start from the template values, only rows that the loop would
+    # write are overwritten. Security columns are lists by security offset.
+    out = {c: df[c].tolist() for c in row_columns}
+    out_sec = {
+        c: [df[sec + "-" + c].tolist() for sec in securities] for c in security_columns
+    }
+    out_unit_traded = out_sec["unit_traded"]
+
+    # Drip units bought per unit held and their cumulative sum, by security.
+    if a["drip"]:
+        factors = rf.drip_factors(a, df)
+        drip_unit = [factors[sec][0].tolist() for sec in securities]
+        drip_f = [factors[sec][1].tolist() for sec in securities]
+
+    # With drip, securities with no units keep the units traded written by the
+    # last window that held units. Track the units that window started with.
+    drip_units = [None for _ in ks]
+
+    # Only taxable accounts track the acb, it is the cost of the gains they pay tax
+    # on.
+    taxable = a["taxable_transactions"]
+
+    # Days on which any security pays a dividend, on the other days the holdings
+    # and acb of the day before carry over.
+    paid = [False] * n
+    for rows in rf.dividend_events(df).values():
+        for j in rows:
+            paid[j] = True
+
+    def record(i, r):
+        for c in row_columns:
+            out[c][i] = getattr(r, c)
+        for c in security_columns:
+            values = getattr(r, c)
+            column = out_sec[c]
+            for k in ks:
+                column[k][i] = values[k]
+
+    def rebalance(i, r):
+        # Rebalance the row until it no longer breaches, the loop would pick the
+        # same date again until it does.
+        while True:
+            r = settle_row(rf.rebalance_row(r, a))
+            record(i, r)
+            if not (period_end[i] and breach(r, a)):
+                return r
+
+    # Rows before fed have been passed to the online metrics, in runs of at least
+    # feed_rows rows.
+    fed = [0, 0.0]
+    if online is not None:
+        online.start(n)
+
+    def feed(stop):
+        w = {
+            c: out[c][fed[0] : stop]
+            for c in ["total_value", "tax_dividend", "tax_gain"]
+        }
+        for k, sec in enumerate(securities):
+            w[sec + "-nav_per_share"] = nav[k][fed[0] : stop]
+            w[sec + "-acb"] = out_sec["acb"][k][fed[0] : stop]
+            w[sec + "-unit"] = out_sec["unit"][k][fed[0] : stop]
+        values, fed[1] = rf.final_values(a, w, fed[1])
+        online.update(values)
+        fed[0] = stop
+
+    # First row, cash from the initial deposit is always invested.
+    r = rs.from_values(df.iloc[0].tolist(), rs.positions(df.columns))
+    r = rebalance(0, r)
+
+    i = 1
+    while i < n:
+        # Start of a new window, the state of the rebalanced row.
+        s = i - 1
+        cash0 = r.cash
+        costs0 = r.costs
+        unit0 = list(r.unit)
+        unit = list(unit0)
+        acb = list(r.acb)
+        cum = [0 for _ in ks]
+        cum_dividends = 0
+        cum_tax = 0
+        cum_mf = 0
+        cum_dep = 0
+
+        if a["drip"]:
+            for k in ks:
+                if unit0[k] != 0:
+                    drip_units[k] = unit0[k]
+
+        while i < n:
+            r.purchases = out["purchases"][i]
+            r.sales = out["sales"][i]
+            r.tax_gain = out["tax_gain"][i]
+            r.rebalanced = out["rebalanced"][i]
+            for k in ks:
+                r.nav[k] = nav[k][i]
+
+            # Dividends for XBB and XIC.
+            dividends = 0
+            tax_dividend = 0
+            if paid[i]:
+                dividends += div[XBB][i] * unit0[XBB]
+                dividends += div[XIC][i] * unit0[XIC]
+
+                # Income dividends to realized tax for XBB and XIC.
+                if a["taxable_transactions"]:
+                    tax_dividend += (div[XBB][i] * unit0[XBB]) * a["tax_rate"]
+                    tax_dividend += (div[XIC][i] * unit0[XIC]) * a["tax_div"]
+
+            cash = cash0
+            if a["drip"]:
+                for k in ks:
+                    if unit0[k] == 0:
+                        if drip_units[k] is not None:
+                            r.unit_traded[k] = drip_units[k] * drip_unit[k][i]
+                        else:
+                            r.unit_traded[k] = out_unit_traded[k][i]
+                        continue
+
+                    if not paid[i]:
+                        r.unit_traded[k] = 0.0
+                        continue
+
+                    unit_traded = unit0[k] * drip_unit[k][i]
+
+                    if not taxable:
+                        pass
+                    elif unit0[k] + unit_traded == 0:
+                        acb[k] = 0
+                    else:
+                        acb[k] = ((acb[k] * unit0[k]) + (nav[k][i] * unit_traded)) / (
+                            unit0[k] + unit_traded
+                        )
+
+                    unit[k] = unit0[k] * (1 + (drip_f[k][i] - drip_f[k][s]))
+                    r.unit_traded[k] = unit_traded
+
+            elif a["mutual_funds"]:
+                for k in [XBB, XIC]:
+                    r.unit_traded[k] = out_unit_traded[k][i]
+
+                for k, target in (
+                    (TD_BOND, a["atar_fixed_income"]),
+                    (TD_CDN_EQUITY, a["atar_equity"]),
+                ):
+                    if not paid[i]:
+                        # Nothing to sweep, the acb resets with no units held.
+                        if taxable and unit[k] == 0:
+                            acb[k] = 0
+                        r.unit_traded[k] = 0.0
+                        continue
+
+                    unit_traded = ((dividends - tax_dividend) * target) / nav[k][i]
+                    cum[k] += unit_traded
+                    unit_before = unit[k]
+                    unit[k] = unit0[k] + cum[k]
+
+                    if not taxable:
+                        pass
+                    elif unit[k] + unit_traded == 0:
+                        acb[k] = 0
+                    else:
+                        acb[k] = (
+                            (acb[k] * unit_before) + (nav[k][i] * unit_traded)
+                        ) / (unit_before + unit_traded)
+
+                    r.unit_traded[k] = unit_traded
+
+                if paid[i]:
+                    cum_mf += (unit[TD_BOND] * div[TD_BOND][i]) + (
+                        unit[TD_CDN_EQUITY] * div[TD_CDN_EQUITY][i]
+                    )
+                cash = cash0 + cum_mf
+
+                # Calculate taxes on mutual fund transactions.
+                if a["taxable_transactions"] and paid[i]:
+                    for k, trate in (
+                        (TD_BOND, a["tax_rate"]),
+                        (TD_CDN_EQUITY, a["tax_div"]),
+                    ):
+                        tax_dividend += (div[k][i] * unit[k]) * trate
+                        cash -= (div[k][i] * unit[k]) * trate
+
+            else:
+                for k in ks:
+                    r.unit_traded[k] = out_unit_traded[k][i]
+
+                # Add dividends net of tax to the cash.
+                cum_dividends += dividends
+                cum_tax += tax_dividend
+                cash = cash0 + (cum_dividends - cum_tax)
+
+            # Add in deposits and withdrawals.
+            cum_dep += dep_with[i]
+            cash += cum_dep
+
+            r.cash = cash
+            r.dividends = dividends
+            r.tax_dividend = tax_dividend
+            r.costs = costs0
+            for k in ks:
+                r.unit[k] = unit[k]
+                r.acb[k] = acb[k]
+
+            r = settle_row(r)
+            record(i, r)
+
+            if period_end[i] and breach(r, a):
+                r = rebalance(i, r)
+                i += 1
+                # The rows up to the rebalanced row are final.
+                if online is not None and i - fed[0] >= feed_rows:
+                    feed(i)
+                break
+
+            i += 1
+
+    if online is not None:
+        feed(n)
+        return None
+
+    # Write the state back to the DataFrame.
+    for c, values in out.items():
+        if c == "rebalanced":
+            df[c] = np.array(values, dtype=bool)
+        else:
+            df[c] = np.array(values, dtype=float)
+    for c, columns in out_sec.items():
+        for sec, values in zip(securities, columns):
+            df[sec + "-" + c] = np.array(values, dtype=float)
+
+    df = rf.finalize(a, df)
+    df["pct_change"] = df.value_after_tax.pct_change()
+    df["log_ret"] = np.log(df.value_after_tax) - np.log(df.value_after_tax.shift(1))
+
+    return df
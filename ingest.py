@@ -0,0 +1,429 @@
+# coding: utf-8
+
+"""
+Price ingestion, replaces data/data_munge.ipynb and data/account_template.ipynb.
+
+Parses the iShares and TD spreadsheets in data/etf_data and data/mutual_fund_data
+in parallel, builds data/historical_prices.pickle and appends new trading days to
+accounts_template.pickle. Every source file is hashed and only files that changed
+since the last run are parsed again, the parsed history of the others is read
+from data/ingest_cache.
+
+    python ingest.py
+    python ingest.py --full --workers 4
+"""
+
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import json
+import os
+import pickle
+import column_store as cs
+import numpy as np
+import pandas as pd
+import price_panel as pp
+
+
+# iShares spreadsheets: file name, (security, asset class).
+# The notebook stored the geography in the asset_class column, kept as is.
+etf_files = {
+    "iShares-Core-Canadian-Short-Term-Bond-Index-ETF_fund.xlsx": ("XSB", "Canadian"),
+    "iShares-Core-Canadian-Universe-Bond-Index-ETF_fund.xlsx": ("XBB", "Canadian"),
+    "iShares-Core-SP-500-Index-ETF-CAD--Hedged_fund.xlsx": ("XSP", "United States"),
+    "iShares-Core-SPTSX-Capped-Composite-Index-ETF_fund.xlsx": ("XIC", "Canadian"),
+    "iShares-MSCI-EAFE-Index-ETF-CAD-Hedged_fund.xlsx": ("XIN", "International"),
+    "iShares-SPTSX-60-Index-ETF_fund.xlsx": ("XIU", "Canadian"),
+}
+
+# TD e-series spreadsheets: file name, (security, asset class).
+mf_files = {
+    "TD Canadian Bond Index - e.xlsx": ("TD_Bond", "Canadian"),
+    "TD Canadian Index - e.xlsx": ("TD_CDN_Equity", "Canadian"),
+    "TD International Index - e.xlsx": ("TD_INT_Equity", "International"),
+    "TD US Index e.xlsx": ("TD_US_Equity", "United States"),
+}
+
+# Securities in the account template, see refunc.securities.
+securities = ["XBB", "XIC", "TD_Bond", "TD_CDN_Equity"]
+
+# First trade date in the account template.
+template_start = "2002-01-01"
+
+# Account columns of the template, all start at zero.
+account_columns = [
+    "cash",
+    "dep_with",
+    "dividends",
+    "purchases",
+    "sales",
+    "market_value",
+    "total_value",
+    "total_value_norm",
+    "tax_accrued",
+    "tax_dividend",
+    "tax_gain",
+    "tax_realized",
+    "tax_total",
+    "value_after_tax",
+    "value_after_tax_norm",
+    "costs",
+    "rebalanced",
+    "cash_allocation",
+    "fixed_income_allocation",
+    "equity_allocation",
+    "cash_total",
+    "fixed_income_total",
+    "equity_total",
+]
+
+# Security columns of the template, in order.
+security_columns = [
+    "nav_per_share",
+    "unit_traded",
+    "unit",
+    "value",
+    "dividends",
+    "acb",
+    "asset_class",
+    "fund_type",
+]
+
+# Columns taken from the price history, the rest start at zero.
+price_columns = ["nav_per_share", "dividends", "asset_class", "fund_type"]
+
+# Last days of the template compared with the history before new days are
+# appended, see update_template().
+check_rows = 20
+
+
+def file_hash(path):
+    """
+    sha256 of a source file.
+
+    :param path: string
+    :return: string, hex digest
+    """
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def parse_etf(path):
+    """
+    Read the historical sheet of an iShares spreadsheet.
+
+    :param path: string
+    :return: dataframe, trade_date, nav_per_share, dividends
+    """
+    # The EAFE sheet has no index return column.
+    if os.path.basename(path) == "iShares-MSCI-EAFE-Index-ETF-CAD-Hedged_fund.xlsx":
+        use_columns = [0, 1, 2]
+    else:
+        use_columns = [0, 2, 3]
+
+    df = pd.read_excel(
+        path,
+        sheet_name="Historical",
+        usecols=use_columns,
+        names=["trade_date", "nav_per_share", "dividends"],
+        na_values="--",
+    )
+    df["trade_date"] = pd.to_datetime(df["trade_date"])
+    return df
+
+
+def parse_mf(path):
+    """
+    Read a TD e-series spreadsheet.
+
+    :param path: string
+    :return: dataframe, trade_date, nav_per_share, dividends
+    """
+    df = pd.read_excel(
+        path,
+        sheet_name=0,
+        names=["trade_date", "nav_per_share", "dividends"],
+        na_values="--",
+        skiprows=1,
+    )
+    df["trade_date"] = pd.to_datetime(df["trade_date"])
+    return df
+
+
+def parse(source):
+    """
+    Parse one source file, called in the worker processes.
+
+    :param source: tuple, (fund_type, path)
+    :return: dataframe
+    """
+    fund_type, path = source
+    if fund_type == "ETF":
+        return parse_etf(path)
+    return parse_mf(path)
+
+
+def sources(data_dir):
+    """
+    Source files by name.
+
+    :param data_dir: string
+    :return: dictionary, name: (fund_type, path, security, asset_class)
+    """
+    s = {}
+    for name, (security, asset_class) in etf_files.items():
+        path = os.path.join(data_dir, "etf_data", name)
+        s[name] = ("ETF", path, security, asset_class)
+    for name, (security, asset_class) in mf_files.items():
+        path = os.path.join(data_dir, "mutual_fund_data", name)
+        s[name] = ("Mutual Fund", path, security, asset_class)
+    return s
+
+
+def concat_sources(parsed, source_list):
+    """
+    Rows of all source files in file order, missing prices dropped.
+
+    :param parsed: dictionary, name: dataframe from parse()
+    :param source_list: dictionary, from sources()
+    :return: dataframe
+    """
+    # The id runs over all rows of the ETF sheets and of the mutual fund sheets,
+    # in the order of the files, before the missing prices are dropped.
+    frames = []
+    ids = {}
+    for name, (fund_type, _, security, asset_class) in source_list.items():
+        df = parsed[name].copy()
+        start = ids.get(fund_type, 0)
+        ids[fund_type] = start + len(df)
+        df.index = pd.RangeIndex(start, ids[fund_type], name="id")
+        df["security"] = security
+        df["asset_class"] = asset_class
+        df["fund_type"] = fund_type
+
+        # Clean the NAV column to remove the NaN's.
+        frames.append(df[df["nav_per_share"].notnull()])
+
+    return pd.concat(frames, axis=0)
+
+
+def build_history(rows):
+    """
+    Long format price history of all securities, as historical_prices.pickle.
+
+    :param rows: dataframe, from concat_sources()
+    :return: dataframe
+    """
+    hist = rows.sort_values(by=["fund_type", "security", "trade_date"], ascending=True)
+    hist = hist.astype(
+        {"security": "category", "asset_class": "category", "fund_type": "category"}
+    )
+
+    # Zero dividends in the mutual fund sheets mean no distribution.
+    hist["dividends"] = hist["dividends"].replace({0: np.nan})
+
+    return hist
+
+
+def template_frame(hist, start=template_start, end=None):
+    """
+    Account template rows built from the price history.
+
+    :param hist: dataframe, from build_history()
+    :param start: string, first trade date
+    :param end: string, last trade date or None for all
+    :return: dataframe, indexed by trade date
+    """
+    hist = hist[hist["trade_date"] >= start]
+    if end is not None:
+        hist = hist[hist["trade_date"] <= end]
+    hist = hist[hist["security"].isin(securities)]
+
+    wide = []
+    for sec in securities:
+        df = hist.loc[hist["security"] == sec, ["trade_date"] + price_columns]
+        df = df.set_index("trade_date")
+        df["dividends"] = df["dividends"].fillna(0)
+        df.columns = [sec + "-" + c for c in price_columns]
+        wide.append(df)
+    df = pd.concat(wide, axis=1)
+    df.index.name = "trade_date"
+
+    for col in account_columns:
+        df[col] = False if col == "rebalanced" else 0
+    for sec in securities:
+        for col in security_columns:
+            if col not in price_columns:
+                df[sec + "-" + col] = 0
+
+    columns = account_columns + [
+        sec + "-" + col for sec in securities for col in security_columns
+    ]
+    return df.reindex(columns=columns)
+
+
+def load_manifest(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def save_pickle(obj, path):
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        pickle.dump(obj, f)
+    os.replace(tmp, path)
+
+
+def update(data_dir="data", template=pp.filename, workers=None, full=False):
+    """
+    Parse the changed source files and refresh the price history and template.
+
+    :param data_dir: string, directory with etf_data and mutual_fund_data
+    :param template: string, account template pickle
+    :param workers: int, parser processes, defaults to the number of cpus
+    :param full: boolean, parse every file and rebuild the template
+    :return: list, names of the files parsed
+    """
+    source_list = sources(data_dir)
+    cache_dir = os.path.join(data_dir, "ingest_cache")
+    manifest_path = os.path.join(data_dir, "ingest_manifest.json")
+    manifest = {} if full else load_manifest(manifest_path)
+
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    # Find the files that changed since the last run.
+    hashes = {}
+    changed = []
+    for name, (_, path, security, _) in source_list.items():
+        hashes[name] = file_hash(path)
+        cache = os.path.join(cache_dir, security + ".pickle")
+        entry = manifest.get(name, {})
+        if entry.get("sha256") != hashes[name] or not os.path.exists(cache):
+            changed.append(name)
+
+    if not changed and os.path.exists(template):
+        return []
+
+    # Parse the changed files in parallel.
+    jobs = [(source_list[name][0], source_list[name][1]) for name in changed]
+    with ProcessPoolExecutor(max_workers=workers) as ex:
+        results = list(ex.map(parse, jobs))
+
+    parsed = {}
+    for name, df in zip(changed, results):
+        security = source_list[name][2]
+        save_pickle(df, os.path.join(cache_dir, security + ".pickle"))
+        manifest[name] = {"sha256": hashes[name], "security": security, "rows": len(df)}
+        parsed[name] = df
+
+    for name, (_, _, security, _) in source_list.items():
+        if name not in parsed:
+            with open(os.path.join(cache_dir, security + ".pickle"), "rb") as f:
+                parsed[name] = pickle.load(f)
+
+    rows = concat_sources(parsed, source_list)
+    etf = rows[rows["fund_type"] == "ETF"].drop(columns=["fund_type"])
+    save_pickle(etf, os.path.join(data_dir, "historical_etf.pickle"))
+    hist = build_history(rows)
+    save_pickle(hist, os.path.join(data_dir, "historical_prices.pickle"))
+
+    update_template(hist, template, full=full)
+
+    # Save the manifest last, an interrupted run parses the files again.
+    tmp = manifest_path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp, manifest_path)
+
+    return changed
+
+
+def update_template(hist, template=pp.filename, full=False):
+    """
+    Append new trading days to the account template.
+
+    Only the last check_rows days of the template and the days after it are
+    built from the history. The new days are appended if the prices of the days
+    checked did not change, otherwise the template is rebuilt. Changes to older
+    days need a full rebuild.
+
+    :param hist: dataframe, from build_history()
+    :param template: string, account template pickle
+    :param full: boolean, always rebuild the template
+    :return: dataframe, account template
+    """
+    store_dir = cs.store_path(template)
+
+    if full or not os.path.exists(template):
+        return save_template(template_frame(hist), template)
+
+    with open(template, "rb") as f:
+        df = pickle.load(f)
+
+    checked = df.index[-check_rows:]
+    built = template_frame(hist, start=checked[0])
+    old = built.loc[: df.index[-1]]
+    cols = [sec + "-" + c for sec in securities for c in price_columns]
+    if not (old.index.equals(checked) and old[cols].equals(df.loc[checked, cols])):
+        return save_template(template_frame(hist), template)
+
+    new = built.loc[df.index[-1] :].iloc[1:]
+    if new.empty:
+        return df
+    new = new.astype(df.dtypes.to_dict())
+
+    # Only a current store is appended to, the others are converted again.
+    current = cs.is_current(store_dir, template)
+    df = pd.concat([df, new], axis=0)
+    save_pickle(df, template)
+    if os.path.isdir(store_dir):
+        if not (current and cs.append(new, store_dir, template)):
+            cs.save(df, store_dir, source=template)
+    pp.set_panel(None)
+
+    return df
+
+
+def save_template(df, template):
+    """
+    Save a rebuilt account template and convert its column store again.
+
+    :param df: dataframe, account template
+    :param template: string, account template pickle
+    :return: dataframe
+    """
+    save_pickle(df, template)
+
+    # Refresh the column store and the panel of this process.
+    if os.path.isdir(cs.store_path(template)):
+        cs.save(df, cs.store_path(template), source=template)
+    pp.set_panel(None)
+
+    return df
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Parse the price spreadsheets and refresh the account template."
+    )
+    parser.add_argument("--data-dir", default="data", help="directory with the sheets")
+    parser.add_argument("--template", default=pp.filename, help="template pickle")
+    parser.add_argument("--workers", type=int, default=None, help="parser processes")
+    parser.add_argument(
+        "--full", action="store_true", help="parse every file and rebuild"
+    )
+    args = parser.parse_args()
+
+    names = update(args.data_dir, args.template, args.workers, args.full)
+    if names:
+        print("Parsed:", ", ".join(names))
+    else:
+        print("Up to date.")
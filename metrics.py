@@ -0,0 +1,287 @@
+# coding: utf-8
+
+"""
+Financial ratios of many return series at once.
+
+The ratios fin_funcs() and fin_funcs_port() used to take from Quantopian's
+empyrical library, one function and one pass per ratio and series, are computed
+here for every row of a returns matrix (series x days) in a few vectorized
+passes. The definitions are those of empyrical with daily periods:
+
+    annual_return, cagr     compounded annual growth rate
+    cumm_return             total return
+    sharpe                  mean / standard deviation, annualized
+    annual_volatility       standard deviation, annualized
+    max_drawdown            largest fall from a running peak
+    calmar                  annual return / max drawdown
+    sortino                 annualized mean / downside deviation
+    tail_ratio              95th percentile / 5th percentile
+
+Missing returns, such as the first pct_change of an account, are skipped but are
+counted in the number of days of a series as empyrical does. Series of different
+lengths are padded with NaN at the end, see returns_matrix(), and their lengths
+are passed in.
+"""
+
+import numpy as np
+
+
+# Trading days in a year.
+ann_factor = 252
+
+# Ratios returned by financials(), in order.
+names = [
+    "annual_return",
+    "cumm_return",
+    "cagr",
+    "sharpe",
+    "annual_volatility",
+    "max_drawdown",
+    "calmar",
+    "sortino",
+    "tail_ratio",
+]
+
+
+def returns_matrix(series):
+    """
+    Matrix of return series of different lengths, padded with NaN.
+
+    :param series: list of arrays or pd.Series
+    :return: tuple, (np.array series x days, np.array of lengths)
+    """
+    lengths = np.array([len(s) for s in series], dtype=int)
+    returns = np.full((len(series), lengths.max(initial=0)), np.nan)
+    for i, s in enumerate(series):
+        returns[i, : lengths[i]] = np.asarray(s, dtype=float)
+    return returns, lengths
+
+
+def financials(returns, lengths=None):
+    """
+    Financial ratios of every row of a returns matrix.
+
+    :param returns: np.array, series x days of daily returns, or one series
+    :param lengths: np.array, days of each series, defaults to the width of the
+    matrix
+    :return: dictionary, ratio name: np.array with one value per series
+    """
+    r = np.asarray(returns, dtype=float)
+    if r.ndim == 1:
+        r = r[np.newaxis, :]
+    rows, width = r.shape
+    n = np.full(rows, width) if lengths is None else np.asarray(lengths)
+
+    valid = ~np.isnan(r)
+    count = valid.sum(axis=1)
+    r0 = np.where(valid, r, 0.0)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # Growth of one dollar, a missing return leaves it unchanged.
+        growth = np.ones((rows, width + 1))
+        np.cumprod(1 + r0, axis=1, out=growth[:, 1:])
+        total = growth[:, -1]
+
+        cumm_return = total - 1
+        # Scalar powers as empyrical, numpy's vectorized power can differ from
+        # them in the last bit depending on the memory layout of its input.
+        exponent = ann_factor / n.astype(float)
+        annual_return = np.array([t**e for t, e in zip(total, exponent)]) - 1
+
+        # Moments over the returns that are not missing.
+        mean = r0.sum(axis=1) / count
+        dev = np.where(valid, r - mean[:, np.newaxis], 0.0)
+        std = np.sqrt((dev * dev).sum(axis=1) / (count - 1))
+        sharpe = mean / std * np.sqrt(ann_factor)
+        annual_volatility = std * np.sqrt(ann_factor)
+
+        downside = np.minimum(r0, 0.0)
+        downside_risk = np.sqrt((downside * downside).sum(axis=1) / count)
+        sortino = mean * ann_factor / (downside_risk * np.sqrt(ann_factor))
+
+        peak = np.fmax.accumulate(growth, axis=1)
+        max_drawdown = ((growth - peak) / peak).min(axis=1)
+
+        calmar = annual_return / np.abs(max_drawdown)
+        calmar[~(max_drawdown < 0) | np.isinf(calmar)] = np.nan
+
+        tail_ratio = np.full(rows, np.nan)
+        some = count > 0
+        if some.any():
+            p95, p5 = np.nanpercentile(r[some], [95, 5], axis=1)
+            tail_ratio[some] = np.abs(p95) / np.abs(p5)
+
+    # Ratios of too short series are not defined.
+    for x in (annual_return, cumm_return, max_drawdown, calmar):
+        x[n < 1] = np.nan
+    for x in (sharpe, annual_volatility, sortino):
+        x[n < 2] = np.nan
+
+    return {
+        "annual_return": annual_return,
+        "cumm_return": cumm_return,
+        "cagr": annual_return.copy(),
+        "sharpe": sharpe,
+        "annual_volatility": annual_volatility,
+        "max_drawdown": max_drawdown,
+        "calmar": calmar,
+        "sortino": sortino,
+        "tail_ratio": tail_ratio,
+    }
+
+
+def percentile(low, high, count, q):
+    """
+    Percentile of a series from its smallest and largest values, as np.percentile.
+
+    :param low: np.array, smallest values, sorted
+    :param high: np.array, largest values, sorted
+    :param count: int, values in the series
+    :param q: float, percentile
+    :return: float
+    """
+    h = (count - 1) * (q / 100)
+    lo = int(np.floor(h))
+    t = h - lo
+    hi = min(lo + 1, count - 1)
+
+    def value(i):
+        # Position i of the sorted series, from whichever end holds it.
+        if i < len(low):
+            return low[i]
+        return high[i - (count - len(high))]
+
+    a, b = value(lo), value(hi)
+    if t >= 0.5:
+        return b - (b - a) * (1 - t)
+    return a + (b - a) * t
+
+
+class OnlineMetrics(object):
+    """
+    Financial ratios of an account updated as its values become final.
+
+    The engines pass the value_after_tax of every day once it will not change
+    again, in order and in chunks of any size. Running sums, the running peak and
+    the drawdown are kept instead of the daily returns. For the tail ratio only
+    the smallest and largest 5% of the returns are kept, which needs the number
+    of days up front. The engines call start() with the days of the account.
+
+        online = metrics.OnlineMetrics()
+        ra.rebalance_account(a, online=online)
+        online.result()
+
+    :param days: int, days in the account, or None to start later
+    """
+
+    def __init__(self, days=None):
+        if days is not None:
+            self.start(days)
+
+    def start(self, days):
+        """
+        Clear the ratios for an account of a number of days.
+
+        :param days: int
+        """
+        self.days = days
+        self.k = int(0.05 * max(days - 1, 0)) + 2
+        self.n = 0
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.down2 = 0.0
+        self.growth = 1.0
+        self.peak = 1.0
+        self.max_drawdown = 0.0
+        self.last = None
+        self.low = np.array([])
+        self.high = np.array([])
+
+    def update(self, values):
+        """
+        Add the values after tax of the next days.
+
+        :param values: array, value_after_tax in date order
+        """
+        values = np.asarray(values, dtype=float)
+        if values.size == 0:
+            return
+        if self.n + values.size > self.days:
+            raise ValueError("More days than the OnlineMetrics was created for.")
+
+        # Daily returns as pct_change, the first day has none.
+        if self.last is None:
+            r = values[1:] / values[:-1] - 1
+        else:
+            r = values / np.append(self.last, values[:-1]) - 1
+        self.n += values.size
+        self.last = values[-1]
+
+        r = r[~np.isnan(r)]
+        if r.size == 0:
+            return
+
+        # Mean and sum of squared deviations, merged with the previous chunks.
+        count = self.count + r.size
+        mean = r.mean()
+        m2 = ((r - mean) ** 2).sum()
+        delta = mean - self.mean
+        self.m2 += m2 + delta * delta * self.count * r.size / count
+        self.mean += delta * r.size / count
+        self.count = count
+
+        down = np.minimum(r, 0.0)
+        self.down2 += (down * down).sum()
+
+        growth = self.growth * np.cumprod(1 + r)
+        peak = np.fmax.accumulate(np.append(self.peak, growth))[1:]
+        self.max_drawdown = min(self.max_drawdown, ((growth - peak) / peak).min())
+        self.growth = growth[-1]
+        self.peak = peak[-1]
+
+        self.low = np.sort(np.append(self.low, r))[: self.k]
+        self.high = np.sort(np.append(self.high, r))[-self.k :]
+
+    def result(self):
+        """
+        Financial ratios of the days added so far, as financials() for one series.
+
+        :return: dictionary, ratio name: float
+        """
+        n = self.n
+        nan = np.nan
+        with np.errstate(divide="ignore", invalid="ignore"):
+            total = np.float64(self.growth)
+            annual_return = total ** (ann_factor / float(n)) - 1 if n >= 1 else nan
+            std = np.sqrt(self.m2 / (self.count - 1)) if self.count > 1 else nan
+            mean = self.mean if self.count else nan
+            downside_risk = np.sqrt(self.down2 / self.count) if self.count else nan
+            max_drawdown = self.max_drawdown if n >= 1 else nan
+            calmar = annual_return / abs(max_drawdown)
+            if not max_drawdown < 0 or np.isinf(calmar):
+                calmar = nan
+
+            if self.count:
+                p95 = percentile(self.low, self.high, self.count, 95)
+                p5 = percentile(self.low, self.high, self.count, 5)
+                tail_ratio = np.abs(p95) / np.abs(p5)
+            else:
+                tail_ratio = nan
+
+            short = n < 2
+            return {
+                "annual_return": annual_return,
+                "cumm_return": total - 1 if n >= 1 else nan,
+                "cagr": annual_return,
+                "sharpe": nan if short else mean / std * np.sqrt(ann_factor),
+                "annual_volatility": nan if short else std * np.sqrt(ann_factor),
+                "max_drawdown": max_drawdown,
+                "calmar": calmar,
+                "sortino": (
+                    nan
+                    if short
+                    else mean * ann_factor / (downside_risk * np.sqrt(ann_factor))
+                ),
+                "tail_ratio": tail_ratio,
+            }
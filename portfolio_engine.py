@@ -0,0 +1,202 @@
+# coding: utf-8
+
+"""
+Household engine, all the accounts of a portfolio in the same arrays.
+
+rebalance_portfolio.rebalance_portfolio() keeps a DataFrame per account, adds up
+their asset totals frame by frame and propagates every account on its own after
+each rebalance of the household. Here every account column is an array of
+accounts x days, as the lanes of batch_engine.py, the state of the household is
+accounts x days x columns. The accounts that propagate the same way, with the
+same drip, mutual funds and tax rates, are propagated together by
+batch_engine.propagate_lanes(), and the asset totals and allocation of the
+household are sums over the accounts, updated from the rebalancing date. The
+account DataFrames are only built to finalize the portfolio, the results are
+those of rebalance_portfolio().
+
+    returns, asset_allocation = portfolio_engine.rebalance_portfolio(
+        port_allocation, accounts, start_date, end_date
+    )
+"""
+
+from collections import OrderedDict
+import numpy as np
+import batch_engine as be
+import rebalance_portfolio as rp
+import refunc as rf
+
+
+# Targets of the portfolio, in the order of the asset totals of the household, see
+# rebalance_portfolio.total_columns.
+target_fields = ["atar_cash", "atar_fixed_income", "atar_equity"]
+
+
+def propagate_key(a):
+    """
+    Parameters of an account read by its propagation.
+
+    The allocation targets are read from every account, see
+    batch_engine.propagate_lanes().
+
+    :param a: dictionary, account parameters
+    :return: tuple, accounts with the same key are propagated together
+    """
+    key = (a["drip"], a["mutual_funds"] and not a["drip"], a["taxable_transactions"])
+    if a["taxable_transactions"]:
+        key += (a["tax_rate"], a["tax_div"])
+    return key
+
+
+def household(state, totals, start=0):
+    """
+    Add up the asset totals of the accounts for the household from a day on.
+
+    :param state: dictionary, column: np.array accounts x days
+    :param totals: np.array days x asset classes, see
+    rebalance_portfolio.total_columns, modified in place
+    :param start: int, first day that changed
+    :return: None
+    """
+    for k, col in enumerate(rp.total_columns):
+        totals[start:, k] = state[col][:, start:].sum(axis=0)
+
+
+def rebalance_portfolio(
+    port_allocation, accounts, start_date, end_date, online=None, compare=False
+):
+    """
+    Rebalance the accounts of a household together, see
+    rebalance_portfolio.rebalance_portfolio().
+
+    :param port_allocation: dictionary, portfolio allocation parameters
+    :param accounts: list of dictionaries, accounts in order of importance for
+    equity investing, with the initial deposit on the start date
+    :param start_date: string
+    :param end_date: string
+    :param online: OnlineMetrics, optional, see
+    rebalance_portfolio.rebalance_portfolio(), the account DataFrames are then
+    not built
+    :param compare: boolean, see rebalance_portfolio.rebalance_portfolio()
+    :returns: two dataframes, see rebalance_portfolio.rebalance_portfolio(), or
+    None with online
+    """
+    for a in accounts:
+        a["start_date"] = start_date
+        a["end_date"] = end_date
+
+    # Dollars invested in each account by asset class, the initial cash first.
+    invested = np.zeros((len(accounts), 3))
+    for i, a in enumerate(accounts):
+        invested[i, 0] = a["dep_with"][start_date]
+    total_invested = invested.sum(axis=0).sum()
+
+    state = None
+    re = 0
+    while True:
+        # Allocate the target dollars of the household to the accounts.
+        target = tuple(total_invested * port_allocation[f] for f in target_fields)
+        new, _ = rf.allocate_household(invested, target)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            allocation = new / new.sum(axis=1)[:, np.newaxis]
+        for a, (cash_all, fi_all, eq_all) in zip(accounts, allocation):
+            rf.retarget(cash_all, fi_all, eq_all, a)
+
+        if state is None:
+            # Initial set up of every account, the days are those of the household.
+            frames = [rf.initialize(a, rf.new_df(a)) for a in accounts]
+            df = frames[0]
+            period = rf.period_positions(port_allocation, df, start_date)
+
+            prices = {c: df[c].values.astype(float) for c in rf.window_columns}
+            dep_with = np.array([f["dep_with"].values for f in frames], dtype=float)
+            nav = [prices[sec + "-nav_per_share"] for sec in be.securities]
+            etf = [(df[sec + "-fund_type"] == "ETF").tolist() for sec in be.securities]
+            state = {
+                c: np.array([f[c].values for f in frames], dtype=float)
+                for c in be.state_columns
+            }
+            totals = np.zeros((df.shape[0], len(rp.total_columns)))
+
+            # Rows before fed have been passed to the online metrics.
+            fed = 0
+            realized = [0.0] * len(accounts)
+            if online is not None:
+                online.start(df.shape[0])
+
+            groups = OrderedDict()
+            for k, a in enumerate(accounts):
+                groups.setdefault(propagate_key(a), []).append(k)
+            groups = [np.array(lanes) for lanes in groups.values()]
+            factors = [
+                (
+                    rf.drip_factors(accounts[lanes[0]], df)
+                    if accounts[lanes[0]]["drip"]
+                    else None
+                )
+                for lanes in groups
+            ]
+            taxable = any(a["taxable_transactions"] for a in accounts)
+            events = rf.dividend_events(df) if taxable else None
+
+            # The account DataFrames are only kept to be finalized.
+            if online is not None:
+                frames = None
+
+        for k, a in enumerate(accounts):
+            r = be.read(state, nav, etf, k, re)
+            be.write(state, k, re, rf.rebalance_row(r, a))
+
+        for lanes, group_factors in zip(groups, factors):
+            params = {
+                f: np.array([accounts[k][f] for k in lanes], dtype=float)[:, np.newaxis]
+                for f in be.lane_fields
+            }
+            be.propagate_lanes(
+                state,
+                lanes,
+                np.full(lanes.size, re),
+                accounts[lanes[0]],
+                params,
+                dict(prices, dep_with=dep_with[lanes]),
+                group_factors,
+                events,
+            )
+
+        # The first period date the household is outside its limits, only the days
+        # from the rebalancing date have changed.
+        household(state, totals, re)
+        dates = period[period >= re]
+        dft = rp.household_allocation(totals, dates)
+        breached = dates[rp.breach_mask(dft, port_allocation)]
+
+        # The rows before the next rebalancing date are final.
+        if online is not None:
+            stop = breached[0] if breached.size else df.shape[0]
+            navs = {c: prices[c] for c in rf.final_columns if c in prices}
+            columns = [
+                dict(navs, **{c: state[c][k] for c in rf.final_columns if c in state})
+                for k in range(len(accounts))
+            ]
+            online.update(rp.household_values(accounts, columns, fed, stop, realized))
+            fed = stop
+
+        if not breached.size:
+            break
+
+        re = breached[0]
+        total_invested = totals[re].sum()
+        invested = np.stack([state[c][:, re] for c in rp.total_columns], axis=1)
+
+    if online is not None:
+        return None
+
+    for k, a in enumerate(accounts):
+        out = frames[k]
+        for c in be.state_columns:
+            if c == "rebalanced":
+                out[c] = state[c][k].astype(bool)
+            else:
+                out[c] = state[c][k]
+        a["df"] = out
+
+    return rp.finalize_portfolio(port_allocation, accounts, compare)
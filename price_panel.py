@@ -0,0 +1,380 @@
+# coding: utf-8
+
+"""
+Process wide, read only price panel.
+
+The account template (prices, dividends and the empty account columns) is loaded
+once per process and date range slices are cached. refunc.new_df takes copies of
+the cached slices instead of unpickling accounts_template.pickle on every call.
+
+If a current column store of the template exists (see column_store.py) it is
+memory mapped instead of unpickling the template, and only the rows of the
+requested date ranges are read.
+
+Worker processes can be handed the panel through shared memory:
+
+    handle = price_panel.get_panel().share()
+    with ProcessPoolExecutor(initializer=price_panel.attach, initargs=(handle,)) as ex:
+        ...
+"""
+
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import pickle
+import threading
+import column_store as cs
+import numpy as np
+import pandas as pd
+import trade_calendar as tc
+
+
+# Raw price data has been munged and is in a pickle file ready for use.
+filename = "accounts_template.pickle"
+
+# Column store converted from the pickle file, used when it is current.
+store = cs.store_path(filename)
+
+# Number of date range slices kept in the cache.
+cache_size = 64
+
+# The panel for this process, see get_panel().
+_panel = None
+
+
+class PricePanel(object):
+    """
+    Read only account template with cached date range slices.
+
+    :param df: dataframe, account template indexed by trade date
+    :param store: ColumnStore, memory mapped account template used instead of df
+    """
+
+    def __init__(self, df=None, store=None):
+        if df is None and store is None:
+            raise ValueError("A price panel needs either a dataframe or a store.")
+        self._df = df
+        self.store = store
+        self.index = df.index if df is not None else store.index
+        self._slices = OrderedDict()
+        self._shm = None
+        self._calendar = None
+        self._valid = None
+        self._version = None
+        self._drip = OrderedDict()
+        self._events = None
+        # The caches are shared by the threads of an executor, see
+        # rebalance_portfolio().
+        self._lock = threading.Lock()
+
+    @property
+    def df(self):
+        """
+        The full account template, read out of the store on first use.
+        """
+        if self._df is None:
+            self._df = self.store.frame()
+        return self._df
+
+    def _rows(self, start, stop):
+        if self._df is None:
+            return self.store.frame(start, stop)
+        return self._df.iloc[start:stop]
+
+    def valid_rows(self):
+        """
+        Mask of the rows with no missing value, the rows kept by dropna().
+
+        A store is read one column at a time, the template is not loaded.
+
+        :return: np.array of booleans
+        """
+        if self._valid is None:
+            if self.store is None:
+                valid = np.asarray(self.df.notnull().all(axis=1))
+            else:
+                valid = np.ones(len(self.index), dtype=bool)
+                for col in self.store.columns:
+                    valid &= np.asarray(pd.notnull(self.store.column(col)))
+            self._valid = valid
+        return self._valid
+
+    def _valid_column(self, col):
+        if self.store is None:
+            values = self.df[col].values
+        else:
+            values = self.store.column(col)
+        return np.asarray(values)[self.valid_rows()]
+
+    def first_trade_date(self, date):
+        """
+        First trade date on or after date.
+
+        :param date: string or timestamp
+        :return: timestamp
+        """
+        return self.index[self.index >= date][0]
+
+    def calendar(self):
+        """
+        Period end calendar of the trading days with prices, built on first use.
+
+        :return: TradeCalendar
+        """
+        if self._calendar is None:
+            self._calendar = tc.TradeCalendar(self.index[self.valid_rows()])
+        return self._calendar
+
+    def drip_factors(self, sec, rate):
+        """
+        Drip units bought per unit held of a security, over the trading days with
+        prices, built on first use for every security and tax rate.
+
+        The drip reinvests the dividends of the units held on the last rebalancing
+        date, so the units it buys on a day per unit held only depend on the prices
+        and the tax rate. The units held from day s are u0 * (1 + (f[i] - f[s])).
+
+        :param sec: string, security symbol
+        :param rate: float, tax rate on the dividends of the security
+        :return: tuple, (np.array, units bought per unit held on each day,
+        np.array, f, their cumulative sum)
+        """
+        key = (sec, rate)
+        with self._lock:
+            try:
+                factors = self._drip.pop(key)
+            except KeyError:
+                div = self._valid_column(sec + "-dividends").astype(float)
+                nav = self._valid_column(sec + "-nav_per_share").astype(float)
+                units = (div * (1 - rate)) / nav
+                factors = (units, np.cumsum(units))
+                if len(self._drip) >= cache_size:
+                    self._drip.popitem(last=False)
+            self._drip[key] = factors
+        return factors
+
+    def dividend_events(self):
+        """
+        Distribution dates of every security over the trading days with prices,
+        built on first use.
+
+        Dividends are paid on a few days a year, the drip and the dividend
+        accounting of an account only change on these days.
+
+        :return: dictionary, security: tuple, (np.array, positions of the days with
+        a dividend, np.array, the dividend per unit on those days)
+        """
+        if self._events is None:
+            columns = self.store.columns if self.store is not None else self.df.columns
+            events = {}
+            for col in columns:
+                if col.endswith("-dividends"):
+                    div = self._valid_column(col).astype(float)
+                    rows = np.flatnonzero(div)
+                    events[col[: -len("-dividends")]] = (rows, div[rows])
+            self._events = events
+        return self._events
+
+    def version(self):
+        """
+        Digest of the prices in the panel, changes whenever the data changes.
+
+        A store is identified by its meta.json, with the signature of the pickle it
+        was saved from, or by the contents of its files if it has no source.
+
+        :return: string, hex digest
+        """
+        if self._version is None and self.store is not None:
+            h = hashlib.sha256()
+            meta = self.store.meta
+            h.update(json.dumps(meta, sort_keys=True).encode())
+            if meta.get("source_signature") is None:
+                files = ["index.npy"] + [c["file"] for c in meta["columns"]]
+                for filename in files:
+                    with open(os.path.join(self.store.path, filename), "rb") as f:
+                        for chunk in iter(lambda: f.read(1 << 20), b""):
+                            h.update(chunk)
+            self._version = h.hexdigest()
+        elif self._version is None:
+            h = hashlib.sha256()
+            h.update(np.asarray(self.index.asi8).tobytes())
+            h.update(repr(list(self.df.columns)).encode())
+            h.update(pd.util.hash_pandas_object(self.df, index=False).values.tobytes())
+            self._version = h.hexdigest()
+        return self._version
+
+    def view(self, start_date, end_date):
+        """
+        Rows between the start and end dates with missing prices dropped.
+
+        The dataframe is shared by every caller and must not be modified, use
+        frame() to get a copy.
+
+        :param start_date: timestamp, must be a trade date
+        :param end_date: string or timestamp
+        :return: dataframe
+        """
+        key = (start_date, end_date)
+        with self._lock:
+            try:
+                df = self._slices.pop(key)
+            except KeyError:
+                sl = self.index.slice_indexer(start_date, end_date)
+                df = self._rows(sl.start, sl.stop).dropna()
+                if len(self._slices) >= cache_size:
+                    self._slices.popitem(last=False)
+            self._slices[key] = df
+        return df
+
+    def frame(self, start_date, end_date):
+        """
+        Copy of view() that the caller owns.
+
+        :param start_date: timestamp, must be a trade date
+        :param end_date: string or timestamp
+        :return: dataframe
+        """
+        return self.view(start_date, end_date).copy()
+
+    def share(self):
+        """
+        Copy the panel into shared memory for worker processes.
+
+        A panel read from a column store is already shared through the page cache,
+        the workers map the same store.
+
+        :return: tuple, handle to pass to attach() in the worker
+        """
+        from multiprocessing import shared_memory
+
+        if self.store is not None:
+            return ("store", self.store.path)
+
+        if self._shm is not None:
+            return self._handle
+
+        # Every column is stored as a flat array in one block of shared memory.
+        # Categorical columns are stored as their codes.
+        layout = []
+        arrays = []
+        offset = 0
+        for col in self.df.columns:
+            s = self.df[col]
+            if s.dtype.name == "category":
+                values = np.asarray(s.cat.codes)
+                categories = list(s.cat.categories)
+            else:
+                values = np.asarray(s)
+                categories = None
+            layout.append((col, values.dtype.str, offset, categories))
+            arrays.append((offset, values))
+            offset += values.nbytes
+
+        index = np.asarray(self.index.asi8)
+        index_offset = offset
+        arrays.append((index_offset, index))
+        offset += index.nbytes
+
+        self._shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+        for start, values in arrays:
+            buf = np.ndarray(
+                values.shape, dtype=values.dtype, buffer=self._shm.buf[start:]
+            )
+            buf[:] = values
+        del buf
+
+        self._handle = (
+            "shm",
+            self._shm.name,
+            len(self.index),
+            self.index.name,
+            index_offset,
+            layout,
+        )
+        return self._handle
+
+    def release(self):
+        """
+        Free the shared memory created by share().
+        """
+        if self._shm is not None:
+            self._shm.close()
+            self._shm.unlink()
+            self._shm = None
+
+
+def load(path=None, store_dir=None):
+    """
+    Load the account template, from the column store if it is current and
+    otherwise from the pickle file.
+
+    :param path: string, defaults to accounts_template.pickle
+    :param store_dir: string, defaults to the store converted from path
+    :return: PricePanel
+    """
+    path = path or filename
+    store_dir = store_dir or (store if path == filename else cs.store_path(path))
+
+    if cs.is_current(store_dir, path):
+        return PricePanel(store=cs.load(store_dir))
+
+    with open(path, "rb") as infile:
+        df = pickle.load(infile)
+    return PricePanel(df)
+
+
+def get_panel():
+    """
+    The price panel of this process, loaded on first use.
+
+    :return: PricePanel
+    """
+    global _panel
+    if _panel is None:
+        _panel = load()
+    return _panel
+
+
+def set_panel(panel):
+    """
+    Replace the price panel of this process, e.g. after refreshing the data.
+
+    :param panel: PricePanel or None to reload on next use
+    """
+    global _panel
+    _panel = panel
+
+
+def attach(handle):
+    """
+    Set the price panel of this process from a handle created by PricePanel.share().
+
+    Use as the initializer of a process pool.
+
+    :param handle: tuple
+    """
+    from multiprocessing import shared_memory
+
+    if handle[0] == "store":
+        set_panel(PricePanel(store=cs.load(handle[1])))
+        return
+
+    _, name, n, index_name, index_offset, layout = handle
+
+    # Pool workers share the resource tracker of the parent, which owns the block.
+    shm = shared_memory.SharedMemory(name=name)
+
+    try:
+        data = OrderedDict()
+        for col, dtype, offset, categories in layout:
+            values = np.ndarray((n,), dtype=dtype, buffer=shm.buf[offset:]).copy()
+            if categories is not None:
+                values = pd.Categorical.from_codes(values, categories)
+            data[col] = values
+        index = np.ndarray((n,), dtype="i8", buffer=shm.buf[index_offset:]).copy()
+    finally:
+        shm.close()
+
+    df = pd.DataFrame(data, index=pd.DatetimeIndex(index, name=index_name))
+    set_panel(PricePanel(df))
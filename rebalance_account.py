@@ -1,17 +1,32 @@
 # coding: utf-8
 
 import account_templates as at
+import event_engine as ee
 import numpy as np
 import pandas as pd
 import refunc as rf
+import row_state as rs
 
 
 # Securities, list of typically two etfs and two mutual funds. Representing equity
 # and fixed income. Do not vary these for now.
 securities = rf.securities
 
+# Minimum number of rows propagated after a rebalance before looking for the next
+# rebalancing date, see rebalance_account().
+window = 64
+
+# Columns tested for rebalancing, see breach_mask().
+breach_columns = [
+    "cash_allocation",
+    "fixed_income_allocation",
+    "equity_allocation",
+    "total_value",
+]
+
+
 # todo: return optinon check it out
-def rebalance_account(a):
+def rebalance_account(a, engine="loop", online=None):
     """
     Initializes accounts and calls rebalancing methods.
 
@@ -113,10 +128,23 @@ def rebalance_account(a):
     "rmin_equity": 0.5,
     }
 
+    :param engine: string, "loop" propagates the account from every rebalance to the
+    next one, "event" walks the trading days once, see event_engine.py. Both return
+    the same DataFrame.
+
+    :param online: OnlineMetrics, optional, fed the value after tax of every day
+    once it is final, see metrics.py. The account is then not finalized and no
+    returns are computed.
+
     :return:
-    df: dataframe
+    df: dataframe, or None with online
 
     """
+    if engine == "event":
+        return ee.rebalance_account(a, online)
+    elif engine != "loop":
+        raise ValueError("The engine must be either 'loop' or 'event'.")
+
     # todo: check if I should delete this? Is it just one test causing problems?
     # Check the input variables.
     # rf.check_var(a)
@@ -129,66 +157,68 @@ def rebalance_account(a):
     # Set the first day of the period.
     re_date = a["start_date"]
 
-    dfp = rf.trade_period_index(a, df, re_date)
+    # Positions of the rebalancing period dates.
+    period = rf.period_positions(a, df, re_date)
+    last = df.shape[0] - 1
 
-    while re_date <= pd.to_datetime(a["end_date"]):
+    # Drip factors and distribution dates of the account, shared by its windows.
+    factors = rf.drip_factors(a, df) if a["drip"] else None
+    events = rf.dividend_events(df) if a["taxable_transactions"] else None
 
-        # Set the row of the df to a pd.Series and call to function rebalance_row,
-        # that will return a rebalanced account on that day.
-        r = df.loc[re_date, :].to_dict()
-
-        # Then reset the df row to the adjusted rebalanced pd.Series.
-        df.loc[re_date, :] = pd.Series(rf.rebalance_row(r, a))
-
-        # Propagate all values down from last rebalance date.
-        df.loc[re_date:, :] = rf.propagate(re_date, df, a)
+    # Rows before fed have been passed to the online metrics.
+    fed = 0
+    realized = 0.0
+    if online is not None:
+        online.start(df.shape[0])
 
-        # Create a DataFrame for setting time periods for trading such as monthly, quarterly etc.
-        # This will be used to filter below and determine if there is a valid rebalancing date.
-
-        dft = df.filter(items=dfp.index, axis=0)
+    while re_date <= pd.to_datetime(a["end_date"]):
 
-        # Create masks to filter for first row to be rebalanced.
-        # Test for maximum levels.
-        mask1 = (dft["cash_allocation"] > a["amax_cash"]) & (
-            ((dft["cash_allocation"] - a["rmax_cash"]) * dft["total_value"])
-            > a["minimum_trade_dollar"]
-        )
-        mask2 = (dft["fixed_income_allocation"] > a["amax_fixed_income"]) & (
-            (
-                (dft["fixed_income_allocation"] - a["rmax_fixed_income"])
-                * dft["total_value"]
-            )
-            > a["minimum_trade_dollar"]
-        )
-        mask3 = (dft["equity_allocation"] > a["amax_equity"]) & (
-            ((dft["equity_allocation"] - a["rmax_equity"]) * dft["total_value"])
-            > a["minimum_trade_dollar"]
-        )
-        # Test for minimum levels.
-        mask4 = (dft["cash_allocation"] < a["amin_cash"]) & (
-            ((dft["cash_allocation"] - a["rmin_cash"]) * dft["total_value"])
-            < -a["minimum_trade_dollar"]
-        )
-        mask5 = (dft["fixed_income_allocation"] < a["amin_fixed_income"]) & (
-            (
-                (dft["fixed_income_allocation"] - a["rmin_fixed_income"])
-                * dft["total_value"]
-            )
-            < -a["minimum_trade_dollar"]
-        )
-        mask6 = (dft["equity_allocation"] < a["amin_equity"]) & (
-            ((dft["equity_allocation"] - a["rmin_equity"]) * dft["total_value"])
-            < -a["minimum_trade_dollar"]
-        )
-        # if a["mutual_funds"]:
-        #     mask7 = dft["cash"] > a["minimum_trade_dollar"]
-        # else:
-        #     dft["false"] = False
-        #     mask7 = dft["false"]
+        # Read the row of the df into a RowState and call to function rebalance_row,
+        # that will return a rebalanced account on that day.
+        r = rs.read(df, re_date)
+
+        # Then write the rebalanced row back to the df.
+        rs.write(df, re_date, rf.rebalance_row(r, a))
+
+        # Propagate values down from last rebalance date, only as far as needed to
+        # find the next rebalancing date. The window starts at the next period
+        # dates and doubles until a period date breaches or the end is reached.
+        start = df.index.get_loc(re_date)
+        upcoming = period[period >= start]
+        stop = min(last, max(start + window, upcoming[0] if upcoming.size else last))
+
+        while True:
+            _, w = rf.propagate_window(re_date, df, a, df.index[stop], factors, events)
+
+            # Period dates in the window, used to determine if there is a valid
+            # rebalancing date.
+            dates = upcoming[upcoming <= stop]
+            dft = {col: w[col][dates - start] for col in breach_columns}
+            breached = dates[breach_mask(dft, a)]
+
+            if breached.size or stop == last:
+                break
+            stop = min(last, start + 2 * (stop - start + 1))
+
+        # Write the window up to the next rebalancing date, the rows after it are
+        # propagated again from there.
+        rows = breached[0] - start + 1 if breached.size else None
+        rf.write_window(df, start, w, rows)
+        if a["drip"] and rows is not None:
+            rf.drip_tail(a, df, re_date, df.index[start + rows - 1], factors)
+
+        # The rows before the next rebalancing date are final.
+        if online is not None:
+            stop = breached[0] if breached.size else last + 1
+            w = {col: df[col].values[fed:stop] for col in rf.final_columns}
+            values, realized = rf.final_values(a, w, realized)
+            online.update(values)
+            fed = stop
 
         # Finalize account if there masks conditions not met.
-        if dft[mask1 | mask2 | mask3 | mask4 | mask5 | mask6].empty:
+        if not breached.size and online is not None:
+            return None
+        elif not breached.size:
             df = rf.finalize(a, df)
             df["pct_change"] = df.value_after_tax.pct_change()
             df["log_ret"] = np.log(df.value_after_tax) - np.log(
@@ -198,7 +228,74 @@ def rebalance_account(a):
 
         else:
             # Get the date for the next rebalancing.
-            re_date = dft[mask1 | mask2 | mask3 | mask4 | mask5 | mask6].iloc[0].name
+            re_date = df.index[breached[0]]
+
+
+def rebalance_brackets(a, brackets, engine="loop"):
+    """
+    Account DataFrames of several tax brackets.
+
+    rsp and tfsa accounts trade the same in every bracket, they are simulated
+    once with the first bracket and the tax columns of the others are computed
+    from that run, see refunc.finalize_brackets(). Taxable accounts are simulated
+    once per bracket.
+
+    :param a: dictionary, account parameters
+    :param brackets: list of dictionaries, tax rates of each bracket, e.g.
+    {"tax_rate": 0.4641, "tax_div": 0.3175, "tax_gains": 0.2320}
+    :param engine: string, see rebalance_account()
+    :return: list of dataframes, one per bracket
+    """
+    if rf.bracket_fields_of(a):
+        first = dict(a, **brackets[0])
+        return rf.finalize_brackets(first, rebalance_account(first, engine), brackets)
+
+    return [rebalance_account(dict(a, **b), engine) for b in brackets]
+
+
+def breach_mask(dft, a):
+    """
+    Rows of the account outside the allocation limits.
+
+    :param dft: dataframe or dictionary of arrays, account rows on rebalancing
+    period dates
+    :param a: dictionary, account parameters
+    :return: boolean mask
+    """
+    # Create masks to filter for first row to be rebalanced.
+    # Test for maximum levels.
+    mask1 = (dft["cash_allocation"] > a["amax_cash"]) & (
+        ((dft["cash_allocation"] - a["rmax_cash"]) * dft["total_value"])
+        > a["minimum_trade_dollar"]
+    )
+    mask2 = (dft["fixed_income_allocation"] > a["amax_fixed_income"]) & (
+        ((dft["fixed_income_allocation"] - a["rmax_fixed_income"]) * dft["total_value"])
+        > a["minimum_trade_dollar"]
+    )
+    mask3 = (dft["equity_allocation"] > a["amax_equity"]) & (
+        ((dft["equity_allocation"] - a["rmax_equity"]) * dft["total_value"])
+        > a["minimum_trade_dollar"]
+    )
+    # Test for minimum levels.
+    mask4 = (dft["cash_allocation"] < a["amin_cash"]) & (
+        ((dft["cash_allocation"] - a["rmin_cash"]) * dft["total_value"])
+        < -a["minimum_trade_dollar"]
+    )
+    mask5 = (dft["fixed_income_allocation"] < a["amin_fixed_income"]) & (
+        ((dft["fixed_income_allocation"] - a["rmin_fixed_income"]) * dft["total_value"])
+        < -a["minimum_trade_dollar"]
+    )
+    mask6 = (dft["equity_allocation"] < a["amin_equity"]) & (
+        ((dft["equity_allocation"] - a["rmin_equity"]) * dft["total_value"])
+        < -a["minimum_trade_dollar"]
+    )
+    # if a["mutual_funds"]:
+    #     mask7 = dft["cash"] > a["minimum_trade_dollar"]
+    # else:
+    #     dft["false"] = False
+    #     mask7 = dft["false"]
+
+    return mask1 | mask2 | mask3 | mask4 | mask5 | mask6
 
 
 if __name__ == "__main__":
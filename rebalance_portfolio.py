@@ -1,22 +1,56 @@
 import account_templates as at
+import numpy as np
 import pandas as pd
-import rebalance_account as ra
+import price_panel as pp
 import refunc as rf
-
-
-def rebalance_portfolio(port_allocation, accounts, start_date, end_date):
+import row_state as rs
+import sim_cache as sc
+
+
+# Parameters of the portfolio given to the accounts rebalanced on their own, see
+# compare_accounts().
+compare_fields = ["rebalance_period"] + [
+    prefix + "_" + asset
+    for prefix in ["atar", "amax", "amin", "rmax", "rmin"]
+    for asset in ["cash", "fixed_income", "equity"]
+]
+
+# Asset totals of the accounts, added up for the household in the order of the
+# columns of refunc.allocate_household().
+total_columns = ["cash_total", "fixed_income_total", "equity_total"]
+
+# Allocation of the household, named as the columns of the accounts.
+allocation_columns = ["cash_allocation", "fixed_income_allocation", "equity_allocation"]
+
+
+def rebalance_portfolio(
+    port_allocation,
+    accounts,
+    start_date,
+    end_date,
+    online=None,
+    compare=False,
+    executor=None,
+):
     """
     Creates and manages multiple investment accounts with combined results.
 
     :param accounts: Accounts dictionary and deposits to be set.
+    :param online: OnlineMetrics, optional, fed the value after tax of the
+    portfolio as its days become final, see metrics.py. The accounts are then not
+    finalized and None is returned.
+    :param compare: boolean, also rebalance every account on its own to the
+    portfolio allocation, see compare_accounts(), not used with online.
+    :param executor: concurrent.futures.Executor, optional, starts or rebalances
+    and propagates the accounts concurrently, e.g. a ThreadPoolExecutor or a
+    process pool sharing the price panel, see scenario_runner.pool().
 
     :returns: two dataframes:
-              dataframe1, Two columns, portfolio returns, account returns, pct_change.
+              dataframe1, portfolio returns, pct_change, and the account returns
+              in a second column with compare.
               dataframe2, long format with asset allocations for each account for plotting.
+              None with online.
     """
-    # Create slicer.
-    idx = pd.IndexSlice
-
     # Create empty dataframes in each account, to be used to determine if this is initialization or rebalance.
     # e.g. a['df'].empty is True
     for a in accounts:
@@ -30,37 +64,28 @@ def rebalance_portfolio(port_allocation, accounts, start_date, end_date):
         # act["drip"] = True
         # act["mutual_funds"] = False
 
-        # Set the start and end date.
+        # Set the start and end date, the start on the first trade date as
+        # new_df() moves it, the accounts may be started in other processes.
         # Make initial deposit equal to zero.
         # Mutual funds must be false.
-        act["start_date"] = start_date
+        act["start_date"] = pp.get_panel().first_trade_date(start_date)
         act["end_date"] = end_date
 
     # Initialize rebalancing date to the start date.
     re_date = start_date
 
-    # Create account tuple for building the multi index for rows.
-    accounts_list = []
-    for a in accounts:
-        accounts_list.append(tuple((a["owner"], a["account_type"])))
-
-    # Create portfolio dataframe for tracking assets. This will show the current investments,
-    # new investments, and asset allocations in percent.
-    idex = pd.MultiIndex.from_tuples(accounts_list, names=["person", "act_type"])
-    col = pd.MultiIndex.from_product(
-        [["invested", "new"], ["csh", "fi", "eq"]], names=["status", "asset"]
-    )
-    df = pd.DataFrame(data=0, index=idex, columns=col)
+    # Household array of the dollars invested in each account, one row per account
+    # in order and one column per asset class, csh, fi and eq.
+    invested = np.zeros((len(accounts), 3))
 
-    # Put initial cash in the portfolio dataframe accounts.
-    for a in accounts:
-        df.loc[idx[a["owner"], a["account_type"]], idx["invested", "csh"]] = a[
-            "dep_with"
-        ][start_date]
+    # Put initial cash in the accounts.
+    for i, a in enumerate(accounts):
+        invested[i, 0] = a["dep_with"][start_date]
 
     # Total size of the initial portfolio.
-    total_invested = df.loc[idx[:, :], idx["invested", :]].sum().sum()
+    total_invested = invested.sum(axis=0).sum()
 
+    totals = None
     rebalancing = True
     while rebalancing:
         # Determine target allocation in dollars.
@@ -69,235 +94,297 @@ def rebalance_portfolio(port_allocation, accounts, start_date, end_date):
         target_eq = total_invested * port_allocation["atar_equity"]
 
         # Allocate dollars to the accounts.
-        for a in accounts:
-            df, target_csh, target_fi, target_eq = rf.allocate_account(
-                a, df, target_csh, target_fi, target_eq
-            )
+        new, _ = rf.allocate_household(invested, (target_csh, target_fi, target_eq))
 
         # Determine allocation percentages.
-        df1 = df.loc[:, idx["new", ("csh", "fi", "eq")]].div(
-            df.loc[:, idx["new", :]].sum(axis=1), axis=0
-        )
-        df = df.join(df1.rename(columns={"new": "allocation"}, level=0))
-
-        # Initialize the dataframes for each account.
-        for a in accounts:
-            cash_all = df.loc[
-                idx[a["owner"], a["account_type"]], idx["allocation", "csh"]
-            ]
-            fi_all = df.loc[idx[a["owner"], a["account_type"]], idx["allocation", "fi"]]
-            eq_all = df.loc[idx[a["owner"], a["account_type"]], idx["allocation", "eq"]]
-            adj_asset_allocation = rf.retarget(cash_all, fi_all, eq_all, a)
-            if a["df"].empty:
-                a["df"] = rf.start_accounts(adj_asset_allocation)
-            else:
-                r = a["df"].loc[re_date, :].to_dict()
-                # Reset the df row to the adjusted rebalanced pd.Series.
-                a["df"].loc[re_date, :] = pd.Series(rf.rebalance_row(r, a))
-
-                # Propagate all values down from last rebalance date.
-                a["df"].loc[re_date:, :] = rf.propagate(re_date, a["df"], a)
-
-        # Create a dataframe with the index rebalancing periods, this is used
-        # so that the re-sampling is only done once. Columns are not used, just the index.
-        dfp = rf.trade_period_index(
-            port_allocation, accounts[0]["df"][["cash", "total_value"]], start_date
-        )
+        with np.errstate(divide="ignore", invalid="ignore"):
+            allocation = new / new.sum(axis=1)[:, np.newaxis]
 
-        # Create a dataframe and add all the account dataframe assets into totals columns.
-        cols = ["cash_total", "fixed_income_total", "equity_total"]
-        df_port = pd.DataFrame(data=0, index=accounts[0]["df"].index, columns=cols)
+        for a, (cash_all, fi_all, eq_all) in zip(accounts, allocation):
+            rf.retarget(cash_all, fi_all, eq_all, a)
 
-        for a in accounts:
-            df_port = df_port.add(a["df"][cols])
-
-        # Create dataframe that shows the allocation for the entire portfolio in percentages over timeindex.
-        df_port_all = df_port.div(df_port.sum(axis=1), axis=0)
+        # Initialize or rebalance the dataframes for each account, they are
+        # independent until they are added up below.
+        if executor is None:
+            dfs = [step_account(a, re_date) for a in accounts]
+        else:
+            dfs = list(executor.map(step_account, accounts, [re_date] * len(accounts)))
+        for a, df in zip(accounts, dfs):
+            a["df"] = df
+
+        if totals is None:
+            # Positions of the rebalancing period dates, the re-sampling is only
+            # done once.
+            index = accounts[0]["df"].index
+            period = rf.period_positions(port_allocation, accounts[0]["df"], start_date)
+
+            # Household totals of the accounts on every day, days x csh, fi, eq.
+            totals = np.zeros((len(index), len(total_columns)))
+            start = 0
+
+            # Rows before fed have been passed to the online metrics.
+            fed = 0
+            realized = [0.0] * len(accounts)
+            if online is not None:
+                online.start(len(index))
+        else:
+            # Only the rows from the rebalancing date have changed.
+            start = index.get_loc(re_date)
 
-        # Filter the dataframe with percentages to show only dates for the trading periods,
-        # e.g. A annual, Q quarterly
-        dft = df_port_all.filter(items=dfp.index, axis=0)
+        # Add all the account assets into the household totals.
+        for k, col in enumerate(total_columns):
+            suffix = 0
+            for a in accounts:
+                suffix = suffix + a["df"][col].values[start:]
+            totals[start:, k] = suffix
 
-        # The columns in the accounts have different names than the short-forms used in these dataframes.
-        dft.columns = [
-            "cash_allocation",
-            "fixed_income_allocation",
-            "equity_allocation",
-        ]
+        # Allocation of the household on the rebalancing period dates, the period
+        # dates before the rebalancing date were inside the limits.
+        dates = period[period >= start]
+        dft = household_allocation(totals, dates)
 
         # Use masks to filter the dataframe with percentages to see if asset allocation is outside
         # accepted limits. If so, set the rebalance date (re_date) and repeat above.
         # If not, then finalize the account dataframes and finish.
-        # Test for maximum levels.
-        mask1 = dft["cash_allocation"] > port_allocation["amax_cash"]
-        mask2 = dft["fixed_income_allocation"] > port_allocation["amax_fixed_income"]
-        mask3 = dft["equity_allocation"] > port_allocation["amax_equity"]
-        # Test for minimum levels.
-        mask4 = dft["cash_allocation"] < port_allocation["amin_cash"]
-        mask5 = dft["fixed_income_allocation"] < port_allocation["amin_fixed_income"]
-        mask6 = dft["equity_allocation"] < port_allocation["amin_equity"]
+        breached = dates[breach_mask(dft, port_allocation)]
+
+        # The rows before the next rebalancing date are final.
+        if online is not None:
+            stop = breached[0] if breached.size else len(index)
+            frames = [a["df"] for a in accounts]
+            online.update(household_values(accounts, frames, fed, stop, realized))
+            fed = stop
 
         # Get the date for the next rebalancing.
-        if dft[mask1 | mask2 | mask3 | mask4 | mask5 | mask6].empty:
-            # Finalize accounts.
-            df_result_portfolio = pd.DataFrame(
-                data=0, index=accounts[0]["df"].index, columns=["value_after_tax"]
-            )
+        if not breached.size and online is not None:
+            for a in accounts:
+                a["df"] = pd.DataFrame()
+            return None
+        elif not breached.size:
+            return finalize_portfolio(port_allocation, accounts, compare)
+        else:
+            # Get the date for the next rebalancing
+            re_date = index[breached[0]]
 
-            df_account_ass_all = pd.DataFrame(
-                data=None,
-                columns=[
-                    "account",
-                    "cash_all_compare",
-                    "fixed_income_all_compare",
-                    "equity_all_compare",
-                ],
-            )
+            total_invested = totals[breached[0]].sum()
 
-            for a in accounts:
-                a["df"] = rf.finalize(a, a["df"])
-                df_result_portfolio = df_result_portfolio.add(
-                    a["df"][["value_after_tax"]]
-                )
-
-                # Add markers to dataframe.
-                a["df"]["account"] = a["name"]
-                a["df"]["owner"] = a["owner"]
-                a["df"]["account_type"] = a["account_type"]
-
-                # Calculate after-tax asset allocation in dollars.
-                a["df"]["cash_all_compare"] = a["df"]["value_after_tax"].mul(
-                    a["df"]["cash_allocation"]
-                )
-                a["df"]["fixed_income_all_compare"] = a["df"]["value_after_tax"].mul(
-                    a["df"]["fixed_income_allocation"]
-                )
-                a["df"]["equity_all_compare"] = a["df"]["value_after_tax"].mul(
-                    a["df"]["equity_allocation"]
-                )
-                # Build asset allocation dataframe for graphing in final report.
-                if not df_account_ass_all.empty:
-                    df_account_ass_all = pd.concat(
-                        [
-                            df_account_ass_all,
-                            a["df"].loc[
-                            :,
-                            [
-                                "account",
-                                "owner",
-                                "account_type",
-                                "cash_all_compare",
-                                "fixed_income_all_compare",
-                                "equity_all_compare",
-                            ],
-                            ],
-                        ],
-                        axis=0,
-                    )
-                else:
-                    df_account_ass_all = a["df"].loc[
-                                         :,
-                                         [
-                                             "account",
-                                             "owner",
-                                             "account_type",
-                                             "cash_all_compare",
-                                             "fixed_income_all_compare",
-                                             "equity_all_compare",
-                                         ],
-                                         ]
-
-            # Make df_account_ass_all wide to long format.
-            df_account_ass_all = df_account_ass_all.reset_index()
-
-            df_account_ass_all.columns = ["trade_date", "account", "owner", "account_type", "cash", "fixed_income",
-                                          "equity"]
-
-            df_account_ass_all = pd.melt(
-                df_account_ass_all,
-                id_vars=["trade_date", "account", "owner", "account_type"],
-                value_vars=["cash", "fixed_income", "equity"],
-            )
+            # Determine the current asset mix of the portfolio.
+            rows = [a["df"].loc[re_date, total_columns] for a in accounts]
+            invested = np.array(rows)
 
-            df_account_ass_all.rename(columns={"variable": "asset"}, inplace=True)
 
-            df_result_portfolio["returns"] = df_result_portfolio[
-                "value_after_tax"
-            ].pct_change()
-            df_result_portfolio = df_result_portfolio["returns"]
-            df_result_accounts = pd.DataFrame(
-                data=0, index=accounts[0]["df"].index, columns=["value_after_tax"]
-            )
-            for a in accounts:
-                # Set the account rebalancing parameters equal to the portfolio rebalancing parameters.
-                a["rebalance_period"] = port_allocation["rebalance_period"]
-                a["atar_cash"] = port_allocation["atar_cash"]
-                a["atar_fixed_income"] = port_allocation["atar_fixed_income"]
-                a["atar_equity"] = port_allocation["atar_equity"]
-                a["amax_cash"] = port_allocation["amax_cash"]
-                a["amax_fixed_income"] = port_allocation["amax_fixed_income"]
-                a["amax_equity"] = port_allocation["amax_equity"]
-                a["amin_cash"] = port_allocation["amin_cash"]
-                a["amin_fixed_income"] = port_allocation["amin_fixed_income"]
-                a["amin_equity"] = port_allocation["amin_equity"]
-                a["rmax_cash"] = port_allocation["rmax_cash"]
-                a["rmax_fixed_income"] = port_allocation["rmax_fixed_income"]
-                a["rmax_equity"] = port_allocation["rmax_equity"]
-                a["rmin_cash"] = port_allocation["rmin_cash"]
-                a["rmin_fixed_income"] = port_allocation["rmin_fixed_income"]
-                a["rmin_equity"] = port_allocation["rmin_equity"]
-
-                a["dfa"] = ra.rebalance_account(a)
-                df_result_accounts = df_result_accounts.add(
-                    a["dfa"][["value_after_tax"]]
-                )
-
-
-
-            df_result_accounts["returns"] = df_result_accounts[
-                "value_after_tax"
-            ].pct_change()
-            df_result_accounts = df_result_accounts["returns"]
-
-            df_result = pd.concat(
-                [df_result_portfolio, df_result_accounts],
-                axis=1,
-                keys=["portfolio", "account"],
+def step_account(a, re_date):
+    """
+    Start an account of the portfolio, or rebalance it on a date and propagate it
+    to the end.
+
+    :param a: dictionary, account parameters with the account dataframe in "df",
+    empty to start the account
+    :param re_date: timestamp, rebalancing date, not used to start the account
+    :return: dataframe, account
+    """
+    if a["df"].empty:
+        return rf.start_accounts(a)
+
+    df = a["df"]
+    r = rs.read(df, re_date)
+    # Write the rebalanced row back to the df.
+    rs.write(df, re_date, rf.rebalance_row(r, a))
+
+    # Propagate all values down from last rebalance date.
+    df.loc[re_date:, :] = rf.propagate(re_date, df, a)
+    return df
+
+
+def household_allocation(totals, rows):
+    """
+    Allocation of the household on some days.
+
+    :param totals: np.array days x asset classes, dollars of the household in csh,
+    fi and eq, see total_columns
+    :param rows: np.array, positions of the days
+    :return: dictionary, allocation column: np.array with one value per row
+    """
+    t = totals[rows]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        allocation = t / t.sum(axis=1)[:, np.newaxis]
+    return {c: allocation[:, i] for i, c in enumerate(allocation_columns)}
+
+
+def household_values(accounts, frames, start, stop, realized):
+    """
+    value_after_tax of the household on some days, as finalize_portfolio() sets
+    it, see refunc.final_values().
+
+    :param accounts: list of dictionaries, account parameters
+    :param frames: list, dataframe or dictionary of arrays with the final_columns
+    of each account
+    :param start: int, first row
+    :param stop: int, row after the last row
+    :param realized: list, tax realized by each account before start, updated
+    :return: np.array
+    """
+    values = 0
+    for k, (a, w) in enumerate(zip(accounts, frames)):
+        rows = {c: np.asarray(w[c])[start:stop] for c in rf.final_columns}
+        v, realized[k] = rf.final_values(a, rows, realized[k])
+        values = values + v
+    return values
+
+
+def breach_mask(dft, port_allocation):
+    """
+    Rows of the portfolio outside the allocation limits.
+
+    :param dft: dataframe or dictionary of arrays, allocation of the portfolio on
+    rebalancing period dates
+    :param port_allocation: dictionary, portfolio allocation parameters
+    :return: boolean mask
+    """
+    # Test for maximum levels.
+    mask1 = dft["cash_allocation"] > port_allocation["amax_cash"]
+    mask2 = dft["fixed_income_allocation"] > port_allocation["amax_fixed_income"]
+    mask3 = dft["equity_allocation"] > port_allocation["amax_equity"]
+    # Test for minimum levels.
+    mask4 = dft["cash_allocation"] < port_allocation["amin_cash"]
+    mask5 = dft["fixed_income_allocation"] < port_allocation["amin_fixed_income"]
+    mask6 = dft["equity_allocation"] < port_allocation["amin_equity"]
+
+    return mask1 | mask2 | mask3 | mask4 | mask5 | mask6
+
+
+def finalize_portfolio(port_allocation, accounts, compare=False):
+    """
+    Finalize the accounts of a rebalanced portfolio and combine their results.
+
+    :param port_allocation: dictionary, portfolio allocation parameters
+    :param accounts: list of dictionaries, accounts with their rebalanced dataframe
+    in "df"
+    :param compare: boolean, see rebalance_portfolio()
+    :returns: two dataframes, see rebalance_portfolio()
+    """
+    df_result_portfolio = pd.DataFrame(
+        data=0, index=accounts[0]["df"].index, columns=["value_after_tax"]
+    )
+
+    df_account_ass_all = pd.DataFrame(
+        data=None,
+        columns=[
+            "account",
+            "cash_all_compare",
+            "fixed_income_all_compare",
+            "equity_all_compare",
+        ],
+    )
+
+    for a in accounts:
+        a["df"] = rf.finalize(a, a["df"])
+        df_result_portfolio = df_result_portfolio.add(a["df"][["value_after_tax"]])
+
+        # Add markers to dataframe.
+        a["df"]["account"] = a["name"]
+        a["df"]["owner"] = a["owner"]
+        a["df"]["account_type"] = a["account_type"]
+
+        # Calculate after-tax asset allocation in dollars.
+        a["df"]["cash_all_compare"] = a["df"]["value_after_tax"].mul(
+            a["df"]["cash_allocation"]
+        )
+        a["df"]["fixed_income_all_compare"] = a["df"]["value_after_tax"].mul(
+            a["df"]["fixed_income_allocation"]
+        )
+        a["df"]["equity_all_compare"] = a["df"]["value_after_tax"].mul(
+            a["df"]["equity_allocation"]
+        )
+        # Build asset allocation dataframe for graphing in final report.
+        columns = [
+            "account",
+            "owner",
+            "account_type",
+            "cash_all_compare",
+            "fixed_income_all_compare",
+            "equity_all_compare",
+        ]
+        if not df_account_ass_all.empty:
+            df_account_ass_all = pd.concat(
+                [df_account_ass_all, a["df"].loc[:, columns]], axis=0
             )
-            return df_result, df_account_ass_all
         else:
-            # Get the date for the next rebalancing
-            re_date = dft[mask1 | mask2 | mask3 | mask4 | mask5 | mask6].iloc[0].name
+            df_account_ass_all = a["df"].loc[:, columns]
+
+    # Make df_account_ass_all wide to long format.
+    df_account_ass_all = df_account_ass_all.reset_index()
+
+    df_account_ass_all.columns = [
+        "trade_date",
+        "account",
+        "owner",
+        "account_type",
+        "cash",
+        "fixed_income",
+        "equity",
+    ]
+
+    df_account_ass_all = pd.melt(
+        df_account_ass_all,
+        id_vars=["trade_date", "account", "owner", "account_type"],
+        value_vars=["cash", "fixed_income", "equity"],
+    )
 
-            total_invested = df_port.loc[re_date].sum()
+    df_account_ass_all.rename(columns={"variable": "asset"}, inplace=True)
 
-            # Determine the current asset mix of the portfolio.
-            cols_acct = ["cash_total", "fixed_income_total", "equity_total"]
-            convert = {
-                "cash_total": "csh",
-                "fixed_income_total": "fi",
-                "equity_total": "eq",
-            }
-            df_all = pd.DataFrame()
-            # Re-create the portfolio dataframe from the account dataframes.
-            for a in accounts:
-                df_all_s = a["df"].loc[re_date, cols_acct]
-                df_all_s.name = (a["owner"], a["account_type"])
-                df_all_s.index = df_all_s.index.map(convert)
-
-                # If the dataframe is empty, create it, else concat
-                if df_all.empty:
-                    df_all = pd.DataFrame(df_all_s)
-                else:
-                    df_all = pd.concat([df_all, pd.DataFrame(df_all_s)], axis=1)
-            # Reshape the dataframe to put the multi index on the correct axis.
-            df_all = df_all.T
-            # Copy and create the 'new' dataframe and populate with zeros.
-            df_all_new = df_all.copy()
-            df_all_new[:] = 0
-            # Join the two together.
-            df_all = pd.concat([df_all, df_all_new], axis=1, keys=["invested", "new"])
-            df = df_all
+    df_result_portfolio["returns"] = df_result_portfolio["value_after_tax"].pct_change()
+    df_result_portfolio = df_result_portfolio["returns"]
+    if not compare:
+        df_result = pd.concat([df_result_portfolio], axis=1, keys=["portfolio"])
+        return df_result, df_account_ass_all
+
+    a = accounts[0]
+    df_result_accounts = compare_accounts(
+        port_allocation, accounts, a["start_date"], a["end_date"]
+    )
+
+    df_result = pd.concat(
+        [df_result_portfolio, df_result_accounts],
+        axis=1,
+        keys=["portfolio", "account"],
+    )
+    return df_result, df_account_ass_all
+
+
+def compare_accounts(port_allocation, accounts, start_date, end_date):
+    """
+    Returns of the accounts of a portfolio when each is rebalanced on its own to
+    the portfolio allocation, the comparison of rebalance_portfolio().
+
+    The accounts are simulated through the simulation cache, see sim_cache.py.
+    They do not depend on the portfolio run, this can run before, after or next to
+    it. The DataFrame of every account is kept in its "dfa", its parameters are
+    not changed.
+
+    :param port_allocation: dictionary, portfolio allocation parameters
+    :param accounts: list of dictionaries, account parameters
+    :param start_date: string
+    :param end_date: string
+    :return: series, pct_change of the value after tax of the sum of the accounts
+    """
+    df_result_accounts = None
+    for a in accounts:
+        # Set the account rebalancing parameters equal to the portfolio rebalancing
+        # parameters.
+        params = {k: v for k, v in a.items() if k not in ("df", "dfa")}
+        params.update({f: port_allocation[f] for f in compare_fields})
+        params["start_date"] = start_date
+        params["end_date"] = end_date
+
+        a["dfa"] = sc.rebalance_account(params)
+        if df_result_accounts is None:
+            df_result_accounts = pd.DataFrame(
+                data=0, index=a["dfa"].index, columns=["value_after_tax"]
+            )
+        df_result_accounts = df_result_accounts.add(a["dfa"][["value_after_tax"]])
+
+    return df_result_accounts["value_after_tax"].pct_change().rename("returns")
 
 
 if __name__ == "__main__":
@@ -2,13 +2,51 @@
 
 import pandas as pd
 import numpy as np
-import pickle
+import price_panel as pp
+import row_state as rs
+import trade_calendar as tc
+from row_state import XBB, XIC, TD_BOND, TD_CDN_EQUITY
 
 
 # Securities, list of typically two etfs and two mutual funds. Representing equity
 # and fixed income. Do not vary these for now.
 securities = ["XBB", "XIC", "TD_Bond", "TD_CDN_Equity"]
 
+# Columns written by propagate.
+propagate_columns = (
+    [
+        "cash",
+        "dividends",
+        "tax_dividend",
+        "market_value",
+        "total_value",
+        "cash_allocation",
+        "cash_total",
+        "fixed_income_allocation",
+        "fixed_income_total",
+        "equity_allocation",
+        "equity_total",
+        "costs",
+    ]
+    + [sec + "-unit_traded" for sec in securities]
+    + [sec + "-unit" for sec in securities]
+    + [sec + "-value" for sec in securities]
+    + [sec + "-acb" for sec in securities]
+)
+
+# Columns read by propagate.
+window_columns = ["dep_with"] + [
+    sec + "-" + col for sec in securities for col in ["nav_per_share", "dividends"]
+]
+
+# Tax rates of a tax bracket, see bracket_fields_of().
+bracket_fields = ["tax_rate", "tax_div", "tax_gains"]
+
+# Columns read by final_values.
+final_columns = ["total_value", "tax_dividend", "tax_gain"] + [
+    sec + "-" + col for sec in securities for col in ["nav_per_share", "acb", "unit"]
+]
+
 # Variables will be input by way of a dict. This will allow for objects and variables
 # to be attached to each account. A DataFrame will be created and attached below.
 # Use this dict if running internally, otherwise use this dict as a template
@@ -106,27 +144,20 @@ def check_var(a):
 
 def new_df(a):
     """
-    Create new dataframe from pickled mutual fund and etf dataframe template.
+    Create new dataframe from the mutual fund and etf dataframe template.
 
     :param a: dictionary, account parameters
     :return: dataframe
     """
-    # Raw price data has been munged and is in a pickle file ready for use.
-    filename = "accounts_template.pickle"
-
-    # Open the existing raw data from the pickle file.
-    infile = open(filename, "rb")
-    df = pickle.load(infile)
-    infile.close()
+    # Raw price data has been munged and is loaded once per process.
+    panel = pp.get_panel()
 
     # Check that the start date is on a trade date.
     # If not, move to first trade date.
-    a["start_date"] = df.index[df.index >= a["start_date"]][0]
+    a["start_date"] = panel.first_trade_date(a["start_date"])
 
-    # Drop rows outside of the start and end dates.
-    df = df.loc[a["start_date"]: a["end_date"], :]
-
-    df = df.dropna()
+    # Rows between the start and end dates, without missing prices.
+    df = panel.frame(a["start_date"], a["end_date"])
 
     return df
 
@@ -172,16 +203,55 @@ def trade_period_index(a, df, re_date):
     :param re_date: string, date rebalancing to occur.
     :return: dataframe, with periodic index for rebalancing.
     """
+    return df.iloc[period_positions(a, df, re_date)]
+
+
+def period_positions(a, df, re_date):
+    """
+    Positions of the rebalancing period dates of an account dataframe.
+
+    Month, quarter and year ends are sliced from the calendar of the price panel.
+    Other periods, and a dataframe that is not a run of panel trading days, are
+    resampled.
+
+    :param a: account dict
+    :param df: dataframe
+    :param re_date: string, date rebalancing to occur.
+    :return: np.array, positions in df
+    """
     if a["rebalance_period"] == "D" or a["rebalance_period"] == "B":
-        dfp = df.loc[re_date:, :]
-    else:
-        dfp = (
-            df.assign(Date=df.index)
-            .resample(a["rebalance_period"])
-            .last()
-            .set_index("Date")
-        )
-    return dfp
+        return np.arange(df.index.searchsorted(re_date), df.shape[0])
+
+    if a["rebalance_period"] in tc.periods:
+        calendar = pp.get_panel().calendar()
+        start = calendar.locate(df.index)
+        if start is not None:
+            stop = start + df.shape[0]
+            return calendar.period_ends(a["rebalance_period"], start, stop)
+
+    dates = pd.Series(df.index, index=df.index).resample(a["rebalance_period"]).last()
+    return df.index.get_indexer(dates.dropna())
+
+
+def is_prefix(a, df, end_date):
+    """
+    Test if the account run to an earlier end date is df cut at that date.
+
+    Rebalancing and propagation only look back, so the rows up to end_date are
+    the same in both runs as long as the last of them is a rebalancing date of df
+    too. A run always treats its last day as a period end.
+
+    :param a: dictionary, account or portfolio parameters
+    :param df: dataframe, account run to a later end date
+    :param end_date: string or timestamp
+    :return: boolean
+    """
+    stop = df.index.searchsorted(pd.Timestamp(end_date), side="right")
+    if stop == 0:
+        return False
+    if stop == df.shape[0] or a["rebalance_period"] in tc.daily_periods:
+        return True
+    return bool(np.isin(stop - 1, period_positions(a, df, df.index[0])))
 
 
 def start_accounts(a):
@@ -195,8 +265,8 @@ def start_accounts(a):
     initialize(a, df)
 
     re_date = a["start_date"]
-    r = df.loc[re_date, :].to_dict()
-    df.loc[re_date, :] = pd.Series(rebalance_row(r, a))
+    r = rs.read(df, re_date)
+    rs.write(df, re_date, rebalance_row(r, a))
     df.loc[re_date:, :] = propagate(re_date, df, a)
 
     return df
@@ -247,27 +317,25 @@ def acb(
 
 def reset_row_allocations(r):
     """
-    Returns updated pd.Series for the trade day with updated asset allocations.
+    Returns updated RowState for the trade day with updated asset allocations.
 
-    :param r: dictionary, rebalanced account details on specific date.
-    :return: dictionary
+    :param r: RowState, rebalanced account details on specific date.
+    :return: RowState
     """
 
-    if r["total_value"] == 0:
+    if r.total_value == 0:
         return r
     else:
         # Determine new allocations.
-        r["equity_allocation"] = (
-            (r["XIC-unit"] * r["XIC-nav_per_share"])
-            + (r["TD_CDN_Equity-unit"] * r["TD_CDN_Equity-nav_per_share"])
-        ) / r["total_value"]
+        r.equity_allocation = (
+            (r.unit[XIC] * r.nav[XIC]) + (r.unit[TD_CDN_EQUITY] * r.nav[TD_CDN_EQUITY])
+        ) / r.total_value
 
-        r["fixed_income_allocation"] = (
-            (r["XBB-unit"] * r["XBB-nav_per_share"])
-            + (r["TD_Bond-unit"] * r["TD_Bond-nav_per_share"])
-        ) / r["total_value"]
+        r.fixed_income_allocation = (
+            (r.unit[XBB] * r.nav[XBB]) + (r.unit[TD_BOND] * r.nav[TD_BOND])
+        ) / r.total_value
 
-        r["cash_allocation"] = r["cash"] / r["total_value"]
+        r.cash_allocation = r.cash / r.total_value
 
     return r
 
@@ -276,20 +344,20 @@ def sell(r, a, trade_cash, mutual_fund, security):
     """
     Sell security for trade_cash amount.
 
-    :param r: dictionary, trade rebalancing information
+    :param r: RowState, trade rebalancing information
     :param a: dictionary, account parameter dictionary
     :param trade_cash: float, funds to be traded
-    :param mutual_fund: string, mutual fund symbol
-    :param security: string, security symbol
-    :return: dictionary, trade rebalancing information updated to correct cash position.
+    :param mutual_fund: int, mutual fund offset, see row_state.py
+    :param security: int, security offset, see row_state.py
+    :return: RowState, trade rebalancing information updated to correct cash position.
     """
     for sec in [mutual_fund, security]:
-        if r[sec + "-value"] < a["minimum_trade_dollar"]:
+        if r.value[sec] < a["minimum_trade_dollar"]:
             continue
-        elif trade_cash > r[sec + "-value"]:
-            trade_cash_sec = r[sec + "-value"]
+        elif trade_cash > r.value[sec]:
+            trade_cash_sec = r.value[sec]
             trade_cash -= trade_cash_sec
-        elif trade_cash <= r[sec + "-value"]:
+        elif trade_cash <= r.value[sec]:
             trade_cash_sec = trade_cash
             trade_cash = 0
         else:
@@ -297,50 +365,50 @@ def sell(r, a, trade_cash, mutual_fund, security):
             pass
 
         # Trading costs.
-        if r[sec + "-fund_type"] == "ETF":
-            r["costs"] += a["trade_fee"]
+        if r.etf[sec]:
+            r.costs += a["trade_fee"]
             trade_costs = a["trade_fee"]
-            r["cash"] -= a["trade_fee"]
+            r.cash -= a["trade_fee"]
         else:
             trade_costs = 0
 
         # Reduce the units.
-        trade_units = (trade_cash_sec + trade_costs) / r[sec + "-nav_per_share"]
+        trade_units = (trade_cash_sec + trade_costs) / r.nav[sec]
 
         # Add cash to the cash account and to the sales account.
-        sale_revenue = trade_units * r[sec + "-nav_per_share"]
-        r["sales"] += sale_revenue
+        sale_revenue = trade_units * r.nav[sec]
+        r.sales += sale_revenue
 
-        r["cash"] += sale_revenue
+        r.cash += sale_revenue
 
         # Calculate taxes on sale.
         if a["taxable_transactions"]:
             tax_gain_realized = acb(
                 "sell",
-                r[sec + "-acb"],
-                r[sec + "-unit"],
-                r[sec + "-nav_per_share"],
+                r.acb[sec],
+                r.unit[sec],
+                r.nav[sec],
                 trade_units,
                 a["trade_fee"],
                 a["tax_gains"],
             )
 
-            r["tax_gain"] += tax_gain_realized
-            r["cash"] -= tax_gain_realized
+            r.tax_gain += tax_gain_realized
+            r.cash -= tax_gain_realized
         else:
             pass
 
         # Adjust the units.
-        r[sec + "-unit"] -= trade_units
-        r[sec + "-unit_traded"] -= trade_units
+        r.unit[sec] -= trade_units
+        r.unit_traded[sec] -= trade_units
 
         # Set new value.
-        r[sec + "-value"] = r[sec + "-unit"] * r[sec + "-nav_per_share"]
+        r.value[sec] = r.unit[sec] * r.nav[sec]
 
     # Determine new allocations.
     r = reset_row_allocations(r)
 
-    r["rebalanced"] = True
+    r.rebalanced = True
 
     return r
 
@@ -349,45 +417,46 @@ def buy(r, a, trade_cash, sec):
     """
     Purchase security for trade_cash amount less fee.
 
-    :param r: dictionary, trade rebalancing information
+    :param r: RowState, trade rebalancing information
     :param a: dictionary, account parameter dictionary
     :param trade_cash: float, funds to be traded
-    :param sec: string, security symbol
-    :return: dictionary, trade rebalancing information updated to correct cash position.
+    :param sec: int, security offset, see row_state.py
+    :return: RowState, trade rebalancing information updated to correct cash position.
     """
     # Take cash from the cash account and to the purchases account.
-    r["costs"] += a["trade_fee"]
+    r.costs += a["trade_fee"]
 
-    trade_cash -= r["tax_gain"]
-    r["cash"] -= trade_cash
+    trade_cash -= r.tax_gain
+    r.cash -= trade_cash
     trade_cash -= a["trade_fee"]
-    r["purchases"] += trade_cash
+    r.purchases += trade_cash
 
     # Increase the equity units.
-    trade_units = trade_cash / r[sec + "-nav_per_share"]
-
-    # Calculate acb.
-    r[sec + "-acb"] = acb(
-        "buy",
-        r[sec + "-acb"],
-        r[sec + "-unit"],
-        r[sec + "-nav_per_share"],
-        trade_units,
-        a["trade_fee"],
-        a["tax_gains"],
-    )
+    trade_units = trade_cash / r.nav[sec]
+
+    # Calculate acb, only taxable accounts pay tax on the gains over it.
+    if a["taxable_transactions"]:
+        r.acb[sec] = acb(
+            "buy",
+            r.acb[sec],
+            r.unit[sec],
+            r.nav[sec],
+            trade_units,
+            a["trade_fee"],
+            a["tax_gains"],
+        )
 
     # Adjust units.
-    r[sec + "-unit"] += trade_units
-    r[sec + "-unit_traded"] += trade_units
+    r.unit[sec] += trade_units
+    r.unit_traded[sec] += trade_units
 
     # Set new security value.
-    r[sec + "-value"] = r[sec + "-unit"] * r[sec + "-nav_per_share"]
+    r.value[sec] = r.unit[sec] * r.nav[sec]
 
     # Determine new allocations.
     r = reset_row_allocations(r)
 
-    r["rebalanced"] = True
+    r.rebalanced = True
 
     return r
 
@@ -396,14 +465,14 @@ def rebalance_cash_max(r, a, trade_cash):
     """
     Sell assets to increase cash position to the minimum rebalance level.
 
-    :param r: dictionary, trade rebalancing information
+    :param r: RowState, trade rebalancing information
     :param a: dictionary, account parameter dictionary
     :param trade_cash: float, funds to be traded
-    :return: dictionary, trade rebalancing information updated to correct cash position
+    :return: RowState, trade rebalancing information updated to correct cash position
     """
     # Find the delta from the asset value to the target value.
-    equity_diff = r["equity_allocation"] - a["atar_equity"]
-    fixed_income_diff = r["fixed_income_allocation"] - a["atar_fixed_income"]
+    equity_diff = r.equity_allocation - a["atar_equity"]
+    fixed_income_diff = r.fixed_income_allocation - a["atar_fixed_income"]
 
     # Deal with possible rounding errors.
     equity_diff = 0 if abs(equity_diff) < 1e-6 else equity_diff
@@ -412,7 +481,7 @@ def rebalance_cash_max(r, a, trade_cash):
     if all([equity_diff == 0, fixed_income_diff == 0]):
         add_to_equity = 0
         add_to_fixed_income = 0
-        r["cash_allocation"] = 0
+        r.cash_allocation = 0
     elif all([equity_diff <= 0, fixed_income_diff <= 0]):
         # Calculate how much to add to both proportionate to how far away from target.
         add_to_equity = trade_cash * (equity_diff / (equity_diff + fixed_income_diff))
@@ -428,58 +497,58 @@ def rebalance_cash_max(r, a, trade_cash):
     else:
         add_to_equity = 0
         add_to_fixed_income = 0
-        r["cash_allocation"] = 0
+        r.cash_allocation = 0
 
     # Reduce cash by trade cash.
-    r["cash"] -= trade_cash
+    r.cash -= trade_cash
 
     # Purchase equity if required.
     if add_to_equity > 0:
-        r["XIC-unit_traded"] = (add_to_equity - a["trade_fee"]) / r["XIC-nav_per_share"]
+        r.unit_traded[XIC] = (add_to_equity - a["trade_fee"]) / r.nav[XIC]
 
         # Adjust the acb of XIC.
-        r["XIC-acb"] = acb(
-            "buy",
-            r["XIC-acb"],
-            r["XIC-unit"],
-            r["XIC-nav_per_share"],
-            r["XIC-unit_traded"],
-            a["trade_fee"],
-            a["tax_gains"],
-        )
+        if a["taxable_transactions"]:
+            r.acb[XIC] = acb(
+                "buy",
+                r.acb[XIC],
+                r.unit[XIC],
+                r.nav[XIC],
+                r.unit_traded[XIC],
+                a["trade_fee"],
+                a["tax_gains"],
+            )
 
-        r["XIC-unit"] += r["XIC-unit_traded"]
-        r["XIC-value"] = r["XIC-unit"] * r["XIC-nav_per_share"]
-        r["purchases"] += add_to_equity
+        r.unit[XIC] += r.unit_traded[XIC]
+        r.value[XIC] = r.unit[XIC] * r.nav[XIC]
+        r.purchases += add_to_equity
 
         # Trading costs.
-        r["costs"] += a["trade_fee"]
+        r.costs += a["trade_fee"]
 
     else:
         pass
 
     # Purchase fixed income if required.
     if add_to_fixed_income > 0:
-        r["XBB-unit_traded"] = (add_to_fixed_income - a["trade_fee"]) / r[
-            "XBB-nav_per_share"
-        ]
+        r.unit_traded[XBB] = (add_to_fixed_income - a["trade_fee"]) / r.nav[XBB]
 
         # Adjust the acb of XBB.
-        r["XBB-acb"] = acb(
-            "buy",
-            r["XBB-acb"],
-            r["XBB-unit"],
-            r["XBB-nav_per_share"],
-            r["XBB-unit_traded"],
-            a["trade_fee"],
-            a["tax_gains"],
-        )
+        if a["taxable_transactions"]:
+            r.acb[XBB] = acb(
+                "buy",
+                r.acb[XBB],
+                r.unit[XBB],
+                r.nav[XBB],
+                r.unit_traded[XBB],
+                a["trade_fee"],
+                a["tax_gains"],
+            )
 
-        r["XBB-unit"] += r["XBB-unit_traded"]
-        r["XBB-value"] = r["XBB-unit"] * r["XBB-nav_per_share"]
-        r["purchases"] += add_to_fixed_income
+        r.unit[XBB] += r.unit_traded[XBB]
+        r.value[XBB] = r.unit[XBB] * r.nav[XBB]
+        r.purchases += add_to_fixed_income
         # trading costs
-        r["costs"] += a["trade_fee"]
+        r.costs += a["trade_fee"]
 
     else:
         pass
@@ -487,7 +556,7 @@ def rebalance_cash_max(r, a, trade_cash):
     # Determine new allocations.
     r = reset_row_allocations(r)
 
-    r["rebalanced"] = True
+    r.rebalanced = True
 
     return r
 
@@ -496,14 +565,14 @@ def rebalance_cash_min(r, a, trade_cash):
     """
     Sell assets to increase cash position to the minimum rebalance level.
 
-    :param r: dictionary, trade rebalancing information
+    :param r: RowState, trade rebalancing information
     :param a: dictionary, account parameter dictionary
     :param trade_cash: float, funds to be traded
-    :return: dictionary, trade rebalancing information updated to correct cash position.
+    :return: RowState, trade rebalancing information updated to correct cash position.
     """
     # Find the delta from the asset value to the target value.
-    equity_diff = r["equity_allocation"] - a["atar_equity"]
-    fixed_income_diff = r["fixed_income_allocation"] - a["atar_fixed_income"]
+    equity_diff = r.equity_allocation - a["atar_equity"]
+    fixed_income_diff = r.fixed_income_allocation - a["atar_fixed_income"]
 
     # Deal with rounding errors.
     equity_diff = 0 if abs(equity_diff) < 1e-6 else equity_diff
@@ -512,7 +581,7 @@ def rebalance_cash_min(r, a, trade_cash):
     if equity_diff + fixed_income_diff == 0:
         take_from_equity = 0
         take_from_fixed_income = 0
-        r["cash_allocation"] = 0
+        r.cash_allocation = 0
         trade_cash = 0
     # If equity_diff and fixed_income_diff are both greater than zero.
     elif all([equity_diff >= 0, fixed_income_diff >= 0]):
@@ -532,14 +601,14 @@ def rebalance_cash_min(r, a, trade_cash):
         # If here the there is a floating error.
         take_from_equity = 0
         take_from_fixed_income = 0
-        r["cash_allocation"] = 0
+        r.cash_allocation = 0
 
     # Increase cash by trade cash.
-    r["cash"] += trade_cash
+    r.cash += trade_cash
 
     for asset, security, mutual_fund in [
-        ["equity", "XIC", "TD_CDN_Equity"],
-        ["fixed_income", "XBB", "TD_Bond"],
+        ["equity", XIC, TD_CDN_EQUITY],
+        ["fixed_income", XBB, TD_BOND],
     ]:
 
         if asset == "equity" and take_from_equity <= 0:
@@ -559,47 +628,47 @@ def rebalance_cash_min(r, a, trade_cash):
 
         for sec in [mutual_fund, security]:
             # Set trading fee for mutual fund (free) vs. etf.
-            if r[sec + "-fund_type"] == "ETF":
+            if r.etf[sec]:
                 trading_fee = a["trade_fee"]
             else:
                 trading_fee = 0
 
             # Determine how much to sell in mutual funds first.
-            if r[sec + "-value"] < a["minimum_trade_dollar"]:
+            if r.value[sec] < a["minimum_trade_dollar"]:
                 continue
-            elif trans_cash > r[sec + "-value"]:
-                trade_cash_sec = r[sec + "-value"]
+            elif trans_cash > r.value[sec]:
+                trade_cash_sec = r.value[sec]
                 trans_cash -= trade_cash_sec
-            elif trans_cash <= r[sec + "-value"]:
+            elif trans_cash <= r.value[sec]:
                 trade_cash_sec = trans_cash
                 trans_cash = 0
             else:
                 raise ValueError("one should not end up here")
                 pass
-            r[sec + "-unit_traded"] = -trade_cash_sec / r[sec + "-nav_per_share"]
+            r.unit_traded[sec] = -trade_cash_sec / r.nav[sec]
 
             if a["taxable_transactions"]:
                 # Calculate taxes on sale.
                 tax_gain_realized = acb(
                     "sell",
-                    r[sec + "-acb"],
-                    r[sec + "-unit"],
-                    r[sec + "-nav_per_share"],
-                    -r[sec + "-unit_traded"],
+                    r.acb[sec],
+                    r.unit[sec],
+                    r.nav[sec],
+                    -r.unit_traded[sec],
                     trading_fee,
                     tax_rate,
                 )
 
-                r["tax_gain"] += tax_gain_realized
-                r["cash"] -= tax_gain_realized
+                r.tax_gain += tax_gain_realized
+                r.cash -= tax_gain_realized
             else:
                 pass
 
-            r[sec + "-unit"] += r[sec + "-unit_traded"]
-            r[sec + "-value"] = r[sec + "-unit"] * r[sec + "-nav_per_share"]
-            r["sales"] += trade_cash_sec
+            r.unit[sec] += r.unit_traded[sec]
+            r.value[sec] = r.unit[sec] * r.nav[sec]
+            r.sales += trade_cash_sec
             # Trading costs.
-            r["costs"] += trading_fee
+            r.costs += trading_fee
 
         else:
             pass
@@ -607,7 +676,7 @@ def rebalance_cash_min(r, a, trade_cash):
     # Determine new allocations.
     r = reset_row_allocations(r)
 
-    r["rebalanced"] = True
+    r.rebalanced = True
 
     return r
 
@@ -616,111 +685,111 @@ def mutual_fund_sweep(r):
     """
     Invests funds from cash to mutual funds.
 
-    :param r: dictionary, trade rebalancing information
-    :return: dictionary, series containing new mutual fund investments from cash
+    :param r: RowState, trade rebalancing information
+    :return: RowState, containing new mutual fund investments from cash
     """
-    cash_sweep = r["cash"]
-    total_fi_and_equity = r["fixed_income_allocation"] + r["equity_allocation"]
-    to_fi = 1 - (r["fixed_income_allocation"] / total_fi_and_equity)
-    to_eq = 1 - (r["equity_allocation"] / total_fi_and_equity)
+    cash_sweep = r.cash
+    total_fi_and_equity = r.fixed_income_allocation + r.equity_allocation
+    to_fi = 1 - (r.fixed_income_allocation / total_fi_and_equity)
+    to_eq = 1 - (r.equity_allocation / total_fi_and_equity)
 
-    for mf, sweep in [["TD_Bond", to_fi], ["TD_CDN_Equity", to_eq]]:
+    for mf, sweep in [[TD_BOND, to_fi], [TD_CDN_EQUITY, to_eq]]:
         if sweep == 0:
             continue
         else:
             pass
 
-        r[mf + "-unit_traded"] = (sweep * cash_sweep) / r[mf + "-nav_per_share"]
+        r.unit_traded[mf] = (sweep * cash_sweep) / r.nav[mf]
 
         # Adjust the acb of XBB.
-        r[mf + "-acb"] = acb(
+        r.acb[mf] = acb(
             "buy",
-            r[mf + "-acb"],
-            r[mf + "-unit"],
-            r[mf + "-nav_per_share"],
-            r[mf + "-unit_traded"],
+            r.acb[mf],
+            r.unit[mf],
+            r.nav[mf],
+            r.unit_traded[mf],
             0,
             0,
         )
 
-        r[mf + "-unit"] += r[mf + "-unit_traded"]
-        r[mf + "-value"] = r[mf + "-unit"] * r[mf + "-nav_per_share"]
+        r.unit[mf] += r.unit_traded[mf]
+        r.value[mf] = r.unit[mf] * r.nav[mf]
 
-        r["purchases"] += sweep * cash_sweep
-        r["cash"] -= sweep * cash_sweep
+        r.purchases += sweep * cash_sweep
+        r.cash -= sweep * cash_sweep
 
     # Determine new allocations.
     r = reset_row_allocations(r)
 
-    r["rebalanced"] = True
+    r.rebalanced = True
 
     return r
 
 
 def rebalance_row(r, a):
     """
-    Rebalance one day or one row as pd.Series
+    Rebalance one day or one row as a RowState.
 
-    :param r: dictionary, one row of the account dataframe
+    :param r: RowState, one row of the account dataframe, see row_state.py
     :param a: dictionary, account parameters
-    :return: dictionary, modified row rebalanced
+    :return: RowState, modified row rebalanced
     """
 
     # Equity max.
-    if r["equity_allocation"] > a["amax_equity"]:
+    if r.equity_allocation > a["amax_equity"]:
         # Rebalance the equity to the rebalance max.
-        trade_cash = r["total_value"] * (r["equity_allocation"] - a["rmax_equity"])
+        trade_cash = r.total_value * (r.equity_allocation - a["rmax_equity"])
         if abs(trade_cash) > a["minimum_trade_dollar"]:
-            r = sell(r, a, trade_cash, "TD_CDN_Equity", "XIC")
+            r = sell(r, a, trade_cash, TD_CDN_EQUITY, XIC)
         else:
             pass
     else:
         pass
 
     # Fixed income max.
-    if r["fixed_income_allocation"] > a["amax_fixed_income"]:
+    if r.fixed_income_allocation > a["amax_fixed_income"]:
         # Rebalance the fixed income to the rebalance max.
-        trade_cash = r["total_value"] * (
-            r["fixed_income_allocation"] - a["rmax_fixed_income"]
+        trade_cash = r.total_value * (
+            r.fixed_income_allocation - a["rmax_fixed_income"]
         )
         if abs(trade_cash) > a["minimum_trade_dollar"]:
-            r = sell(r, a, trade_cash, "TD_Bond", "XBB")
+            r = sell(r, a, trade_cash, TD_BOND, XBB)
         else:
             pass
     else:
         pass
 
     # Equity min.
-    if r["equity_allocation"] < a["amin_equity"]:
+    if r.equity_allocation < a["amin_equity"]:
         # Reset market value and total value to account for taxes and commissions.
         # Rebalance to the rebalance minimum.
-        trade_cash = r["total_value"] * (a["rmin_equity"] - r["equity_allocation"])
+        trade_cash = r.total_value * (a["rmin_equity"] - r.equity_allocation)
 
         if abs(trade_cash) > a["minimum_trade_dollar"]:
-            r = buy(r, a, trade_cash, "XIC")
+            r = buy(r, a, trade_cash, XIC)
         else:
             pass
     else:
         pass
 
     # Fixed income min.
-    if r["fixed_income_allocation"] < a["amin_fixed_income"]:
+    if r.fixed_income_allocation < a["amin_fixed_income"]:
         # Rebalance to the rebalance minimum.
-        trade_cash = r["total_value"] * (
-            a["rmin_fixed_income"] - r["fixed_income_allocation"]
+        trade_cash = r.total_value * (
+            a["rmin_fixed_income"] - r.fixed_income_allocation
         )
 
         if abs(trade_cash) > a["minimum_trade_dollar"]:
-            r = buy(r, a, trade_cash, "XBB")
+            r = buy(r, a, trade_cash, XBB)
         else:
             pass
     else:
         pass
 
     # Cash greater than max.
-    if r["cash_allocation"] > a["amax_cash"]:
+    if r.cash_allocation > a["amax_cash"]:
         # Rebalance the cash to the rebalance max.
-        trade_cash = r["total_value"] * (r["cash_allocation"] - a["rmax_cash"])
+        trade_cash = r.total_value * (r.cash_allocation - a["rmax_cash"])
         if abs(trade_cash) > a["minimum_trade_dollar"]:
             r = rebalance_cash_max(r, a, trade_cash)
         else:
@@ -729,9 +798,9 @@ def rebalance_row(r, a):
         pass
 
     # Cash less than minimum.
-    if r["cash_allocation"] < a["amin_cash"]:
+    if r.cash_allocation < a["amin_cash"]:
         # Rebalance the cash to the rebalance min.
-        trade_cash = r["total_value"] * (a["rmin_cash"] - r["cash_allocation"])
+        trade_cash = r.total_value * (a["rmin_cash"] - r.cash_allocation)
         if abs(trade_cash) > a["minimum_trade_dollar"]:
             r = rebalance_cash_min(r, a, trade_cash)
         else:
@@ -741,9 +810,9 @@ def rebalance_row(r, a):
 
     # Rounding errors in cash will cause false trades. Set cash to zero
     # if the value of cash is between plus/minus 1 x 10**-6
-    if abs(r["cash_allocation"]) < 1e-6:
-        r["cash"] = 0
-        r["cash_allocation"] = 0
+    if abs(r.cash_allocation) < 1e-6:
+        r.cash = 0
+        r.cash_allocation = 0
 
     return r
 
@@ -753,10 +822,91 @@ def calc_acb(nav, unit_traded, unit, acb):
     """
     Calculate the acb of a security.
 
-    :param nav:
-    :param unit_traded:
-    :param unit:
-    :param acb:
+    Vectorized form of calc_acb_loop. Each acb is a linear function of the one
+    before it, acb[i] = w[i] * acb[i - 1] + c[i], which is solved with cumulative
+    products and sums. The recurrence restarts where the acb resets to zero and
+    where units are bought with no units held.
+
+    :param nav: np.array, nav per share
+    :param unit_traded: np.array, units traded
+    :param unit: np.array, units held
+    :param acb: np.array, acb, only the first value is used
+    :return: np.array
+    """
+    n = acb.shape[0]
+    if n < 2:
+        return np.array(acb, dtype=float)
+
+    w = np.empty(n)
+    c = np.empty(n)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        units = unit[:-1] + unit_traded[1:]
+        w[1:] = unit[:-1] / units
+        c[1:] = (nav[1:] * unit_traded[1:]) / units
+
+    # Reset to zero when no units are left.
+    reset = (unit[1:] + unit_traded[1:]) == 0
+    w[1:][reset] = 0
+    c[1:][reset] = 0
+
+    # Trades that net the units to zero divide by zero, leave them to the loop.
+    if not (np.isfinite(w[1:]).all() and np.isfinite(c[1:]).all()):
+        return calc_acb_loop(nav, unit_traded, unit, acb)
+
+    # Rows that do not depend on the acb before them start a new run.
+    start = w == 0
+    start[0] = True
+    w[0] = 1
+    c[0] = acb[0]
+    w[start] = 1
+
+    p = np.cumprod(w)
+    d = c / p
+    d[start] = 0
+    cd = np.cumsum(d)
+
+    # First row of the run each row belongs to.
+    first = np.maximum.accumulate(np.where(start, np.arange(n), 0))
+
+    return p * (c[first] / p[first] + cd - cd[first])
+
+
+def event_acb(nav, unit_traded, unit, acb, rows):
+    """
+    calc_acb of a window where units are only traded on some rows.
+
+    On the other rows the acb of the row before carries over, or is zero with no
+    units held, so the acb is found on the rows with trades and held between them.
+    The result is the same as calc_acb over every row.
+
+    :param nav: np.array, nav per share
+    :param unit_traded: np.array, units traded, zero outside of rows
+    :param unit: np.array, units held, only changed on rows
+    :param acb: np.array, acb, only the first value is used
+    :param rows: np.array, sorted positions of the rows with trades, e.g. from
+    dividend_events()
+    :return: np.array
+    """
+    n = acb.shape[0]
+    rows = rows[rows > 0]
+
+    # With no units held the acb is zero from the second row.
+    if unit[0] == 0 and n > 1 and not (rows.size and rows[0] == 1):
+        rows = np.append(1, rows)
+    rows = np.append(0, rows)
+
+    res = calc_acb(nav[rows], unit_traded[rows], unit[rows], acb[rows])
+    return np.repeat(res, np.diff(rows, append=n))
+
+
+def calc_acb_loop(nav, unit_traded, unit, acb):
+    """
+    Calculate the acb of a security one row at a time, reference for calc_acb.
+
+    :param nav: np.array, nav per share
+    :param unit_traded: np.array, units traded
+    :param unit: np.array, units held
+    :param acb: np.array, acb, only the first value is used
     :return: np.array
     """
     res = np.empty(acb.shape)
@@ -771,33 +921,39 @@ def calc_acb(nav, unit_traded, unit, acb):
     return res
 
 
-def drip(a, df):
+def drip(a, w, factors=None, events=None):
     """
     Allocates dividends to drip or cash.
 
     :param a: dictionary, account parameters
-    :param df: dataframe, for rebalancing
-    :return: a, df
+    :param w: dictionary, column arrays of the propagated window, see propagate_window
+    :param factors: dictionary, security: drip factors of the window from
+    drip_factors(), computed from the window if not given
+    :param events: dictionary, security: positions of its dividends in the window,
+    see dividend_events(), found in the window if not given, only used for the acb
+    of taxable accounts
+    :return: dictionary
     """
+    if events is None and a["taxable_transactions"]:
+        events = window_events(w)
+
     # Reset the cash to first row value of cash.
-    df.iloc[1:, 0] = df.iloc[0, 0]
+    w["cash"][1:] = w["cash"][0]
 
     # Start slice.
-    s = df.index[1:]
+    s = slice(1, None)
 
     # Dividends for XBB and XIC.
-    df.loc[s, "dividends"] = 0
+    w["dividends"][s] = 0
     for sec in ["XBB", "XIC"]:
-        df.loc[s, "dividends"] += df.loc[s, sec + "-dividends"].mul(
-            df.loc[s, sec + "-unit"]
-        )
+        w["dividends"][s] += w[sec + "-dividends"][s] * w[sec + "-unit"][s]
 
     # Income dividends to realized tax for XBB and XIC.
-    df.loc[s, "tax_dividend"] = 0
+    w["tax_dividend"][s] = 0
     if a["taxable_transactions"]:
         for s1, trate in (("XBB", a["tax_rate"]), ("XIC", a["tax_div"])):
-            df.loc[s, "tax_dividend"] += (
-                (df.loc[s, s1 + "-dividends"].mul(df.loc[s, s1 + "-unit"]))
+            w["tax_dividend"][s] += (
+                w[s1 + "-dividends"][s] * w[s1 + "-unit"][s]
             ) * trate
     else:
         pass
@@ -806,86 +962,68 @@ def drip(a, df):
     if a["drip"]:
         for sec in securities:
             # Check to see if non invested, and continue loop. Typically the mutual funds.
-            if df.loc[df.index[0], sec + "-unit"] == 0:
+            if w[sec + "-unit"][0] == 0:
                 continue
 
-            # Set the tax rate either dividend or interest.
-            if not a["taxable_transactions"]:
-                t_rate = 0
-            elif sec == "XBB" or sec == "TD_Bond":
-                t_rate = a["tax_rate"]
+            # Units purchased with dividends per unit held, less the dividend tax at
+            # the rate of the security, either dividend or interest. The tax amount
+            # never makes it into the account, hence tax paid.
+            if factors is None:
+                units, f = window_factors(a, w, sec)
             else:
-                t_rate = a["tax_div"]
+                units, f = factors[sec]
 
-            # Calculate units purchased with dividends.
-            # Units purchased is less the dividend tax, and the difference or tax amount
-            # never makes it into the account, hence tax paid.
-            drip_total_dividend = df.loc[s, sec + "-dividends"].mul(
-                df.loc[s, sec + "-unit"]
-            )
+            # Dividends are paid on the units of the first row.
+            u0 = w[sec + "-unit"][0]
+            w[sec + "-unit_traded"][s] = u0 * units[s]
 
-            df.loc[s, sec + "-unit_traded"] = (
-                drip_total_dividend * (1 - t_rate)
-            ) / df.loc[s, sec + "-nav_per_share"]
-
-            df[sec + "-acb"] = calc_acb(
-                *df[
-                    [
-                        sec + "-nav_per_share",
-                        sec + "-unit_traded",
-                        sec + "-unit",
-                        sec + "-acb",
-                    ]
-                ].values.T
-            )
+            # Units are only bought on the distribution dates of the security.
+            if a["taxable_transactions"]:
+                w[sec + "-acb"] = event_acb(
+                    w[sec + "-nav_per_share"],
+                    w[sec + "-unit_traded"],
+                    w[sec + "-unit"],
+                    w[sec + "-acb"],
+                    events[sec],
+                )
 
             # New unit total.
-            df.loc[s, sec + "-unit"] += df.loc[s, sec + "-unit_traded"].cumsum()
+            w[sec + "-unit"][s] = u0 * (1 + (f[s] - f[0]))
 
     else:
 
         # Sweep cash to mutual funds if indicated.
         if a["mutual_funds"]:
             # Fixed income.
-            df.loc[s, "TD_Bond-unit_traded"] = 0
-
-            df.loc[s, "TD_Bond-unit_traded"] = (
-                (df.loc[s, "dividends"] - df.loc[s, "tax_dividend"])
-                * a["atar_fixed_income"]
-            ) / df.loc[s, "TD_Bond-nav_per_share"]
+            w["TD_Bond-unit_traded"][s] = (
+                (w["dividends"][s] - w["tax_dividend"][s]) * a["atar_fixed_income"]
+            ) / w["TD_Bond-nav_per_share"][s]
 
-            df.loc[s, "TD_Bond-unit"] += df.loc[s, "TD_Bond-unit_traded"].cumsum()
+            w["TD_Bond-unit"][s] += np.cumsum(w["TD_Bond-unit_traded"][s])
 
             # Equity.
-            df.loc[s, "TD_CDN_Equity-unit_traded"] = 0
-
-            df.loc[s, "TD_CDN_Equity-unit_traded"] += (
-                (df.loc[s, "dividends"] - df.loc[s, "tax_dividend"]) * a["atar_equity"]
-            ) / df.loc[s, "TD_CDN_Equity-nav_per_share"]
-
-            df.loc[s, "TD_CDN_Equity-unit"] += df.loc[
-                s, "TD_CDN_Equity-unit_traded"
-            ].cumsum()
-
-            for sec in ["TD_Bond", "TD_CDN_Equity"]:
-                df[sec + "-acb"] = calc_acb(
-                    *df[
-                        [
-                            sec + "-nav_per_share",
-                            sec + "-unit_traded",
-                            sec + "-unit",
-                            sec + "-acb",
-                        ]
-                    ].values.T
-                )
+            w["TD_CDN_Equity-unit_traded"][s] = (
+                (w["dividends"][s] - w["tax_dividend"][s]) * a["atar_equity"]
+            ) / w["TD_CDN_Equity-nav_per_share"][s]
 
-            df.loc[s, "cash"] += (
-                (df.loc[s, "TD_Bond-unit"] * df.loc[s, "TD_Bond-dividends"])
-                + (
-                    df.loc[s, "TD_CDN_Equity-unit"]
-                    * df.loc[s, "TD_CDN_Equity-dividends"]
-                )
-            ).cumsum()
+            w["TD_CDN_Equity-unit"][s] += np.cumsum(w["TD_CDN_Equity-unit_traded"][s])
+
+            # Units are only bought on the distribution dates of the etfs.
+            if a["taxable_transactions"]:
+                etf_rows = np.union1d(events["XBB"], events["XIC"])
+                for sec in ["TD_Bond", "TD_CDN_Equity"]:
+                    w[sec + "-acb"] = event_acb(
+                        w[sec + "-nav_per_share"],
+                        w[sec + "-unit_traded"],
+                        w[sec + "-unit"],
+                        w[sec + "-acb"],
+                        etf_rows,
+                    )
+
+            w["cash"][s] += np.cumsum(
+                (w["TD_Bond-unit"][s] * w["TD_Bond-dividends"][s])
+                + (w["TD_CDN_Equity-unit"][s] * w["TD_CDN_Equity-dividends"][s])
+            )
 
             # Calculate taxes on mutual fund transactions.
             if a["taxable_transactions"]:
@@ -893,87 +1031,277 @@ def drip(a, df):
                     ("TD_Bond", a["tax_rate"]),
                     ("TD_CDN_Equity", a["tax_div"]),
                 ):
-                    df.loc[s, "tax_dividend"] += (
-                        (df.loc[s, s1 + "-dividends"].mul(df.loc[s, s1 + "-unit"]))
+                    w["tax_dividend"][s] += (
+                        w[s1 + "-dividends"][s] * w[s1 + "-unit"][s]
                     ) * trate
-                    df.loc[s, "cash"] -= (
-                        (df.loc[s, s1 + "-dividends"].mul(df.loc[s, s1 + "-unit"]))
+                    w["cash"][s] -= (
+                        w[s1 + "-dividends"][s] * w[s1 + "-unit"][s]
                     ) * trate
 
         else:
             # Add dividends net of tax and deposits to the cash.
-            df.loc[s, "cash"] += (
-                df.loc[s, "dividends"].cumsum() - df.loc[s, "tax_dividend"].cumsum()
+            w["cash"][s] += np.cumsum(w["dividends"][s]) - np.cumsum(
+                w["tax_dividend"][s]
             )
 
     # Add in deposits and withdrawals.
-    df.loc[s, "cash"] += df.loc[s, "dep_with"].cumsum()
+    w["cash"][s] += np.cumsum(w["dep_with"][s])
 
-    return df
+    return w
 
 
-def propagate(re_date, df, a):
+def drip_factors(a, df):
     """
-    Fills down the DataFrame from the last rebalance date to the end.
+    Drip factors of every security over the days of an account.
 
-    :param re_date: account
-    :param a: account dict
-    :param df: dataframe
-    :return: account DataFrame
+    Sliced from the table of the price panel, see PricePanel.drip_factors(), or
+    computed from the account if it is not a run of panel trading days.
+
+    :param a: dictionary, account parameters
+    :param df: dataframe, account
+    :return: dictionary, security: tuple, (np.array, units bought per unit held on
+    each day, np.array, their cumulative sum)
+    """
+    panel = pp.get_panel()
+    start = panel.calendar().locate(df.index)
+    factors = {}
+    for sec in securities:
+        if start is None:
+            factors[sec] = window_factors(a, df, sec)
+        else:
+            units, f = panel.drip_factors(sec, drip_tax_rate(a, sec))
+            stop = start + df.shape[0]
+            factors[sec] = units[start:stop], f[start:stop]
+    return factors
+
+
+def window_factors(a, w, sec):
+    """
+    Drip factors of a security computed from the prices of a window.
+
+    :param a: dictionary, account parameters
+    :param w: dictionary of arrays or dataframe, with the price columns
+    :param sec: string, security symbol
+    :return: tuple, (np.array, np.array), see drip_factors()
+    """
+    div = np.asarray(w[sec + "-dividends"], dtype=float)
+    nav = np.asarray(w[sec + "-nav_per_share"], dtype=float)
+    units = (div * (1 - drip_tax_rate(a, sec))) / nav
+    return units, np.cumsum(units)
+
+
+def dividend_events(df):
+    """
+    Distribution dates of every security over the days of an account.
+
+    Sliced from the index of the price panel, see PricePanel.dividend_events(), or
+    found in the account if it is not a run of panel trading days.
+
+    :param df: dataframe, account
+    :return: dictionary, security: np.array, positions in df of the days with a
+    dividend
+    """
+    panel = pp.get_panel()
+    start = panel.calendar().locate(df.index)
+    if start is None:
+        return window_events(df)
+
+    events = {}
+    stop = start + df.shape[0]
+    for sec in securities:
+        rows, _ = panel.dividend_events()[sec]
+        events[sec] = rows[rows.searchsorted(start) : rows.searchsorted(stop)] - start
+    return events
+
+
+def window_events(w):
+    """
+    Distribution dates of every security found in the dividends of a window.
+
+    :param w: dictionary of arrays or dataframe, with the dividend columns
+    :return: dictionary, security: np.array, positions of the days with a dividend
+    """
+    return {
+        sec: np.flatnonzero(np.asarray(w[sec + "-dividends"], dtype=float))
+        for sec in securities
+    }
+
+
+def drip_tax_rate(a, sec):
+    """
+    Tax rate on the dividends of a security reinvested by the drip.
+
+    :param a: dictionary, account parameters
+    :param sec: string, security symbol
+    :return: float
+    """
+    if not a["taxable_transactions"]:
+        return 0
+    elif sec == "XBB" or sec == "TD_Bond":
+        return a["tax_rate"]
+    else:
+        return a["tax_div"]
+
+
+def propagate_window(re_date, df, a, end_date=None, factors=None, events=None):
+    """
+    Fills down the account from the last rebalance date, as arrays.
+
+    Every row only depends on the rebalance date row and the rows before it, so
+    propagating up to end_date gives the first rows of the full propagation.
+
+    :param re_date: timestamp, rebalance date
+    :param df: dataframe, account
+    :param a: dictionary, account parameters
+    :param end_date: timestamp, last row to propagate, defaults to the end
+    :param factors: dictionary, drip factors of the account from drip_factors(),
+    found on every call if not given
+    :param events: dictionary, distribution dates of the account from
+    dividend_events(), found on every call if not given
+    :return: int, position of re_date, and dictionary, column arrays of the window
     """
+    start = df.index.get_loc(re_date)
+    stop = df.shape[0] if end_date is None else df.index.get_loc(end_date) + 1
 
-    df = df.loc[re_date:, :].copy()
+    w = {
+        col: np.array(df[col].values[start:stop], dtype=float)
+        for col in propagate_columns + window_columns
+    }
 
-    # Propagate the number of units and acb down the DataFrame.
+    # Propagate the number of units and acb down the window.
     for sec in securities:
-        df.loc[:, sec + "-unit"] = df.loc[df.index[0], sec + "-unit"]
-        df.loc[:, sec + "-acb"] = df.loc[df.index[0], sec + "-acb"]
+        w[sec + "-unit"][:] = w[sec + "-unit"][0]
+        w[sec + "-acb"][:] = w[sec + "-acb"][0]
 
-    # Set drip values.
-    df = drip(a, df)
+    # Set drip values, the units bought are read from the drip factors and the
+    # acb only changes on the distribution dates. Only taxable accounts track the
+    # acb, it is the cost of the gains they pay tax on.
+    w_factors = None
+    if a["drip"]:
+        factors = factors or drip_factors(a, df)
+        w_factors = {
+            sec: (units[start:stop], f[start:stop])
+            for sec, (units, f) in factors.items()
+        }
+    w_events = None
+    if a["taxable_transactions"] and (a["drip"] or a["mutual_funds"]):
+        events = events or dividend_events(df)
+        w_events = {
+            sec: rows[rows.searchsorted(start) : rows.searchsorted(stop)] - start
+            for sec, rows in events.items()
+        }
+    w = drip(a, w, w_factors, w_events)
 
     # Determine the market values of the individual securities.
     for sec in securities:
-        df.loc[:, sec + "-value"] = (
-            df.loc[:, sec + "-unit"] * df.loc[:, sec + "-nav_per_share"]
-        )
+        w[sec + "-value"] = w[sec + "-unit"] * w[sec + "-nav_per_share"]
 
     # Set market value.
-    df.loc[:, "market_value"] = df.loc[
-        :, ["XBB-value", "XIC-value", "TD_Bond-value", "TD_CDN_Equity-value"]
-    ].sum(axis=1)
+    w["market_value"] = (
+        w["XBB-value"] + w["XIC-value"] + w["TD_Bond-value"] + w["TD_CDN_Equity-value"]
+    )
 
     # Set total value.
-    df.loc[:, "total_value"] = df.loc[:, "market_value"] + df.loc[:, "cash"]
+    w["total_value"] = w["market_value"] + w["cash"]
 
     # Set cash allocation.
-    df.loc[:, "cash_allocation"] = df.loc[:, "cash"] / df.loc[:, "total_value"]
-    df.loc[:, "cash_total"] = df.loc[:, "cash_allocation"] * df.loc[:, "total_value"]
+    w["cash_allocation"] = w["cash"] / w["total_value"]
+    w["cash_total"] = w["cash_allocation"] * w["total_value"]
 
     # Set fixed income allocation.
-    df.loc[:, "fixed_income_allocation"] = (
-        df.loc[:, "XBB-value"].add(df.loc[:, "TD_Bond-value"])
-        / df.loc[:, "total_value"]
-    )
-    df.loc[:, "fixed_income_total"] = (
-        df.loc[:, "fixed_income_allocation"] * df.loc[:, "total_value"]
-    )
+    w["fixed_income_allocation"] = (w["XBB-value"] + w["TD_Bond-value"]) / w[
+        "total_value"
+    ]
+    w["fixed_income_total"] = w["fixed_income_allocation"] * w["total_value"]
 
     # Set equity allocation.
-    df.loc[:, "equity_allocation"] = (
-        df.loc[:, "XIC-value"].add(df.loc[:, "TD_CDN_Equity-value"])
-        / df.loc[:, "total_value"]
-    )
-    df.loc[:, "equity_total"] = (
-        df.loc[:, "equity_allocation"] * df.loc[:, "total_value"]
-    )
+    w["equity_allocation"] = (w["XIC-value"] + w["TD_CDN_Equity-value"]) / w[
+        "total_value"
+    ]
+    w["equity_total"] = w["equity_allocation"] * w["total_value"]
 
     # Set costs.
-    df.loc[1:, "costs"] = df.loc[df.index[0], "costs"]
+    w["costs"][1:] = w["costs"][0]
+
+    for col in window_columns:
+        del w[col]
+
+    return start, w
+
+
+def write_window(df, start, w, stop=None):
+    """
+    Write the arrays of propagate_window back to the account.
+
+    :param df: dataframe, account, modified in place
+    :param start: int, position of the first row of the window
+    :param w: dictionary, column arrays from propagate_window
+    :param stop: int, number of window rows to write, defaults to all
+    :return: None
+    """
+    for col, values in w.items():
+        # Propagated columns are float, as the integer zeros of the template.
+        if df[col].dtype != float:
+            df[col] = df[col].astype(float)
+
+        values = values[:stop]
+        df.iloc[start : start + len(values), df.columns.get_loc(col)] = values
+
+
+def propagate(re_date, df, a, end_date=None):
+    """
+    Fills down the DataFrame from the last rebalance date to the end.
+
+    With an end_date the rows after it are not propagated, the drip units traded
+    after it are written to df in place as a full propagate would, see
+    drip_tail(). df is not changed otherwise.
+
+    :param re_date: account
+    :param a: account dict
+    :param df: dataframe, modified in place with an end_date and drip
+    :param end_date: timestamp, last row to propagate, defaults to the end
+    :return: account DataFrame, the rows from re_date to end_date
+    """
+    if end_date is not None and a["drip"]:
+        drip_tail(a, df, re_date, end_date)
+
+    _, w = propagate_window(re_date, df, a, end_date)
+
+    df = df.loc[re_date:end_date, :].copy()
+    for col, values in w.items():
+        df[col] = values
 
     return df
 
 
+def drip_tail(a, df, re_date, end_date, factors=None):
+    """
+    Write the drip units traded after end_date, as a full propagate would.
+
+    Securities with no units keep the units traded of the last propagation that
+    held units, so those rows must not be left to a bounded propagate.
+
+    :param a: dictionary, account parameters
+    :param df: dataframe, account, modified in place
+    :param re_date: timestamp, rebalance date
+    :param end_date: timestamp, last row of the bounded propagate
+    :param factors: dictionary, drip factors of the account, see drip_factors()
+    :return: None
+    """
+    tail = df.index > end_date
+    if not tail.any():
+        return
+
+    factors = factors or drip_factors(a, df)
+    for sec in securities:
+        u0 = df.at[re_date, sec + "-unit"]
+        if u0 == 0:
+            continue
+
+        units, _ = factors[sec]
+        df.loc[tail, sec + "-unit_traded"] = u0 * units[tail]
+
+
 def retarget(cash, fi, eq, aa_adj):
     """
     Assign a new asset allocation to an account parameter dictionary used for rebalancing accounts on a date.
@@ -1004,48 +1332,41 @@ def retarget(cash, fi, eq, aa_adj):
     return aa_adj
 
 
-def allocate_account(account, df, target_csh, target_fi, target_eq):
-    """
-    Function called to allocate dollars to the accounts. Used in 'rebalance_portfolio.py'
-
-    :param account:
-    :param df:
-    :param target_csh:
-    :param target_fi:
-    :param target_eq:
-    :return:
-    """
-    idx = pd.IndexSlice
-    owner = account["owner"]
-    account_type = account["account_type"]
-    inv_balance = df.loc[idx[owner, account_type], idx["invested", :]].sum()
-    if inv_balance >= target_eq:
-        df.loc[idx[owner, account_type], idx["new", "eq"]] = target_eq
-        target_eq = 0
-        inv_balance -= df.loc[idx[owner, account_type], idx["new", "eq"]]
-        if inv_balance >= target_fi:
-            df.loc[idx[owner, account_type], idx["new", "fi"]] = target_fi
-            target_fi = 0
-            inv_balance -= df.loc[idx[owner, account_type], idx["new", "fi"]]
-            df.loc[idx[owner, account_type], idx["new", "csh"]] = inv_balance
-            target_csh -= inv_balance
-            inv_balance = 0
-        elif inv_balance < target_fi:
-            df.loc[idx[owner, account_type], idx["new", "fi"]] = inv_balance
-            target_fi -= inv_balance
-            inv_balance = 0
-            df.loc[idx[owner, account_type], idx["new", "csh"]] = 0
-        else:
-            pass
-    elif inv_balance < target_eq:
-        df.loc[idx[owner, account_type], idx["new", "eq"]] = inv_balance
-        target_eq -= inv_balance
-        df.loc[idx[owner, account_type], idx["new", "fi"]] = 0
-        df.loc[idx[owner, account_type], idx["new", "csh"]] = 0
-    else:
-        pass
+def allocate_household(invested, target):
+    """
+    Allocate the dollars of a household to its accounts. Used in
+    'rebalance_portfolio.py'
 
-    return df, target_csh, target_fi, target_eq
+    The accounts are filled in order, each with equity first, then fixed income,
+    and the rest of its balance in cash, until the targets of the household are
+    met. The columns of the arrays are the asset classes csh, fi and eq.
+
+    :param invested: np.array, accounts x asset classes, dollars in each account
+    :param target: sequence, target dollars of the household in csh, fi and eq
+    :return: tuple, (np.array accounts x asset classes, new dollars of each
+    account, tuple of the targets left in csh, fi and eq)
+    """
+    target_csh, target_fi, target_eq = target
+    new = np.zeros((len(invested), 3))
+    for i, inv_balance in enumerate(np.sum(invested, axis=1)):
+        if inv_balance >= target_eq:
+            new[i, 2] = target_eq
+            inv_balance -= target_eq
+            target_eq = 0
+            if inv_balance >= target_fi:
+                new[i, 1] = target_fi
+                inv_balance -= target_fi
+                target_fi = 0
+                new[i, 0] = inv_balance
+                target_csh -= inv_balance
+            elif inv_balance < target_fi:
+                new[i, 1] = inv_balance
+                target_fi -= inv_balance
+        elif inv_balance < target_eq:
+            new[i, 2] = inv_balance
+            target_eq -= inv_balance
+
+    return new, (target_csh, target_fi, target_eq)
 
 
 def re_allocate(df, a, re_date):
@@ -1057,8 +1378,8 @@ def re_allocate(df, a, re_date):
     :param re_date: string, date rebalancing to occcur.
     :return: dataframe, rebalanced from the re_date
     """
-    r = df.loc[re_date, :].to_dict()
-    df.loc[re_date, :] = pd.Series(rebalance_row(r, a))
+    r = rs.read(df, re_date)
+    rs.write(df, re_date, rebalance_row(r, a))
     df.loc[re_date:, :] = propagate(re_date, df, a)
 
     return df
@@ -1121,3 +1442,104 @@ def finalize(a, df):
     )
 
     return df
+
+
+def bracket_fields_of(a):
+    """
+    Tax rates that can change without changing the trades of an account.
+
+    Taxable accounts pay the tax on dividends and sales out of the cash, or out of
+    the dividends reinvested by the drip, which changes their allocations and so
+    their rebalancing dates. The tax of rsp and tfsa accounts is only set by
+    finalize().
+
+    :param a: dictionary, account parameters
+    :return: list of strings, empty for taxable accounts
+    """
+    if a["taxable_transactions"]:
+        return []
+    return bracket_fields
+
+
+def finalize_brackets(a, df, brackets):
+    """
+    Final account DataFrames of several tax brackets from one simulation.
+
+    The tax columns of all the brackets are computed at once, one column per
+    bracket, and written into a copy of df for each bracket. Only the brackets
+    allowed by bracket_fields_of() can differ from the tax rates of a.
+
+    :param a: dictionary, account parameters df was simulated with
+    :param df: dataframe, account, finalized
+    :param brackets: list of dictionaries, tax rates of each bracket
+    :return: list of dataframes, one per bracket
+    """
+    changed = [any(b.get(f, a[f]) != a[f] for f in bracket_fields) for b in brackets]
+    if any(changed) and not bracket_fields_of(a):
+        raise ValueError("The trades of taxable accounts depend on the tax rates.")
+
+    # tfsa accounts pay no tax in any bracket.
+    if not a["taxable_withdrawal"]:
+        return [df.copy() for _ in brackets]
+
+    # rsp accounts accrue tax_rate on the total value.
+    rates = np.array([b.get("tax_rate", a["tax_rate"]) for b in brackets])
+    tax = df["total_value"].values[:, np.newaxis] * rates[np.newaxis, :]
+
+    finals = []
+    for k in range(len(brackets)):
+        if not changed[k]:
+            finals.append(df.copy())
+            continue
+        final = df.copy()
+        final["tax_total"] = tax[:, k]
+        final["tax_accrued"] = tax[:, k]
+        final["value_after_tax"] = final["total_value"] - final["tax_total"]
+        final["value_after_tax_norm"] = (
+            final["value_after_tax"] / final.loc[a["start_date"], "value_after_tax"]
+        )
+        final["pct_change"] = final.value_after_tax.pct_change()
+        final["log_ret"] = np.log(final.value_after_tax) - np.log(
+            final.value_after_tax.shift(1)
+        )
+        finals.append(final)
+    return finals
+
+
+def final_values(a, w, realized=0.0):
+    """
+    value_after_tax of a run of rows as finalize() will set it.
+
+    Rows before the next rebalancing date do not change again, the engines pass
+    their values to an OnlineMetrics as they go. The realized tax is carried from
+    one run of rows to the next.
+
+    :param a: dictionary, account parameters
+    :param w: dataframe or dictionary of arrays, final_columns of the rows
+    :param realized: float, tax realized before the first row
+    :return: tuple, (np.array, tax realized up to the last row)
+    """
+    total = np.asarray(w["total_value"], dtype=float)
+
+    if not a["taxable_withdrawal"] and not a["taxable_transactions"]:
+        return total - 0, realized
+    elif a["taxable_withdrawal"]:
+        return total - total * a["tax_rate"], realized
+
+    # Taxable investment accounts, accrued tax on the gains over the acb.
+    accrued = 0
+    for sec in securities:
+        nav = np.asarray(w[sec + "-nav_per_share"], dtype=float)
+        acb = np.asarray(w[sec + "-acb"], dtype=float)
+        unit = np.asarray(w[sec + "-unit"], dtype=float)
+        accrued = accrued + ((nav - acb) * unit) * a["tax_gains"]
+
+    # Running sum as finalize's cumsum, continued from the previous rows.
+    tax = np.asarray(w["tax_dividend"], dtype=float) + np.asarray(
+        w["tax_gain"], dtype=float
+    )
+    tax_realized = np.cumsum(np.append(realized, tax))[1:]
+    if tax_realized.size:
+        realized = tax_realized[-1]
+
+    return total - (accrued + tax_realized), realized
@@ -0,0 +1,174 @@
+# coding: utf-8
+
+"""
+Append only store of the scenario results, replaces the port_<n>.pickle files.
+
+Every result is a row of an sqlite database keyed by the name of its grid and
+the scenario tuple, e.g. (du, sd, ac, rb, dr, tx, mf, at, rr). A result is
+committed as soon as it arrives, so an interrupted sweep keeps everything
+finished before it stopped and a rerun skips the completed keys. Results are
+read back by key or key prefix without loading the rest of the store.
+
+    store = ResultStore("scenario_data/results.sqlite")
+    done = store.keys("accounts")
+    store.put("accounts", key, metrics)
+    df = store.frame("accounts", prefix=("5 year", "2002-01-01"))
+"""
+
+import glob
+import json
+import os
+import pickle
+import sqlite3
+import pandas as pd
+
+
+# Default location of the store.
+filename = "scenario_data/results.sqlite"
+
+
+def dump_key(key):
+    """
+    Text of a scenario key, a JSON list.
+
+    :param key: tuple
+    :return: string
+    """
+    return json.dumps(list(key))
+
+
+def load_key(text):
+    """
+    Scenario key from its text.
+
+    :param text: string, from dump_key()
+    :return: tuple
+    """
+    return tuple(json.loads(text))
+
+
+class ResultStore(object):
+    """
+    Scenario results in an sqlite database.
+
+    :param path: string, database file, created if missing
+    """
+
+    def __init__(self, path=filename):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.con = sqlite3.connect(path)
+        self.con.execute("PRAGMA journal_mode=WAL")
+        self.con.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "grid TEXT NOT NULL, "
+            "key TEXT NOT NULL, "
+            "metrics BLOB NOT NULL, "
+            "PRIMARY KEY (grid, key))"
+        )
+        self.con.commit()
+
+    def close(self):
+        self.con.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def put(self, grid, key, metrics):
+        """
+        Add the result of one scenario. A key already in the store is kept.
+
+        :param grid: string, name of the grid, e.g. "accounts"
+        :param key: tuple, scenario key
+        :param metrics: dictionary, from fin_funcs() or fin_funcs_port()
+        :return: boolean, True if the result was added
+        """
+        cur = self.con.execute(
+            "INSERT OR IGNORE INTO results (grid, key, metrics) VALUES (?, ?, ?)",
+            (grid, dump_key(key), pickle.dumps(metrics)),
+        )
+        self.con.commit()
+        return cur.rowcount == 1
+
+    def keys(self, grid):
+        """
+        Keys of the completed scenarios of a grid.
+
+        :param grid: string
+        :return: set of tuples
+        """
+        rows = self.con.execute("SELECT key FROM results WHERE grid = ?", (grid,))
+        return {load_key(k) for k, in rows}
+
+    def get(self, grid, keys=None, prefix=()):
+        """
+        Results of a grid.
+
+        :param grid: string
+        :param keys: iterable of tuples, only these keys, default all
+        :param prefix: tuple, only the keys starting with these values
+        :return: dictionary, key: metrics, in the order of keys or else in the
+        order the results were added
+        """
+        sql = "SELECT r.key, r.metrics FROM results AS r"
+        args = []
+        if keys is not None:
+            # The keys asked for are joined in a temporary table, in their order.
+            self.con.execute(
+                "CREATE TEMP TABLE IF NOT EXISTS wanted "
+                "(key TEXT PRIMARY KEY, pos INTEGER NOT NULL)"
+            )
+            self.con.execute("DELETE FROM temp.wanted")
+            self.con.executemany(
+                "INSERT OR IGNORE INTO temp.wanted (key, pos) VALUES (?, ?)",
+                ((dump_key(k), i) for i, k in enumerate(keys)),
+            )
+            sql += " JOIN temp.wanted AS w ON r.key = w.key"
+        sql += " WHERE r.grid = ?"
+        args.append(grid)
+        if prefix:
+            # The text of a key starts as the text of its prefix without the
+            # closing bracket.
+            sql += " AND substr(r.key, 1, ?) = ?"
+            text = dump_key(prefix)[:-1] + ","
+            args += [len(text), text]
+        sql += " ORDER BY w.pos" if keys is not None else " ORDER BY r.rowid"
+
+        results = {}
+        for k, m in self.con.execute(sql, args):
+            results[load_key(k)] = pickle.loads(m)
+        return results
+
+    def frame(self, grid, keys=None, prefix=()):
+        """
+        Results of a grid as a DataFrame, one row per scenario.
+
+        :param grid: string
+        :param keys: iterable of tuples, only these keys, default all
+        :param prefix: tuple, only the keys starting with these values
+        :return: dataframe
+        """
+        return pd.DataFrame.from_dict(self.get(grid, keys, prefix)).T
+
+    def import_pickles(self, grid, pattern):
+        """
+        Add the results of the port_<n>.pickle files the scenarios were saved to
+        before this store, each a dictionary of key: metrics.
+
+        :param grid: string
+        :param pattern: string, glob of the files, e.g.
+        "scenario_data/data_port_asset_allocation/port_*.pickle"
+        :return: int, number of results added
+        """
+        added = 0
+        for path in sorted(glob.glob(pattern)):
+            with open(path, "rb") as f:
+                result_dict = pickle.load(f)
+            for key, metrics in result_dict.items():
+                added += self.put(grid, key, metrics)
+        return added
@@ -0,0 +1,143 @@
+# coding: utf-8
+
+"""
+Fixed layout state of one account row used by the rebalancing functions.
+
+rebalance_row, sell, buy, rebalance_cash_max, rebalance_cash_min and
+mutual_fund_sweep work on a RowState instead of a dictionary of the row. The
+account columns are attributes and the security columns are lists indexed by
+the security offsets below, so no column names are built while trading.
+
+    r = rs.read(df, re_date)
+    rs.write(df, re_date, rf.rebalance_row(r, a))
+"""
+
+
+# Securities, in the order of the account template.
+securities = ["XBB", "XIC", "TD_Bond", "TD_CDN_Equity"]
+
+# Offsets of the securities in the security lists of a RowState.
+XBB = 0
+XIC = 1
+TD_BOND = 2
+TD_CDN_EQUITY = 3
+
+# Account columns held by a RowState.
+row_columns = [
+    "cash",
+    "dividends",
+    "purchases",
+    "sales",
+    "market_value",
+    "total_value",
+    "tax_dividend",
+    "tax_gain",
+    "costs",
+    "rebalanced",
+    "cash_allocation",
+    "fixed_income_allocation",
+    "equity_allocation",
+    "cash_total",
+    "fixed_income_total",
+    "equity_total",
+]
+
+# Security columns held by a RowState, one list per column.
+security_columns = ["unit_traded", "unit", "value", "acb"]
+
+# Column positions by DataFrame layout, see positions().
+_positions = {}
+
+
+class RowState(object):
+    """
+    One row of an account DataFrame.
+
+    nav, unit_traded, unit, value and acb are lists with one entry per security,
+    etf is True for the securities traded with a fee.
+    """
+
+    __slots__ = row_columns + ["nav", "etf"] + security_columns
+
+    def copy(self):
+        r = RowState.__new__(RowState)
+        for name in row_columns:
+            setattr(r, name, getattr(self, name))
+        r.etf = self.etf
+        for name in ["nav"] + security_columns:
+            setattr(r, name, list(getattr(self, name)))
+        return r
+
+    def items(self):
+        """
+        Column names and values of the columns a rebalance can change.
+
+        :return: list of tuples
+        """
+        items = [(name, getattr(self, name)) for name in row_columns]
+        for name in security_columns:
+            values = getattr(self, name)
+            for k, sec in enumerate(securities):
+                items.append((sec + "-" + name, values[k]))
+        return items
+
+
+def positions(columns):
+    """
+    Positions of the RowState columns in a DataFrame with the given columns.
+
+    :param columns: pd.Index, DataFrame columns
+    :return: dictionary, column name: position
+    """
+    key = tuple(columns)
+    try:
+        return _positions[key]
+    except KeyError:
+        pos = {c: i for i, c in enumerate(key)}
+        _positions[key] = pos
+        return pos
+
+
+def from_values(values, pos):
+    """
+    RowState from the values of a row.
+
+    :param values: list, values of the row in column order
+    :param pos: dictionary, from positions()
+    :return: RowState
+    """
+    r = RowState.__new__(RowState)
+    for name in row_columns:
+        setattr(r, name, values[pos[name]])
+    r.nav = [values[pos[sec + "-nav_per_share"]] for sec in securities]
+    r.etf = [values[pos[sec + "-fund_type"]] == "ETF" for sec in securities]
+    for name in security_columns:
+        setattr(r, name, [values[pos[sec + "-" + name]] for sec in securities])
+    return r
+
+
+def read(df, date):
+    """
+    RowState of the row of a date.
+
+    :param df: dataframe, account
+    :param date: timestamp or string, trade date
+    :return: RowState
+    """
+    i = df.index.get_loc(date)
+    return from_values(df.iloc[i].tolist(), positions(df.columns))
+
+
+def write(df, date, r):
+    """
+    Write a RowState back to the row of a date.
+
+    :param df: dataframe, account
+    :param date: timestamp or string, trade date
+    :param r: RowState
+    :return: None
+    """
+    i = df.index.get_loc(date)
+    pos = positions(df.columns)
+    for col, value in r.items():
+        df.iat[i, pos[col]] = value
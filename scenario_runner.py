@@ -0,0 +1,270 @@
+# coding: utf-8
+
+"""
+Parallel runner of the scenario grids.
+
+A grid is expanded into jobs before anything runs. Every job is an immutable
+spec of one simulation, its key in the results and its frozen parameters, so the
+simulations do not share a parameter dictionary and can run in any order. The
+jobs are run in a process pool that shares the price panel of the parent, see
+price_panel.attach(), and only the metrics of each simulation are sent back.
+
+Jobs that differ only in their end date can be grouped with horizons(), the
+group is simulated once to the last end date and the earlier end dates are cut
+from that run, optionally with the tax brackets that do not change the trades
+of an account. Jobs that differ only in parameters their simulation does not
+read are found with equivalents(), one of them is run for all.
+
+    jobs = [Job(key, freeze(d)) for key, d in grid]
+    results = run(simulate, jobs, workers=8)
+"""
+
+from collections import namedtuple, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
+import pandas as pd
+import price_panel as pp
+
+
+# One simulation of a grid.
+# key: tuple, key of the result
+# params: tuple, frozen parameters, see freeze()
+Job = namedtuple("Job", ["key", "params"])
+
+# Jobs that differ only in their end date, and in the tax brackets that do not
+# change their trades, simulated once to the last end date, see horizons().
+# keys: tuple, keys of the results
+# end_dates: tuple, end date of each key
+# params: tuple, frozen parameters with the last end date
+# brackets: tuple, frozen tax rates of each key, or None
+Horizons = namedtuple("Horizons", ["keys", "end_dates", "params", "brackets"])
+Horizons.__new__.__defaults__ = (None,)
+
+
+def freeze(value):
+    """
+    Immutable copy of a parameter dictionary, nested dictionaries and lists included.
+
+    :param value: dictionary, list or value
+    :return: tuple of sorted (key, value) items, tuple or value
+    """
+    if isinstance(value, dict):
+        return ("__dict__",) + tuple(sorted((k, freeze(v)) for k, v in value.items()))
+    if isinstance(value, list):
+        return ("__list__",) + tuple(freeze(v) for v in value)
+    return value
+
+
+def thaw(value):
+    """
+    New mutable parameter dictionary from a frozen one.
+
+    :param value: from freeze()
+    :return: dictionary, list or value
+    """
+    if isinstance(value, tuple) and value and value[0] == "__dict__":
+        return {k: thaw(v) for k, v in value[1:]}
+    if isinstance(value, tuple) and value and value[0] == "__list__":
+        return [thaw(v) for v in value[1:]]
+    return value
+
+
+def equivalents(jobs, normalize):
+    """
+    Group the jobs that run the same simulation.
+
+    The first job of every group is run, its metrics are the metrics of every key
+    of the group.
+
+    :param jobs: list of Job
+    :param normalize: function, parameter dictionary to the parameters that change
+    its simulation, e.g. sim_cache.normalize
+    :return: tuple, (list of Job, the first of each group, dictionary, key of each
+    of these jobs: list of the keys of its group)
+    """
+    groups = OrderedDict()
+    for job in jobs:
+        groups.setdefault(freeze(normalize(thaw(job.params))), []).append(job)
+
+    first = [members[0] for members in groups.values()]
+    fan_out = {
+        members[0].key: [job.key for job in members] for members in groups.values()
+    }
+    return first, fan_out
+
+
+def horizons(jobs, brackets=None):
+    """
+    Group the jobs whose parameters differ only in end_date.
+
+    :param jobs: list of Job, parameters with an end_date
+    :param brackets: function, parameters to the list of tax rates that may also
+    differ within a group, e.g. refunc.bracket_fields_of, None groups by end date
+    only
+    :return: list of Job and Horizons, in the order of the first job of each group
+    """
+    groups = OrderedDict()
+    for job in jobs:
+        params = thaw(job.params)
+        fields = brackets(params) if brackets is not None else []
+        bracket = {f: params.pop(f) for f in fields}
+        end_date = params.pop("end_date")
+        groups.setdefault(freeze(params), []).append((job, end_date, bracket))
+
+    grouped = []
+    for members in groups.values():
+        if len(members) == 1:
+            grouped.append(members[0][0])
+            continue
+        keys = tuple(job.key for job, _, _ in members)
+        end_dates = tuple(end_date for _, end_date, _ in members)
+        params = last_end(members[0][0], end_dates)
+        if brackets is None:
+            grouped.append(Horizons(keys, end_dates, params))
+        else:
+            bracket_list = tuple(freeze(bracket) for _, _, bracket in members)
+            grouped.append(Horizons(keys, end_dates, params, bracket_list))
+    return grouped
+
+
+def last_end(job, end_dates):
+    """
+    Frozen parameters of a job with the last of the end dates.
+
+    :param job: Job or Horizons
+    :param end_dates: iterable of strings
+    :return: tuple, frozen parameters
+    """
+    params = thaw(job.params)
+    params["end_date"] = max(end_dates, key=pd.Timestamp)
+    return freeze(params)
+
+
+def pending(jobs, done):
+    """
+    Jobs with the keys that are not done yet.
+
+    :param jobs: list of Job and Horizons
+    :param done: set of keys
+    :return: list of Job and Horizons
+    """
+    todo = []
+    for job in jobs:
+        if isinstance(job, Horizons):
+            left = [i for i, k in enumerate(job.keys) if k not in done]
+            if len(left) == len(job.keys):
+                todo.append(job)
+            elif left:
+                keys = tuple(job.keys[i] for i in left)
+                end_dates = tuple(job.end_dates[i] for i in left)
+                brackets = job.brackets and tuple(job.brackets[i] for i in left)
+                params = last_end(job, end_dates)
+                todo.append(Horizons(keys, end_dates, params, brackets))
+        elif job.key not in done:
+            todo.append(job)
+    return todo
+
+
+def keys(jobs):
+    """
+    Keys of the results of the jobs, in order.
+
+    :param jobs: list of Job and Horizons
+    :return: list of tuples
+    """
+    k = []
+    for job in jobs:
+        k.extend(job.keys if isinstance(job, Horizons) else [job.key])
+    return k
+
+
+def run_chunk(func, jobs):
+    """
+    Run a chunk of jobs in a worker process.
+
+    :param func: function, takes a Job and returns its metrics, or takes a
+    Horizons and returns a list of metrics, one per key
+    :param jobs: list of Job and Horizons
+    :return: list of tuples, (key, metrics)
+    """
+    results = []
+    for job in jobs:
+        if isinstance(job, Horizons):
+            results.extend(zip(job.keys, func(job)))
+        else:
+            results.append((job.key, func(job)))
+    return results
+
+
+def imap(func, jobs, workers=None, chunksize=1):
+    """
+    Run the jobs of a grid, yielding the metrics of every job as it completes.
+
+    :param func: function, module level, see run_chunk()
+    :param jobs: list of Job and Horizons
+    :param workers: int, processes, defaults to the number of cpus. 1 runs the
+    jobs in this process.
+    :param chunksize: int, jobs sent to a worker at a time
+    :return: generator of tuples, (key, metrics), in order of completion
+    """
+    if workers == 1:
+        for key, metrics in run_chunk(func, jobs):
+            yield key, metrics
+        return
+
+    if not jobs:
+        return
+
+    with pool(workers) as ex:
+        futures = [
+            ex.submit(run_chunk, func, jobs[i : i + chunksize])
+            for i in range(0, len(jobs), chunksize)
+        ]
+        try:
+            for future in as_completed(futures):
+                for key, metrics in future.result():
+                    yield key, metrics
+        finally:
+            # Jobs not started yet are dropped if the caller stops early.
+            for future in futures:
+                future.cancel()
+
+
+@contextmanager
+def pool(workers=None):
+    """
+    Process pool whose workers share the price panel of this process.
+
+        with pool(6) as ex:
+            returns, _ = rebalance_portfolio(..., executor=ex)
+
+    :param workers: int, processes, defaults to the number of cpus
+    :return: ProcessPoolExecutor, shut down on exit
+    """
+    panel = pp.get_panel()
+    shared = panel._shm is not None
+    handle = panel.share()
+    try:
+        with ProcessPoolExecutor(
+            max_workers=workers, initializer=pp.attach, initargs=(handle,)
+        ) as ex:
+            yield ex
+    finally:
+        # Free the shared memory unless it was shared before.
+        if not shared:
+            panel.release()
+
+
+def run(func, jobs, workers=None, chunksize=1):
+    """
+    Run the jobs of a grid.
+
+    :param func: function, module level, see run_chunk()
+    :param jobs: list of Job and Horizons
+    :param workers: int, processes, defaults to the number of cpus. 1 runs the
+    jobs in this process.
+    :param chunksize: int, jobs sent to a worker at a time
+    :return: dictionary, key: metrics, in the order of the jobs
+    """
+    results = dict(imap(func, jobs, workers, chunksize))
+    return {key: results[key] for key in keys(jobs)}
@@ -1,9 +1,17 @@
-import empyrical as ep
+import copy
+import functools
+import metrics
+import numpy as np
 import pandas as pd
 import pickle
-import rebalance_account as ra
 from rebalance_portfolio import rebalance_portfolio
 import account_templates as at
+import rebalance_account as ra
+import rebalance_portfolio as rp
+import refunc as rf
+import result_store
+import scenario_runner as sr
+import sim_cache as sc
 
 
 # Initial parameter dictionary. Values will be set by the generator.
@@ -43,182 +51,34 @@ params = {
 
 def fin_funcs(df):
     """
-    Financial calculations taken from Quantopians Empirical Library.
+    Financial ratios of the daily returns of an account, see metrics.py.
 
     :param df: dataframe containing daily returns calculated on a percentage change and also by log scale.
-    :return: Dictionary of financial ratios both for percent change returns and log returns.
+    :return: Dictionary of financial ratios for percent change returns.
     """
-    returns_pct = df["pct_change"]
-
-    risk_free_rate = 0.0
-
-    annual_return_pct = ep.annual_return(
-        returns_pct, period="daily", annualization=None
-    )
-    cumm_return_pct = ep.cum_returns(returns_pct, starting_value=0).iloc[-1]
-    cagr_pct = ep.cagr(returns_pct, period="daily", annualization=None)
-    sharpe_pct = ep.sharpe_ratio(
-        returns_pct, risk_free=risk_free_rate, period="daily", annualization=None
-    )
-    annual_volatility_pct = ep.annual_volatility(
-        returns_pct, period="daily", alpha=2.0, annualization=None
-    )
-    max_drawdown_pct = ep.max_drawdown(returns_pct)
-    calmar_pct = ep.calmar_ratio(returns_pct, period="daily", annualization=None)
-    sortino_pct = ep.sortino_ratio(
-        returns_pct,
-        required_return=0,
-        period="daily",
-        annualization=None,
-        _downside_risk=None,
-    )
-    tail_ratio_pct = ep.tail_ratio(returns_pct)
-
-    financials = {
-        "annual_return": annual_return_pct,
-        "cumm_return": cumm_return_pct,
-        "cagr": cagr_pct,
-        "sharpe": sharpe_pct,
-        "annual_volatility": annual_volatility_pct,
-        "max_drawdown": max_drawdown_pct,
-        "calmar": calmar_pct,
-        "sortino": sortino_pct,
-        "tail_ratio": tail_ratio_pct,
-    }
+    # Originally set up program to analyse both pct_change and log returns, but the
+    # difference between log and pct_change was not material to the final analysis.
+    # Consequently pct_change used exclusively. Log returns can be added as a second
+    # row of the returns matrix, as in fin_funcs_port.
+    m = metrics.financials(df["pct_change"].values)
 
-    # Originally set up program to analyse both pct_change and log returns, but the difference between log and
-    # pct_change was not material to the final analysis. Consequently pct_change used exclusively. The code below
-    # is left in tact should log returns at the account level be desired.
-
-    # returns_log = df["log_ret"]
-    # Log returns not used in final scenario.
-    # annual_return_log = ep.annual_return(
-    #     returns_log, period="daily", annualization=None
-    # )
-    # cumm_return_log = ep.cum_returns(returns_log, starting_value=0).iloc[-1]
-    # cagr_log = ep.cagr(returns_log, period="daily", annualization=None)
-    # sharpe_log = ep.sharpe_ratio(
-    #     returns_log, risk_free=risk_free_rate, period="daily", annualization=None
-    # )
-    # annual_volatility_log = ep.annual_volatility(
-    #     returns_log, period="daily", alpha=2.0, annualization=None
-    # )
-    # max_drawdown_log = ep.max_drawdown(returns_log)
-    # calmar_log = ep.calmar_ratio(returns_log, period="daily", annualization=None)
-    # sortino_log = ep.sortino_ratio(
-    #     returns_log,
-    #     required_return=0,
-    #     period="daily",
-    #     annualization=None,
-    #     _downside_risk=None,
-    # )
-    # tail_ratio_log = ep.tail_ratio(returns_log)
-
-    # financials = {
-    #     ("return_percent_change", "annual_return"): annual_return_pct,
-    #     ("return_percent_change", "cumm_return"): cumm_return_pct,
-    #     ("return_percent_change", "cagr"): cagr_pct,
-    #     ("return_percent_change", "sharpe"): sharpe_pct,
-    #     ("return_percent_change", "annual_volatility"): annual_volatility_pct,
-    #     ("return_percent_change", "max_drawdown"): max_drawdown_pct,
-    #     ("return_percent_change", "calmar"): calmar_pct,
-    #     ("return_percent_change", "sortino"): sortino_pct,
-    #     ("return_percent_change", "tail_ratio"): tail_ratio_pct,
-    #     ("return_log", "annual_return"): annual_return_log,
-    #     ("return_log", "cumm_return"): cumm_return_log,
-    #     ("return_log", "cagr"): cagr_log,
-    #     ("return_log", "sharpe"): sharpe_log,
-    #     ("return_log", "annual_volatility"): annual_volatility_log,
-    #     ("return_log", "max_drawdown"): max_drawdown_log,
-    #     ("return_log", "calmar"): calmar_log,
-    #     ("return_log", "sortino"): sortino_log,
-    #     ("return_log", "tail_ratio"): tail_ratio_log,
-    #     }
-
-    return financials
+    return {name: m[name][0] for name in metrics.names}
 
 
 def fin_funcs_port(df):
     """
-    Financial calculations taken from Quantopians Empirical Library.
+    Financial ratios of the daily returns of a portfolio and of its accounts, see
+    metrics.py.
+
     :param df: dataframe containing daily returns calculated for a portfolio and as well for the related accounts.
-    :return: Dictionary of financial ratios both for percent change returns and log returns.
+    :return: Dictionary of financial ratios for the portfolio and the account returns.
     """
-    returns_port = df["portfolio"]
-    returns_acct = df["account"]
-
-    risk_free_rate = 0.0
+    m = metrics.financials(np.vstack([df["portfolio"].values, df["account"].values]))
 
-    annual_return_port = ep.annual_return(
-        returns_port, period="daily", annualization=None
-    )
-    annual_return_acct = ep.annual_return(
-        returns_acct, period="daily", annualization=None
-    )
-
-    cumm_return_port = ep.cum_returns(returns_port, starting_value=0).iloc[-1]
-    cumm_return_acct = ep.cum_returns(returns_acct, starting_value=0).iloc[-1]
-
-    cagr_port = ep.cagr(returns_port, period="daily", annualization=None)
-    cagr_acct = ep.cagr(returns_acct, period="daily", annualization=None)
-
-    sharpe_port = ep.sharpe_ratio(
-        returns_port, risk_free=risk_free_rate, period="daily", annualization=None
-    )
-    sharpe_acct = ep.sharpe_ratio(
-        returns_acct, risk_free=risk_free_rate, period="daily", annualization=None
-    )
-
-    annual_volatility_port = ep.annual_volatility(
-        returns_port, period="daily", alpha=2.0, annualization=None
-    )
-    annual_volatility_acct = ep.annual_volatility(
-        returns_acct, period="daily", alpha=2.0, annualization=None
-    )
-    max_drawdown_port = ep.max_drawdown(returns_port)
-    max_drawdown_acct = ep.max_drawdown(returns_acct)
-
-    calmar_port = ep.calmar_ratio(returns_port, period="daily", annualization=None)
-    calmar_acct = ep.calmar_ratio(returns_acct, period="daily", annualization=None)
-
-    sortino_port = ep.sortino_ratio(
-        returns_port,
-        required_return=0,
-        period="daily",
-        annualization=None,
-        _downside_risk=None,
-    )
-    sortino_acct = ep.sortino_ratio(
-        returns_acct,
-        required_return=0,
-        period="daily",
-        annualization=None,
-        _downside_risk=None,
-    )
-
-    tail_ratio_port = ep.tail_ratio(returns_port)
-    tail_ratio_acct = ep.tail_ratio(returns_acct)
-
-    financials = {
-        ("return_portfolio", "annual_return"): annual_return_port,
-        ("return_portfolio", "cumm_return"): cumm_return_port,
-        ("return_portfolio", "cagr"): cagr_port,
-        ("return_portfolio", "sharpe"): sharpe_port,
-        ("return_portfolio", "annual_volatility"): annual_volatility_port,
-        ("return_portfolio", "max_drawdown"): max_drawdown_port,
-        ("return_portfolio", "calmar"): calmar_port,
-        ("return_portfolio", "sortino"): sortino_port,
-        ("return_portfolio", "tail_ratio"): tail_ratio_port,
-        ("return_account", "annual_return"): annual_return_acct,
-        ("return_account", "cumm_return"): cumm_return_acct,
-        ("return_account", "cagr"): cagr_acct,
-        ("return_account", "sharpe"): sharpe_acct,
-        ("return_account", "annual_volatility"): annual_volatility_acct,
-        ("return_account", "max_drawdown"): max_drawdown_acct,
-        ("return_account", "calmar"): calmar_acct,
-        ("return_account", "sortino"): sortino_acct,
-        ("return_account", "tail_ratio"): tail_ratio_acct,
-    }
+    financials = {}
+    for i, returns in enumerate(["return_portfolio", "return_account"]):
+        for name in metrics.names:
+            financials[(returns, name)] = m[name][i]
 
     return financials
 
@@ -353,17 +213,69 @@ def specify_allocation(d, at, rr):
     return d
 
 
-def save_dict(result_dict, n):
-    # Use this code below to save results to pickle and reset the dictionary.
-    if result_dict:
-        filename = "scenario_data/data_port_asset_allocation/port_" + str(n) + ".pickle"
-        with open(filename, "wb") as f:
-            pickle.dump(result_dict, f)
+def run_grid(
+    grid,
+    func,
+    jobs,
+    workers=None,
+    store=None,
+    normalize=None,
+    brackets=None,
+    online=False,
+):
+    """
+    Run the jobs of a grid that are not in the result store yet.
+
+    Every result is added to the store as it completes, an interrupted grid is
+    continued by calling this again. Jobs that differ only in their end date are
+    simulated once, see scenario_runner.horizons(), as are jobs with equal
+    normalized parameters, see scenario_runner.equivalents(). With online every
+    end date is simulated on its own, the ratios are computed while simulating.
+
+    :param grid: string, name of the grid in the store
+    :param func: function, run_account or run_portfolio
+    :param jobs: list of scenario_runner.Job
+    :param workers: int, processes, defaults to the number of cpus
+    :param store: ResultStore, defaults to result_store.filename
+    :param normalize: function, parameters to the parameters that change the
+    simulation, e.g. sim_cache.normalize, None runs every job
+    :param brackets: function, parameters to the tax rates that do not change the
+    trades, e.g. refunc.bracket_fields_of, jobs that differ only in these are
+    simulated once too, not used with online
+    :param online: boolean, passed to func, see run_account()
+    :return: dataframe, one row per job
+    """
+    if store is None:
+        with result_store.ResultStore() as store:
+            return run_grid(
+                grid, func, jobs, workers, store, normalize, brackets, online
+            )
+
+    if normalize is None:
+        first, fan_out = jobs, {job.key: [job.key] for job in jobs}
     else:
-        pass
+        first, fan_out = sr.equivalents(jobs, normalize)
+
+    # A group is done once every one of its keys is.
+    done = store.keys(grid)
+    done_first = {k for k, group in fan_out.items() if done.issuperset(group)}
+    todo = sr.pending(first if online else sr.horizons(first, brackets), done_first)
+    print(
+        grid,
+        len(done),
+        "done,",
+        sum(len(fan_out[k]) for k in sr.keys(todo)),
+        "to run in",
+        len(todo),
+        "jobs",
+    )
+
+    func = functools.partial(func, online=online)
+    for key, result in sr.imap(func, todo, workers):
+        for k in fan_out[key]:
+            store.put(grid, k, result)
 
-    # Reset the dictionary here.
-    return {}
+    return store.frame(grid, keys=[job.key for job in jobs])
 
 
 def set_start_date_port(accounts, start_date):
@@ -384,7 +296,16 @@ def port_change_dep_with(p2_inv, p1_inv, p2_rsp, p2_tfsa, p1_rsp, p1_tfsa, start
     return (p2_inv, p1_inv, p2_rsp, p2_tfsa, p1_rsp, p1_tfsa)
 
 
-def scenarios(d):
+def account_jobs(d):
+    """
+    Jobs of the account scenario grid, see scenarios().
+
+    The grid is expanded in the order of the loops of the original runner, every
+    job has its own copy of the parameters.
+
+    :param d: dictionary, initial account parameters, not changed
+    :return: list of scenario_runner.Job
+    """
     mutual_funds = (True, False)
     account_type = ("inv", "rsp", "tfsa")
     drip = (True, False)
@@ -392,7 +313,6 @@ def scenarios(d):
     tax_rate = ["low", "medium", "high"]
     duration = ["3 year", "5 year", "10 year"]
     start_date = ["2002-01-01", "2004-01-01", "2005-01-01", "2007-01-01", "2009-01-01"]
-    result_dict = None
     date_dict = {
         "2002-01-01": ["2004-12-31", "2006-12-31", "2011-12-31"],
         "2004-01-01": ["2006-12-31", "2008-12-31", "2013-12-31"],
@@ -403,7 +323,8 @@ def scenarios(d):
     allocation_target = ["75/25", "50/50", "25/75"]
     rebalancing_range = ["narrow", "broad"]
 
-    n = 4321
+    d = copy.deepcopy(d)
+    jobs = []
 
     for du in duration:
         if du == "3 year":
@@ -412,10 +333,10 @@ def scenarios(d):
             dur_dict = {"3 year": 0, "5 year": 1, "10 year": 2}
             d["start_date"] = sd
             d["end_date"] = date_dict[sd][dur_dict[du]]
+            # Only the deposit of this start date.
+            d["dep_with"] = {}
             for ac in account_type:
                 d = set_account_type(d, ac)
-                result_dict = save_dict(result_dict, n)
-                print('####### SAVED #######')
                 for rb in rebalance_period:
                     d["rebalance_period"] = rb
                     for dr in drip:
@@ -427,19 +348,94 @@ def scenarios(d):
                                 for at in allocation_target:
                                     for rr in rebalancing_range:
                                         d = specify_allocation(d, at, rr)
-                                        n += 1
                                         cols = (du, sd, ac, rb, dr, tx, mf, at, rr)
-                                        print(cols, n)
-                                        result_dict[cols] = fin_funcs(
-                                            ra.rebalance_account(d)
-                                        )
+                                        jobs.append(sr.Job(cols, sr.freeze(d)))
+
+    return jobs
+
 
-    result_dict = save_dict(result_dict, n)
+def run_account(job, online=False):
+    """
+    Metrics of one account scenario, called in the worker processes.
+
+    :param job: scenario_runner.Job, or Horizons for a list of metrics, one per key
+    :param online: boolean, compute the metrics of a Job while the account is
+    simulated instead of from its returns, a Horizons is cut from the returns of
+    one run and is not used with online
+    :return: dictionary, as fin_funcs()
+    """
+    if isinstance(job, sr.Horizons):
+        if online:
+            raise ValueError("Online metrics are computed for a Job, not Horizons.")
+        a = sr.thaw(job.params)
+        df = sc.rebalance_account(a)
+
+        # The final DataFrame of every tax bracket of the group, from the one run.
+        frozen = job.brackets or [sr.freeze({})] * len(job.keys)
+        brackets = [sr.thaw(b) for b in frozen]
+        unique = [b for i, b in enumerate(brackets) if b not in brackets[:i]]
+        finals = rf.finalize_brackets(a, df, unique)
+
+        results = []
+        for end_date, bracket in zip(job.end_dates, brackets):
+            if not rf.is_prefix(a, df, end_date):
+                a_end = dict(sr.thaw(job.params), end_date=end_date, **bracket)
+                results.append(fin_funcs(sc.rebalance_account(a_end)))
+            else:
+                final = finals[unique.index(bracket)]
+                results.append(fin_funcs(final.loc[:end_date]))
+        return results
+
+    if online:
+        m = metrics.OnlineMetrics()
+        ra.rebalance_account(sr.thaw(job.params), online=m)
+        return m.result()
+
+    return fin_funcs(sc.rebalance_account(sr.thaw(job.params)))
+
+
+def scenarios(d, workers=None, store=None, online=False):
+    """
+    Metrics of every account scenario.
+
+    :param d: dictionary, initial account parameters
+    :param workers: int, processes, defaults to the number of cpus
+    :param store: ResultStore, completed scenarios are skipped
+    :param online: boolean, compute the metrics while simulating, see run_account()
+    :return: dataframe, one row per scenario
+    """
+    return run_grid(
+        "accounts",
+        run_account,
+        account_jobs(d),
+        workers,
+        store,
+        normalize=sc.normalize,
+        brackets=rf.bracket_fields_of,
+        online=online,
+    )
 
-    return pd.DataFrame.from_dict(result_dict).T
 
+def scenarios_portfolio(
+    p1_inv,
+    p1_rsp,
+    p1_tfsa,
+    p2_inv,
+    p2_rsp,
+    p2_tfsa,
+    workers=None,
+    store=None,
+    online=False,
+):
+    """
+    Metrics of every portfolio scenario.
 
-def scenarios_portfolio(p1_inv, p1_rsp, p1_tfsa, p2_inv, p2_rsp, p2_tfsa):
+    :param p1_inv: dictionary, account parameters, as the other accounts
+    :param workers: int, processes, defaults to the number of cpus
+    :param store: ResultStore, completed scenarios are skipped
+    :param online: boolean, compute the metrics while simulating, see run_portfolio()
+    :return: dataframe, one row per scenario
+    """
 
     accounts_dict = {
         "[p2_inv, p1_inv, p2_rsp, p1_rsp, p2_tfsa, p1_tfsa]": [
@@ -505,10 +501,6 @@ def scenarios_portfolio(p1_inv, p1_rsp, p1_tfsa, p2_inv, p2_rsp, p2_tfsa):
     allocation_target = ["75/25", "50/50", "25/75"]
     rebalancing_range = ["narrow", "broad"]
 
-    result_dict = None
-
-    n = 0
-
     # Allocation parameters for the portfolio.
     # Used to reallocation the portfolio of accounts and mask when rebalancing needed.
     port_allocation = {
@@ -542,12 +534,10 @@ def scenarios_portfolio(p1_inv, p1_rsp, p1_tfsa, p2_inv, p2_rsp, p2_tfsa):
         "rmin_equity": 0.5,
     }
 
+    jobs = []
     for k, accounts in accounts_dict.items():
-        print(k)
         for sd in start_date_list:
             accounts = set_start_date_port(accounts, sd)
-            result_dict = save_dict(result_dict, n)
-            print("***** SAVED *****")
             for du in range(3):
                 ed = date_dict[sd][du]
                 # rsps in pretax dollars, since we are measuring after tax effect after all withdrawals.
@@ -564,19 +554,114 @@ def scenarios_portfolio(p1_inv, p1_rsp, p1_tfsa, p2_inv, p2_rsp, p2_tfsa):
                             port_allocation = specify_allocation(
                                 port_allocation, at, rr
                             )
-                            n += 1
                             cols = (k, sd, duration[du], rb, at, rr)
-                            print(cols, n)
-                            result_dict[cols] = fin_funcs_port(
-                                rebalance_portfolio(port_allocation, accounts, sd, ed)
+                            jobs.append(
+                                portfolio_job(cols, port_allocation, accounts, sd, ed)
                             )
 
-    result_dict = save_dict(result_dict, n)
-    print("final save")
+    return run_grid("portfolios", run_portfolio, jobs, workers, store, online=online)
+
 
-    return pd.DataFrame.from_dict(result_dict).T
+def portfolio_job(key, port_allocation, accounts, start_date, end_date):
+    """
+    Job of one portfolio scenario, with copies of the current parameters.
+
+    :param key: tuple, scenario key
+    :param port_allocation: dictionary, portfolio allocation parameters
+    :param accounts: list of dictionaries, account parameters
+    :param start_date: string
+    :param end_date: string
+    :return: scenario_runner.Job
+    """
+    # The account DataFrames of a previous run are not part of the parameters.
+    accounts = [
+        {k: v for k, v in a.items() if k not in ("df", "dfa")} for a in accounts
+    ]
+    return sr.Job(
+        key,
+        sr.freeze(
+            {
+                "port_allocation": port_allocation,
+                "accounts": accounts,
+                "start_date": start_date,
+                "end_date": end_date,
+            }
+        ),
+    )
 
-def scenarios_portfolio_check(p1_inv, p1_rsp, p1_tfsa, p2_inv, p2_rsp, p2_tfsa):
+
+def run_portfolio(job, online=False):
+    """
+    Metrics of one portfolio scenario, called in the worker processes.
+
+    :param job: scenario_runner.Job, or Horizons for a list of metrics, one per end
+    date
+    :param online: boolean, compute the metrics of a Job while the portfolio is
+    simulated instead of from its returns, a Horizons is cut from the returns of
+    one run and is not used with online
+    :return: dictionary, as fin_funcs_port()
+    """
+    p = sr.thaw(job.params)
+
+    if isinstance(job, sr.Horizons):
+        if online:
+            raise ValueError("Online metrics are computed for a Job, not Horizons.")
+        returns, _ = rebalance_portfolio(
+            p["port_allocation"],
+            p["accounts"],
+            p["start_date"],
+            p["end_date"],
+            compare=True,
+        )
+        results = []
+        for end_date in job.end_dates:
+            if not rf.is_prefix(p["port_allocation"], returns, end_date):
+                p = sr.thaw(job.params)
+                returns_end, _ = rebalance_portfolio(
+                    p["port_allocation"],
+                    p["accounts"],
+                    p["start_date"],
+                    end_date,
+                    compare=True,
+                )
+                results.append(fin_funcs_port(returns_end))
+            else:
+                results.append(fin_funcs_port(returns.loc[:end_date]))
+        return results
+
+    if not online:
+        returns, _ = rebalance_portfolio(
+            p["port_allocation"],
+            p["accounts"],
+            p["start_date"],
+            p["end_date"],
+            compare=True,
+        )
+        return fin_funcs_port(returns)
+
+    # The accounts rebalanced on their own are separate simulations, their ratios
+    # are computed from the returns of their sum.
+    m = metrics.OnlineMetrics()
+    rebalance_portfolio(
+        p["port_allocation"], p["accounts"], p["start_date"], p["end_date"], m
+    )
+    account = rp.compare_accounts(
+        p["port_allocation"], p["accounts"], p["start_date"], p["end_date"]
+    )
+    m_account = metrics.financials(account.values)
+
+    financials = {}
+    for name, value in m.result().items():
+        financials[("return_portfolio", name)] = value
+    for name in metrics.names:
+        financials[("return_account", name)] = m_account[name][0]
+
+    return financials
+
+
+def scenarios_portfolio_check(
+    p1_inv, p1_rsp, p1_tfsa, p2_inv, p2_rsp, p2_tfsa, workers=None, store=None
+):
 
     accounts_dict = {
         "[p2_inv, p1_inv, p2_rsp, p1_rsp, p2_tfsa, p1_tfsa]": [
@@ -608,10 +693,6 @@ def scenarios_portfolio_check(p1_inv, p1_rsp, p1_tfsa, p2_inv, p2_rsp, p2_tfsa):
 
     allocation_target = ["75/25", "50/50", "25/75"]
 
-    result_dict = None
-
-    n = 0
-
     # Allocation parameters for the portfolio.
     # Used to reallocation the portfolio of accounts and mask when rebalancing needed.
     port_allocation = {
@@ -647,15 +728,13 @@ def scenarios_portfolio_check(p1_inv, p1_rsp, p1_tfsa, p2_inv, p2_rsp, p2_tfsa):
 
 
 
+    jobs = []
     for k, accounts in accounts_dict.items():
-        print(k)
         for ind in df_dates.index:
             sd = df_dates.iloc[ind, 0]
             ed = df_dates.iloc[ind, 1]
 
             accounts = set_start_date_port(accounts, sd)
-            result_dict = save_dict(result_dict, n)
-            print("***** SAVED *****")
             # rsps in pretax dollars, since we are measuring after tax effect after all withdrawals.
             p1_inv.update({"dep_with": {sd: 100000}})
             p1_rsp.update({"dep_with": {sd: 186601.9779809666}})
@@ -667,19 +746,14 @@ def scenarios_portfolio_check(p1_inv, p1_rsp, p1_tfsa, p2_inv, p2_rsp, p2_tfsa):
                 port_allocation = specify_allocation(
                     port_allocation, at, "narrow"
                 )
-                n += 1
                 cols = (k, sd, at)
-                print(cols, n)
-                result_dict[cols] = fin_funcs_port(
-                    rebalance_portfolio(port_allocation, accounts, sd, ed)
-                )
-
-    result_dict = save_dict(result_dict, n)
-    print("final save")
+                jobs.append(portfolio_job(cols, port_allocation, accounts, sd, ed))
 
-    return pd.DataFrame.from_dict(result_dict).T
+    return run_grid("portfolios_check", run_portfolio, jobs, workers, store)
 
-def scenarios_portfolio_check_three(p1_inv, p1_rsp, p1_tfsa, p2_inv, p2_rsp, p2_tfsa):
+def scenarios_portfolio_check_three(
+    p1_inv, p1_rsp, p1_tfsa, p2_inv, p2_rsp, p2_tfsa, workers=None, store=None
+):
 
     accounts_dict = {
         "[p1_inv, p1_rsp, p1_tfsa]": [
@@ -725,10 +799,6 @@ def scenarios_portfolio_check_three(p1_inv, p1_rsp, p1_tfsa, p2_inv, p2_rsp, p2_
 
     allocation_target = ["75/25", "50/50", "25/75"]
 
-    result_dict = None
-
-    n = 0
-
     # Allocation parameters for the portfolio.
     # Used to reallocation the portfolio of accounts and mask when rebalancing needed.
     port_allocation = {
@@ -764,15 +834,13 @@ def scenarios_portfolio_check_three(p1_inv, p1_rsp, p1_tfsa, p2_inv, p2_rsp, p2_
 
 
 
+    jobs = []
     for k, accounts in accounts_dict.items():
-        print(k)
         for ind in df_dates.index:
             sd = df_dates.iloc[ind, 0]
             ed = df_dates.iloc[ind, 1]
 
             accounts = set_start_date_port(accounts, sd)
-            result_dict = save_dict(result_dict, n)
-            print("***** SAVED *****")
             # rsps in pretax dollars, since we are measuring after tax effect after all withdrawals.
             p1_inv.update({"dep_with": {sd: 100000}})
             p1_rsp.update({"dep_with": {sd: 186601.9779809666}})
@@ -784,17 +852,10 @@ def scenarios_portfolio_check_three(p1_inv, p1_rsp, p1_tfsa, p2_inv, p2_rsp, p2_
                 port_allocation = specify_allocation(
                     port_allocation, at, "narrow"
                 )
-                n += 1
                 cols = (k, sd, at)
-                print(cols, n)
-                result_dict[cols] = fin_funcs_port(
-                    rebalance_portfolio(port_allocation, accounts, sd, ed)
-                )
-
-    result_dict = save_dict(result_dict, n)
-    print("final save")
+                jobs.append(portfolio_job(cols, port_allocation, accounts, sd, ed))
 
-    return pd.DataFrame.from_dict(result_dict).T
+    return run_grid("portfolios_check_three", run_portfolio, jobs, workers, store)
 
 def scenarios_asset_allocation(p1_inv, p1_rsp, p1_tfsa, p2_inv, p2_rsp, p2_tfsa):
 
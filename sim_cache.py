@@ -0,0 +1,322 @@
+# coding: utf-8
+
+"""
+Content addressed cache of account simulations.
+
+An account DataFrame from rebalance_account() only depends on the account
+parameters, the prices and the code of the engines. The cache key is a digest of
+the parameters that change the simulation, written out in a canonical form, of
+the version of the price panel, see PricePanel.version(), and of the source of
+the engine modules, see code_version(). Results are kept in a small in memory
+LRU.
+
+The disk tier is off by default. Setting cache_dir before the cache is first
+used also keeps the results in pickle files in that directory, shared by every
+process using it and by later runs. Entries of older price data or code are
+never hit again and are evicted from disk once the directory is over its size
+limit.
+
+    sim_cache.cache_dir = ".sim_cache"
+    df = sim_cache.rebalance_account(a)
+"""
+
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import pickle
+import sys
+import event_engine as ee
+import pandas as pd
+import price_panel as pp
+import rebalance_account as ra
+import refunc as rf
+import row_state as rs
+import trade_calendar as tc
+
+
+# Parameters that describe an account but do not change its simulation.
+excluded = ["name", "description", "owner", "account_type", "df", "dfa"]
+
+# Directory of the disk tier of get_cache(), e.g. ".sim_cache", None keeps the
+# simulations in memory only.
+cache_dir = None
+
+# Modules whose code changes the simulations, see code_version().
+engine_modules = [ra, ee, rf, rs, pp, tc, sys.modules[__name__]]
+
+# Default number of DataFrames kept in memory.
+memory_size = 16
+
+# Default size limit of the disk tier in bytes.
+disk_size = 2 * 1024**3
+
+# Share of the size limit left after an eviction, see SimCache.evict().
+low_water = 0.9
+
+# The cache for this process, see get_cache().
+_cache = None
+
+# Digest of the engine modules, see code_version().
+_code_version = None
+
+
+def normalize(a):
+    """
+    Account parameters with the fields its simulation does not read set to fixed
+    values.
+
+    mutual_funds is only read when the dividends are not reinvested by the drip.
+    The tax rates only apply to the transactions of taxable accounts, an rsp uses
+    tax_rate for the tax on withdrawal and a tfsa none of them.
+
+    :param a: dictionary, account parameters, not changed
+    :return: dictionary
+    """
+    a = dict(a)
+    if a["drip"]:
+        a["mutual_funds"] = False
+    if not a["taxable_transactions"]:
+        a["tax_div"] = 0.0
+        a["tax_gains"] = 0.0
+        if not a["taxable_withdrawal"]:
+            a["tax_rate"] = 0.0
+    return a
+
+
+def canonical(a):
+    """
+    Parameters of an account that change its simulation, in canonical form.
+
+    Dates are written as timestamps, the identity of the account is left out and
+    the fields that are not read are normalized, so equal simulations have equal
+    canonical parameters.
+
+    :param a: dictionary, account parameters
+    :return: string, JSON
+    """
+    c = {k: v for k, v in normalize(a).items() if k not in excluded}
+    c["start_date"] = pd.Timestamp(c["start_date"]).isoformat()
+    c["end_date"] = pd.Timestamp(c["end_date"]).isoformat()
+    c["dep_with"] = sorted(
+        (pd.Timestamp(d).isoformat(), v) for d, v in c["dep_with"].items()
+    )
+    return json.dumps(c, sort_keys=True)
+
+
+def code_version():
+    """
+    Digest of the source of the engine modules, computed once per process.
+
+    :return: string, hex digest
+    """
+    global _code_version
+    if _code_version is None:
+        h = hashlib.sha256()
+        for module in engine_modules:
+            with open(module.__file__, "rb") as f:
+                h.update(f.read())
+        _code_version = h.hexdigest()
+    return _code_version
+
+
+def cache_key(a, engine="loop", version=None, code=None):
+    """
+    Key of the simulation of an account.
+
+    :param a: dictionary, account parameters
+    :param engine: string, engine of rebalance_account()
+    :param version: string, price data version, defaults to the current panel
+    :param code: string, version of the engines, defaults to code_version()
+    :return: string, hex digest
+    """
+    version = version or pp.get_panel().version()
+    code = code or code_version()
+    h = hashlib.sha256()
+    for part in (version, code, engine, canonical(a)):
+        h.update(part.encode())
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+class SimCache(object):
+    """
+    In memory LRU in front of a directory of pickled DataFrames.
+
+    The size of the disk tier is counted once and then kept up to date with the
+    files this process writes. Files written by other processes are counted the
+    next time the directory is scanned, on the next eviction.
+
+    :param path: string, directory of the disk tier, None for memory only
+    :param size: int, DataFrames kept in memory
+    :param max_bytes: int, size limit of the disk tier
+    """
+
+    def __init__(self, path=None, size=memory_size, max_bytes=disk_size):
+        self.path = path
+        self.size = size
+        self.max_bytes = max_bytes
+        self._memory = OrderedDict()
+        self._disk_bytes = None
+        if path is not None and not os.path.isdir(path):
+            os.makedirs(path, exist_ok=True)
+
+    def _file(self, key):
+        return os.path.join(self.path, key + ".pickle")
+
+    def _remember(self, key, df):
+        self._memory[key] = df
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.size:
+            self._memory.popitem(last=False)
+
+    def get(self, key):
+        """
+        Cached DataFrame of a key.
+
+        :param key: string, from cache_key()
+        :return: dataframe owned by the caller, or None
+        """
+        df = self._memory.get(key)
+        if df is not None:
+            self._memory.move_to_end(key)
+            return df.copy()
+
+        if self.path is None:
+            return None
+        try:
+            with open(self._file(key), "rb") as f:
+                df = pickle.load(f)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+        self._remember(key, df)
+        return df.copy()
+
+    def put(self, key, df):
+        """
+        Add the DataFrame of a key to both tiers.
+
+        :param key: string, from cache_key()
+        :param df: dataframe, a copy is kept
+        """
+        df = df.copy()
+        self._remember(key, df)
+        if self.path is None:
+            return
+
+        if self._disk_bytes is None:
+            self._disk_bytes = self.disk_bytes()
+
+        # Workers share the directory, the file appears complete or not at all.
+        tmp = self._file(key) + ".%d.tmp" % os.getpid()
+        with open(tmp, "wb") as f:
+            pickle.dump(df, f, protocol=pickle.HIGHEST_PROTOCOL)
+        size = os.path.getsize(tmp)
+        try:
+            size -= os.path.getsize(self._file(key))
+        except OSError:
+            pass
+        os.replace(tmp, self._file(key))
+
+        self._disk_bytes += size
+        if self._disk_bytes > self.max_bytes:
+            self.evict()
+
+    def entries(self):
+        """
+        Files of the disk tier.
+
+        :return: list of tuples, (mtime, size, path), least recently written first
+        """
+        entries = []
+        for e in os.scandir(self.path):
+            if e.name.endswith(".pickle"):
+                try:
+                    st = e.stat()
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, e.path))
+        entries.sort()
+        return entries
+
+    def disk_bytes(self):
+        """
+        Size of the files of the disk tier.
+
+        :return: int, bytes
+        """
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        """
+        Remove the least recently written files of the disk tier when it is over
+        its limit, down to low_water of the limit so that the directory is not
+        scanned again on the next put().
+        """
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        if total > self.max_bytes:
+            for _, size, path in entries:
+                if total <= low_water * self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                total -= size
+        self._disk_bytes = total
+
+    def clear(self):
+        """
+        Empty both tiers.
+        """
+        self._memory.clear()
+        if self.path is not None:
+            for e in os.scandir(self.path):
+                if e.name.endswith(".pickle"):
+                    os.remove(e.path)
+            self._disk_bytes = 0
+
+
+def get_cache():
+    """
+    The simulation cache of this process, created on first use.
+
+    :return: SimCache
+    """
+    global _cache
+    if _cache is None:
+        _cache = SimCache(cache_dir)
+    return _cache
+
+
+def set_cache(cache):
+    """
+    Replace the simulation cache of this process.
+
+    :param cache: SimCache or None for the default on next use
+    """
+    global _cache
+    _cache = cache
+
+
+def rebalance_account(a, engine="loop", cache=None):
+    """
+    rebalance_account.rebalance_account() with cached results.
+
+    :param a: dictionary, account parameters, the start date is moved to the
+    first trade date as rebalance_account() does
+    :param engine: string, "loop" or "event"
+    :param cache: SimCache, defaults to get_cache()
+    :return: dataframe
+    """
+    cache = cache or get_cache()
+    a["start_date"] = pp.get_panel().first_trade_date(a["start_date"])
+    key = cache_key(a, engine)
+
+    df = cache.get(key)
+    if df is None:
+        df = ra.rebalance_account(a, engine)
+        cache.put(key, df)
+    return df
@@ -1,5 +1,25 @@
+import copy
+import os
+import pickle
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+import pytest
+import column_store as cs
+import ingest
+import metrics
+import portfolio_engine as pe
+import price_panel as pp
 import rebalance_account as ra
+import rebalance_portfolio as rp
+import refunc as rf
+import result_store
+import row_state as rs
+import scenario_runner as sr
+import scenarios
+import sim_cache
 import account_templates as at
+import batch_engine as be
 
 test_var_d = at.inv
 df = ra.rebalance_account(test_var_d)
@@ -50,3 +70,526 @@ def test_sum_dividends():
         df["temp"] += df[sec + "-unit"] * df[sec + "-dividends"]
     filt = (df["dividends"] - df["temp"]) > 0
     assert df[filt].empty, df.loc[filt, "dividends"]
+
+
+def test_event_engine_matches_loop():
+    # The single pass engine must reproduce the loop.
+    df_event = ra.rebalance_account(copy.deepcopy(test_var_d), engine="event")
+    cols = [c for c in df_event.columns if df_event[c].dtype.kind in "fb"]
+    pd.testing.assert_frame_equal(
+        df_event[cols], df[cols], check_dtype=False, check_exact=False
+    )
+
+
+def test_column_store_matches_pickle(tmp_path):
+    path = cs.convert("accounts_template.pickle", str(tmp_path / "store"))
+    with open("accounts_template.pickle", "rb") as f:
+        df_pickle = pickle.load(f)
+    panel = pp.load("accounts_template.pickle", path)
+    assert panel.store is not None
+    pd.testing.assert_frame_equal(panel.store.frame(), df_pickle)
+
+    start = panel.first_trade_date("2004-01-01")
+    pd.testing.assert_frame_equal(
+        panel.frame(start, "2008-12-31"),
+        df_pickle.loc[start:"2008-12-31", :].dropna(),
+    )
+
+
+def test_store_panel_reads_columns(tmp_path):
+    path = cs.convert("accounts_template.pickle", str(tmp_path / "store"))
+    panel = pp.load("accounts_template.pickle", path)
+    a = copy.deepcopy(at.inv)
+    a["drip"] = True
+    a["mutual_funds"] = False
+    expected = ra.rebalance_account(copy.deepcopy(a))
+
+    old = pp.get_panel()
+    pp.set_panel(panel)
+    try:
+        result = ra.rebalance_account(copy.deepcopy(a))
+    finally:
+        pp.set_panel(old)
+    assert panel.version() == pp.load("accounts_template.pickle", path).version()
+    assert panel._df is None
+    assert panel.calendar().index.equals(old.calendar().index)
+    pd.testing.assert_frame_equal(result, expected)
+
+
+def test_ingest_template_matches_pickle():
+    with open("data/historical_prices.pickle", "rb") as f:
+        hist = pickle.load(f)
+    with open("accounts_template.pickle", "rb") as f:
+        df_pickle = pickle.load(f)
+    df = ingest.template_frame(hist, end=df_pickle.index[-1])
+    pd.testing.assert_frame_equal(df, df_pickle)
+
+
+def test_ingest_appends_new_days(tmp_path):
+    with open("data/historical_prices.pickle", "rb") as f:
+        hist = pickle.load(f)
+    with open("accounts_template.pickle", "rb") as f:
+        df_pickle = pickle.load(f)
+    template = str(tmp_path / "template.pickle")
+    ingest.save_pickle(df_pickle.iloc[:-100], template)
+    path = cs.convert(template)
+
+    df = ingest.update_template(hist, template)
+    pd.testing.assert_frame_equal(df, ingest.template_frame(hist))
+    assert cs.is_current(path, template)
+    pd.testing.assert_frame_equal(cs.load(path).frame(), df)
+
+
+def test_row_state_round_trip():
+    a = copy.deepcopy(at.inv)
+    df = rf.initialize(a, rf.new_df(a))
+    before = df.copy()
+    re_date = df.index[10]
+    r = rs.read(df, re_date)
+    assert r.cash == df.loc[re_date, "cash"]
+    assert r.unit[rs.XIC] == df.loc[re_date, "XIC-unit"]
+    assert r.etf == [True, True, False, False]
+    rs.write(df, re_date, r)
+    pd.testing.assert_frame_equal(df, before)
+
+
+def test_allocate_household():
+    invested = np.array([[100.0, 0, 0], [50, 30, 20], [40, 0, 0], [10, 0, 0]])
+    new, left = rf.allocate_household(invested, (25.0, 75, 150))
+    # Equity fills the first account, fixed income and cash what is left.
+    expected = [[0, 0, 100], [0, 50, 50], [15, 25, 0], [10, 0, 0]]
+    np.testing.assert_array_equal(new, expected)
+    assert left == (0, 0, 0)
+    new, _ = rf.allocate_household(invested, (20.0, 30, 50))
+    np.testing.assert_array_equal(new[:2], [[20, 30, 50], [100, 0, 0]])
+    assert new.sum() == invested.sum()
+
+
+def test_calc_acb_matches_loop():
+    panel = pp.get_panel()
+    for sec in rf.securities:
+        nav = panel.df[sec + "-nav_per_share"].values
+        div = panel.df[sec + "-dividends"].values
+
+        # Dividends reinvested on a fixed holding, as drip does.
+        unit = np.full(nav.shape, 1000.0)
+        unit_traded = div * unit * 0.7 / nav
+        acb = np.full(nav.shape, nav[0])
+        np.testing.assert_allclose(
+            rf.calc_acb(nav, unit_traded, unit, acb),
+            rf.calc_acb_loop(nav, unit_traded, unit, acb),
+            rtol=1e-12,
+        )
+
+        # Units bought from nothing and sold down to zero, as the sweep does.
+        unit = np.cumsum(unit_traded)
+        unit[len(unit) // 2 :] = 0
+        unit_traded[len(unit) // 2] = 0
+        acb = np.zeros(nav.shape)
+        np.testing.assert_allclose(
+            rf.calc_acb(nav, unit_traded, unit, acb),
+            rf.calc_acb_loop(nav, unit_traded, unit, acb),
+            rtol=1e-12,
+        )
+
+
+def test_drip_factors_match_window():
+    a = copy.deepcopy(at.inv)
+    a["drip"] = True
+    account = rf.new_df(a)
+    factors = rf.drip_factors(a, account)
+    for sec in rf.securities:
+        units, f = factors[sec]
+        w_units, w_f = rf.window_factors(a, account, sec)
+        np.testing.assert_array_equal(units, w_units)
+        np.testing.assert_allclose(f - f[0], w_f - w_f[0], rtol=1e-12, atol=1e-15)
+
+    # Between two rebalancing dates the units grow by the factors.
+    df = ra.rebalance_account(a)
+    s, e = np.flatnonzero(df.rebalanced.values)[:2]
+    units, f = factors["XIC"]
+    u0 = df["XIC-unit"].values[s]
+    np.testing.assert_array_equal(
+        df["XIC-unit"].values[s:e], u0 * (1 + (f[s:e] - f[s]))
+    )
+
+
+def test_event_acb_matches_calc_acb():
+    panel = pp.get_panel()
+    days = panel.df.dropna()
+    for sec in rf.securities:
+        nav = days[sec + "-nav_per_share"].values.astype(float)
+        rows, div = panel.dividend_events()[sec]
+        assert (days[sec + "-dividends"].values[rows] == div).all()
+        unit_traded = np.zeros(nav.shape)
+        unit_traded[rows] = div * 1000 * 0.7 / nav[rows]
+        unit_traded[0] = 0
+
+        # Dividends reinvested on a fixed holding, as drip does.
+        unit = np.full(nav.shape, 1000.0)
+        acb = np.full(nav.shape, nav[0])
+        np.testing.assert_array_equal(
+            rf.event_acb(nav, unit_traded, unit, acb, rows),
+            rf.calc_acb(nav, unit_traded, unit, acb),
+        )
+
+        # Units bought from nothing, as the mutual fund sweep does.
+        unit = np.cumsum(unit_traded)
+        np.testing.assert_array_equal(
+            rf.event_acb(nav, unit_traded, unit, acb, rows),
+            rf.calc_acb(nav, unit_traded, unit, acb),
+        )
+
+
+def test_non_taxable_accounts_skip_acb():
+    acb_columns = [sec + "-acb" for sec in rf.securities]
+    for template in [at.rsp, at.tfsa]:
+        for drip in [True, False]:
+            a = copy.deepcopy(template)
+            a["drip"] = drip
+            a["mutual_funds"] = not drip
+            loop = ra.rebalance_account(copy.deepcopy(a))
+            event = ra.rebalance_account(copy.deepcopy(a), engine="event")
+            assert (loop[acb_columns] == 0).all().all()
+            assert (event[acb_columns] == 0).all().all()
+            np.testing.assert_allclose(
+                event["value_after_tax"], loop["value_after_tax"], rtol=1e-12
+            )
+
+
+def test_bounded_propagate_matches_full():
+    a = copy.deepcopy(at.inv)
+    a["drip"] = True
+    df = rf.initialize(a, rf.new_df(a))
+    re_date = df.index[0]
+    rs.write(df, re_date, rf.rebalance_row(rs.read(df, re_date), a))
+    end_date = df.index[100]
+    full = rf.propagate(re_date, df.copy(), a)
+    bounded = rf.propagate(re_date, df, a, end_date)
+    pd.testing.assert_frame_equal(bounded, full.loc[:end_date, :])
+    # The drip units traded after end_date are written to df.
+    cols = [sec + "-unit_traded" for sec in rf.securities]
+    tail = df.index > end_date
+    pd.testing.assert_frame_equal(
+        df.loc[tail, cols], full.loc[tail, cols], check_dtype=False
+    )
+
+
+def test_period_positions_match_resample():
+    a = copy.deepcopy(at.inv)
+    df = rf.new_df(a)
+    for period in ["M", "Q", "A", "BA"]:
+        a["rebalance_period"] = period
+        dfp = (
+            df.assign(Date=df.index)
+            .resample(a["rebalance_period"])
+            .last()
+            .set_index("Date")
+        )
+        pd.testing.assert_index_equal(
+            rf.trade_period_index(a, df, a["start_date"]).index,
+            dfp.index.dropna(),
+            check_names=False,
+        )
+
+
+def final_value(job):
+    return ra.rebalance_account(sr.thaw(job.params))["value_after_tax"].iloc[-1]
+
+
+def test_scenario_runner_matches_serial():
+    jobs = []
+    for period in ["D", "M", "Q", "A"]:
+        a = copy.deepcopy(at.inv)
+        a["rebalance_period"] = period
+        jobs.append(sr.Job((period,), sr.freeze(a)))
+    assert sr.thaw(jobs[0].params) == dict(at.inv, rebalance_period="D")
+    assert sr.run(final_value, jobs, workers=2) == sr.run(final_value, jobs, workers=1)
+
+
+def test_portfolio_executor_matches_serial():
+    port_allocation = dict(at.params, atar_cash=0.1, atar_fixed_income=0.4)
+    port_allocation.update(amin_fixed_income=0.35, amax_fixed_income=0.45)
+    port_allocation.update(amin_cash=-0.05, amax_cash=0.15)
+    templates = [at.p1_inv, at.p2_inv, at.p1_rsp, at.p1_tfsa]
+
+    def run(executor):
+        accounts = copy.deepcopy(templates)
+        for a, deposit in zip(accounts, [50000, 150000, 20000, 80000]):
+            a["dep_with"] = {"2004-01-02": deposit}
+        accounts[1]["drip"] = True
+        returns, allocation = rp.rebalance_portfolio(
+            port_allocation, accounts, "2004-01-02", "2006-12-31", executor=executor
+        )
+        return returns, allocation, [a["df"] for a in accounts]
+
+    serial = run(None)
+    with ThreadPoolExecutor(2) as threads, sr.pool(2) as processes:
+        for executor in [threads, processes]:
+            returns, allocation, dfs = run(executor)
+            pd.testing.assert_frame_equal(returns, serial[0], check_exact=True)
+            pd.testing.assert_frame_equal(allocation, serial[1], check_exact=True)
+            for df, serial_df in zip(dfs, serial[2]):
+                pd.testing.assert_frame_equal(df, serial_df, check_exact=True)
+
+
+def test_horizons_match_separate_runs():
+    jobs = []
+    for end_date in ["2006-12-31", "2008-12-31"]:
+        a = dict(copy.deepcopy(at.inv), rebalance_period="Q", end_date=end_date)
+        jobs.append(sr.Job((end_date,), sr.freeze(a)))
+    grouped = sr.horizons(jobs)
+    assert len(grouped) == 1 and grouped[0].end_dates == ("2006-12-31", "2008-12-31")
+    assert sr.pending(grouped, {("2008-12-31",)})[0].end_dates == ("2006-12-31",)
+
+    a = sr.thaw(grouped[0].params)
+    df = ra.rebalance_account(a)
+    assert rf.is_prefix(a, df, "2006-12-31")
+    pd.testing.assert_frame_equal(
+        df.loc[:"2006-12-31"], ra.rebalance_account(sr.thaw(jobs[0].params))
+    )
+
+
+def test_online_grid_matches_returns(tmp_path, monkeypatch):
+    jobs = []
+    for end_date in ["2006-12-31", "2008-12-31"]:
+        for tax_rate in [0.3, 0.4]:
+            a = dict(copy.deepcopy(at.inv), rebalance_period="Q", end_date=end_date)
+            a["tax_rate"] = tax_rate
+            jobs.append(sr.Job((end_date, tax_rate), sr.freeze(a)))
+
+    # Every job is simulated with its own online metrics.
+    calls = []
+    result = metrics.OnlineMetrics.result
+    monkeypatch.setattr(
+        metrics.OnlineMetrics, "result", lambda m: calls.append(m) or result(m)
+    )
+
+    frames = []
+    with result_store.ResultStore(str(tmp_path / "results.sqlite")) as store:
+        for online in [False, True]:
+            grid = "online" if online else "returns"
+            frames.append(
+                scenarios.run_grid(
+                    grid,
+                    scenarios.run_account,
+                    jobs,
+                    workers=1,
+                    store=store,
+                    normalize=sim_cache.normalize,
+                    brackets=rf.bracket_fields_of,
+                    online=online,
+                )
+            )
+    assert len(calls) == len(jobs)
+    pd.testing.assert_frame_equal(frames[1], frames[0], check_exact=False, rtol=1e-9)
+
+
+def test_equivalents_share_simulation():
+    jobs = []
+    for drip, mutual_funds, tax_rate in [
+        (True, True, 0.3),
+        (True, False, 0.4),
+        (False, True, 0.3),
+        (False, False, 0.3),
+    ]:
+        a = dict(
+            copy.deepcopy(at.tfsa),
+            drip=drip,
+            mutual_funds=mutual_funds,
+            tax_rate=tax_rate,
+        )
+        jobs.append(sr.Job((drip, mutual_funds, tax_rate), sr.freeze(a)))
+    first, fan_out = sr.equivalents(jobs, sim_cache.normalize)
+    assert fan_out == {
+        (True, True, 0.3): [(True, True, 0.3), (True, False, 0.4)],
+        (False, True, 0.3): [(False, True, 0.3)],
+        (False, False, 0.3): [(False, False, 0.3)],
+    }
+
+    a, b = sr.thaw(jobs[0].params), sr.thaw(jobs[1].params)
+    assert sim_cache.cache_key(a) == sim_cache.cache_key(b)
+    pd.testing.assert_frame_equal(ra.rebalance_account(a), ra.rebalance_account(b))
+
+
+def test_brackets_match_separate_runs():
+    brackets = [
+        {"tax_rate": 0.2965, "tax_div": 0.0756, "tax_gains": 0.1482},
+        {"tax_rate": 0.4641, "tax_div": 0.3175, "tax_gains": 0.2320},
+    ]
+    for template in [at.rsp, at.tfsa]:
+        a = dict(copy.deepcopy(template), rebalance_period="Q")
+        for b, df in zip(brackets, ra.rebalance_brackets(copy.deepcopy(a), brackets)):
+            expected = ra.rebalance_account(dict(copy.deepcopy(a), **b))
+            pd.testing.assert_frame_equal(df, expected, check_exact=True)
+
+    a = copy.deepcopy(at.inv)
+    assert rf.bracket_fields_of(a) == []
+    with pytest.raises(ValueError):
+        rf.finalize_brackets(a, ra.rebalance_account(copy.deepcopy(a)), brackets)
+
+
+def test_batch_lanes_match_separate_runs():
+    lanes = [
+        {
+            "atar_equity": 0.5,
+            "amin_equity": 0.45,
+            "amax_equity": 0.55,
+            "atar_fixed_income": 0.5,
+            "amin_fixed_income": 0.45,
+            "amax_fixed_income": 0.55,
+        },
+        {"amin_equity": 0.35, "amax_equity": 0.65},
+        {"atar_equity": 0.75, "atar_fixed_income": 0.25},
+    ]
+    a = copy.deepcopy(at.inv)
+    a["rebalance_period"] = "Q"
+    dfs = be.rebalance_lanes(copy.deepcopy(a), lanes)
+    for lane, batch in zip(lanes, dfs):
+        single = ra.rebalance_account(dict(copy.deepcopy(a), **lane))
+        pd.testing.assert_frame_equal(
+            batch, single, check_exact=True, check_dtype=False
+        )
+
+    with pytest.raises(ValueError):
+        be.rebalance_lanes(copy.deepcopy(a), [{"drip": True}])
+
+
+def test_portfolio_engine_matches_frames():
+    port_allocation = dict(at.params, atar_cash=0.1, atar_fixed_income=0.4)
+    port_allocation.update(amin_fixed_income=0.35, amax_fixed_income=0.45)
+    port_allocation.update(amin_cash=-0.05, amax_cash=0.15)
+    templates = [at.p1_inv, at.p2_inv, at.p1_rsp, at.p1_tfsa]
+
+    def household():
+        accounts = copy.deepcopy(templates)
+        for a, deposit in zip(accounts, [50000, 150000, 20000, 80000]):
+            a["dep_with"] = {"2004-01-02": deposit}
+        accounts[1]["drip"] = True
+        accounts[3]["mutual_funds"] = True
+        return accounts
+
+    results = []
+    sim_cache.set_cache(sim_cache.SimCache(path=None))
+    try:
+        for engine in [rp, pe]:
+            accounts = household()
+            returns, allocation = engine.rebalance_portfolio(
+                port_allocation,
+                accounts,
+                "2004-01-02",
+                "2008-12-31",
+                compare=engine is rp,
+            )
+            results.append((returns, allocation, [a["df"] for a in accounts]))
+
+        # The comparison can be run on its own.
+        compared = rp.compare_accounts(
+            port_allocation, accounts, "2004-01-02", "2008-12-31"
+        )
+    finally:
+        sim_cache.set_cache(None)
+
+    (returns, allocation, dfs), (pe_returns, pe_allocation, pe_dfs) = results
+    assert list(pe_returns.columns) == ["portfolio"]
+    pd.testing.assert_frame_equal(pe_returns, returns[["portfolio"]], check_exact=True)
+    pd.testing.assert_series_equal(
+        compared, returns["account"], check_exact=True, check_names=False
+    )
+    pd.testing.assert_frame_equal(pe_allocation, allocation, check_exact=True)
+    for pe_df, df in zip(pe_dfs, dfs):
+        pd.testing.assert_frame_equal(pe_df, df, check_exact=True, check_dtype=False)
+
+    # The ratios fed from the rebalancing loop are those of the returns.
+    batch = metrics.financials(returns["portfolio"].values)
+    for engine in [rp, pe]:
+        online = metrics.OnlineMetrics()
+        args = (port_allocation, household(), "2004-01-02", "2008-12-31")
+        assert engine.rebalance_portfolio(*args, online=online) is None
+        result = online.result()
+        for name in metrics.names:
+            np.testing.assert_allclose(result[name], batch[name][0], rtol=1e-9)
+
+
+def test_result_store(tmp_path):
+    path = str(tmp_path / "results.sqlite")
+    with result_store.ResultStore(path) as store:
+        assert store.put("accounts", ("5 year", "2002-01-01", True), {"cagr": 0.1})
+        assert store.put("accounts", ("5 year", "2004-01-01", False), {"cagr": 0.2})
+        assert not store.put("accounts", ("5 year", "2002-01-01", True), {"cagr": 0})
+    with result_store.ResultStore(path) as store:
+        assert store.keys("accounts") == {
+            ("5 year", "2002-01-01", True),
+            ("5 year", "2004-01-01", False),
+        }
+        assert store.keys("portfolios") == set()
+        assert store.get("accounts", prefix=("5 year", "2002-01-01")) == {
+            ("5 year", "2002-01-01", True): {"cagr": 0.1}
+        }
+        keys = [
+            ("5 year", "2004-01-01", False),
+            ("3 year",),
+            ("5 year", "2002-01-01", True),
+        ]
+        assert list(store.get("accounts", keys=keys)) == [keys[0], keys[2]]
+        assert store.frame("accounts").shape == (2, 1)
+
+
+def test_sim_cache(tmp_path):
+    cache = sim_cache.SimCache(str(tmp_path))
+    a = copy.deepcopy(at.inv)
+    df = sim_cache.rebalance_account(a, cache=cache)
+    pd.testing.assert_frame_equal(df, ra.rebalance_account(copy.deepcopy(at.inv)))
+
+    # Renamed accounts share the simulation, other parameters do not.
+    b = dict(copy.deepcopy(at.inv), name="renamed")
+    assert sim_cache.cache_key(a) == sim_cache.cache_key(b)
+    assert sim_cache.cache_key(a) != sim_cache.cache_key(dict(a, tax_rate=0.5))
+    assert sim_cache.cache_key(a) != sim_cache.cache_key(a, version="old")
+    assert sim_cache.cache_key(a) != sim_cache.cache_key(a, code="old")
+
+    # A new process reads the disk tier.
+    disk = sim_cache.SimCache(str(tmp_path))
+    pd.testing.assert_frame_equal(disk.get(sim_cache.cache_key(b)), df)
+
+    # The disk tier is kept under its limit.
+    size = os.path.getsize(disk._file(sim_cache.cache_key(b)))
+    small = sim_cache.SimCache(str(tmp_path), max_bytes=3 * size)
+    for i in range(6):
+        small.put(str(i), df)
+    assert small.disk_bytes() <= 3 * size
+    assert small.get("5") is not None
+
+
+def test_metrics_batch_matches_single():
+    series = [
+        ra.rebalance_account(copy.deepcopy(at.inv))["pct_change"],
+        pd.Series([np.nan, 0.01, -0.02, 0.03]),
+        pd.Series([np.nan]),
+    ]
+    returns, lengths = metrics.returns_matrix(series)
+    batch = metrics.financials(returns, lengths)
+    for i, s in enumerate(series):
+        single = metrics.financials(s.values)
+        for name in metrics.names:
+            np.testing.assert_allclose(batch[name][i], single[name][0], rtol=1e-12)
+
+    # Leading NaN counted in the days, as empyrical.
+    m = metrics.financials(series[1].values)
+    assert np.isclose(m["cumm_return"][0], 1.01 * 0.98 * 1.03 - 1)
+    assert np.isclose(m["annual_return"][0], (1.01 * 0.98 * 1.03) ** (252 / 4) - 1)
+    assert np.isclose(m["max_drawdown"][0], -0.02)
+    assert np.isnan(batch["sharpe"][2])
+
+
+def test_online_metrics_match_returns():
+    for engine in ["loop", "event"]:
+        a = copy.deepcopy(at.inv)
+        a["rebalance_period"] = "M"
+        df = ra.rebalance_account(copy.deepcopy(a), engine)
+        online = metrics.OnlineMetrics()
+        assert ra.rebalance_account(a, engine, online=online) is None
+        batch = metrics.financials(df["pct_change"].values)
+        result = online.result()
+        for name in metrics.names:
+            np.testing.assert_allclose(result[name], batch[name][0], rtol=1e-9)
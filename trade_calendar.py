@@ -0,0 +1,81 @@
+# coding: utf-8
+
+"""
+Period end calendar of the trading days.
+
+The last trading day of every month, quarter or year is found once for the
+whole price panel. The rebalancing dates of an account are then a slice of these
+positions instead of a resample of the account DataFrame on every call.
+"""
+
+import numpy as np
+import pandas as pd
+
+
+# Rebalancing periods where every trading day is a rebalancing date.
+daily_periods = ["D", "B"]
+
+# Calendar anchored periods, their ends do not depend on the first trading day.
+periods = ["M", "Q", "A", "Y", "BA"]
+
+
+class TradeCalendar(object):
+    """
+    Period end positions over an index of trading days.
+
+    :param index: pd.DatetimeIndex, trading days
+    """
+
+    def __init__(self, index):
+        self.index = index
+        self._ends = {}
+
+    def ends(self, period):
+        """
+        Positions of the last trading day of each period, over the whole index.
+
+        :param period: string, pandas frequency, e.g. "M", "Q", "A", "BA"
+        :return: np.array
+        """
+        try:
+            return self._ends[period]
+        except KeyError:
+            dates = pd.Series(self.index, index=self.index).resample(period).last()
+            ends = self.index.get_indexer(dates.dropna())
+            self._ends[period] = ends
+            return ends
+
+    def locate(self, index):
+        """
+        Position of an index in the calendar, if it is a run of calendar days.
+
+        :param index: pd.DatetimeIndex, e.g. of an account DataFrame
+        :return: int or None
+        """
+        if len(index) == 0:
+            return None
+        start = self.index.searchsorted(index[0])
+        if not self.index[start : start + len(index)].equals(index):
+            return None
+        return start
+
+    def period_ends(self, period, start, stop):
+        """
+        Period ends of the trading days start to stop, as resampling those days.
+
+        The last day is always a period end, the period it closes is cut short.
+
+        :param period: string, pandas frequency
+        :param start: int, position of the first trading day
+        :param stop: int, position after the last trading day
+        :return: np.array, positions relative to start
+        """
+        if stop <= start:
+            return np.array([], dtype=int)
+        if period in daily_periods:
+            return np.arange(stop - start)
+
+        ends = self.ends(period)
+        lo = ends.searchsorted(start)
+        hi = ends.searchsorted(stop - 1)
+        return np.append(ends[lo:hi], stop - 1) - start